@@ -0,0 +1,165 @@
+"""Índice aproximado (IVF-flat) para os vetores do RAG.
+
+Os vetores (já normalizados, ver `vector_store`) são agrupados por k-means esférico em
+`n_lists` listas invertidas. Na consulta só as `nprobe` listas cujos centróides são mais
+próximos da query são varridas; `nprobe` maior = mais recall e mais latência.
+
+Arquivos gravados ao lado de `embeddings.npy`:
+- `ivf_centroids.npy`: (n_lists, d) float32, normalizados;
+- `ivf_lists.npy`: ids das linhas ordenados por lista;
+- `ivf_offsets.npy`: (n_lists + 1,) início de cada lista em `ivf_lists.npy`.
+"""
+
+import os
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+
+CENTROIDS_FILE = 'ivf_centroids.npy'
+LISTS_FILE = 'ivf_lists.npy'
+OFFSETS_FILE = 'ivf_offsets.npy'
+ANN_TYPE = 'ivf_flat'
+
+# Abaixo disso a varredura exata é rápida o bastante; o modo 'auto' não constrói o índice
+AUTO_BUILD_MIN_ROWS = 50_000
+DEFAULT_NPROBE = 8
+# Amostra usada no treino do k-means (o restante é só atribuído aos centróides)
+TRAIN_SAMPLE_PER_LIST = 64
+ASSIGN_BATCH = 65_536
+
+
+def default_n_lists(n_rows: int) -> int:
+    """Heurística usual: ~4·sqrt(N) listas, no mínimo 1."""
+    return max(1, min(n_rows, int(4 * np.sqrt(max(n_rows, 1)))))
+
+
+def _normalize(x: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return x / norms
+
+
+def assign_lists(embeddings: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Atribui cada linha ao centróide de maior produto interno (em lotes, memória limitada)."""
+    labels = np.empty(embeddings.shape[0], dtype=np.int32)
+    for start in range(0, embeddings.shape[0], ASSIGN_BATCH):
+        block = np.asarray(embeddings[start:start + ASSIGN_BATCH], dtype=np.float32)
+        labels[start:start + block.shape[0]] = np.argmax(block @ centroids.T, axis=1)
+    return labels
+
+
+def train_kmeans(embeddings: np.ndarray, n_lists: int, n_iter: int = 20, seed: int = 0) -> np.ndarray:
+    """K-means esférico (similaridade de cosseno) sobre uma amostra das linhas."""
+    n_rows = embeddings.shape[0]
+    rng = np.random.default_rng(seed)
+    sample_size = min(n_rows, max(n_lists * TRAIN_SAMPLE_PER_LIST, n_lists))
+    sample_idx = np.sort(rng.choice(n_rows, size=sample_size, replace=False))
+    sample = np.asarray(embeddings[sample_idx], dtype=np.float32)
+
+    centroids = sample[rng.choice(sample_size, size=n_lists, replace=False)].copy()
+    for _ in range(n_iter):
+        labels = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        counts = np.bincount(labels, minlength=n_lists)
+        empty = counts == 0
+        if empty.any():
+            # listas vazias recebem pontos aleatórios da amostra
+            sums[empty] = sample[rng.choice(sample_size, size=int(empty.sum()), replace=False)]
+        centroids = _normalize(sums)
+    return centroids.astype(np.float32)
+
+
+class IVFIndex:
+    """Listas invertidas sobre a matriz de embeddings (que continua em `embeddings.npy`)."""
+
+    def __init__(self, centroids: np.ndarray, lists: np.ndarray, offsets: np.ndarray):
+        self.centroids = centroids
+        self.lists = lists
+        self.offsets = offsets
+
+    @property
+    def n_lists(self) -> int:
+        return int(self.centroids.shape[0])
+
+    @classmethod
+    def build(cls, embeddings: np.ndarray, n_lists: Optional[int] = None, n_iter: int = 20, seed: int = 0) -> 'IVFIndex':
+        n_rows = int(embeddings.shape[0])
+        n_lists = min(n_rows, n_lists or default_n_lists(n_rows))
+        centroids = train_kmeans(embeddings, n_lists, n_iter=n_iter, seed=seed)
+        labels = assign_lists(embeddings, centroids)
+        lists = np.argsort(labels, kind='stable').astype(np.int64)
+        counts = np.bincount(labels, minlength=n_lists)
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return cls(centroids, lists, offsets)
+
+    def save(self, out_dir: Path):
+        out_dir = Path(out_dir)
+        for name, arr in ((CENTROIDS_FILE, self.centroids), (LISTS_FILE, self.lists), (OFFSETS_FILE, self.offsets)):
+            tmp = out_dir / (name + '.tmp')
+            with open(tmp, 'wb') as f:
+                np.save(f, arr)
+            os.replace(tmp, out_dir / name)
+
+    @classmethod
+    def load(cls, vdir: Path) -> Optional['IVFIndex']:
+        vdir = Path(vdir)
+        files = [vdir / CENTROIDS_FILE, vdir / LISTS_FILE, vdir / OFFSETS_FILE]
+        if not all(f.exists() for f in files):
+            return None
+        return cls(
+            np.load(str(files[0])),
+            np.load(str(files[1]), mmap_mode='r'),
+            np.load(str(files[2])),
+        )
+
+    def candidates(self, q: np.ndarray, nprobe: int) -> np.ndarray:
+        """Ids das linhas nas `nprobe` listas mais próximas da query (normalizada)."""
+        nprobe = max(1, min(int(nprobe), self.n_lists))
+        c_scores = self.centroids @ q
+        if nprobe < self.n_lists:
+            probe = np.argpartition(-c_scores, nprobe - 1)[:nprobe]
+        else:
+            probe = np.arange(self.n_lists)
+        parts = [self.lists[self.offsets[c]:self.offsets[c + 1]] for c in probe]
+        if not parts:
+            return np.empty(0, dtype=np.int64)
+        return np.sort(np.concatenate(parts))
+
+    def search(self, q: np.ndarray, embeddings: np.ndarray, top_k: int, nprobe: int = DEFAULT_NPROBE) -> Tuple[np.ndarray, np.ndarray]:
+        """Retorna (linhas, scores) do top_k aproximado, em ordem decrescente de score."""
+        rows = self.candidates(q, nprobe)
+        if rows.size == 0:
+            return rows, np.empty(0, dtype=np.float32)
+        scores = np.asarray(embeddings[rows], dtype=np.float32) @ q
+        k = min(int(top_k), rows.size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return rows[top], scores[top]
+
+
+def remove(vdir: Path):
+    """Apaga um índice IVF existente (p.ex. quando o índice foi regravado sem ANN)."""
+    for name in (CENTROIDS_FILE, LISTS_FILE, OFFSETS_FILE):
+        try:
+            (Path(vdir) / name).unlink()
+        except FileNotFoundError:
+            pass
+
+
+def build_for(vdir: Path, embeddings: np.ndarray, mode: str = 'auto', n_lists: Optional[int] = None) -> Optional[dict]:
+    """Constrói (ou remove) o índice IVF de `vdir` conforme `mode` ('auto', 'on', 'off').
+
+    Retorna o trecho para `config.json['ann']` ou None quando não há índice.
+    """
+    n_rows = int(embeddings.shape[0])
+    if mode == 'off' or n_rows == 0 or (mode == 'auto' and n_rows < AUTO_BUILD_MIN_ROWS):
+        remove(vdir)
+        return None
+    print(f"🧭 Construindo índice IVF-flat para {n_rows} vetores...")
+    index = IVFIndex.build(embeddings, n_lists=n_lists)
+    index.save(vdir)
+    print(f"✅ Índice IVF salvo em: {vdir} (n_lists={index.n_lists})")
+    return {'type': ANN_TYPE, 'n_lists': index.n_lists, 'nprobe': DEFAULT_NPROBE}
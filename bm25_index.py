@@ -0,0 +1,182 @@
+"""Índice lexical BM25 persistente para o RAG.
+
+Construído na indexação (ao lado de `embeddings.npy`, com as linhas na mesma ordem) e
+usado no fallback quando não há embedding da query, no modo `lexical` e no lado lexical
+da busca híbrida. A consulta só percorre as listas de postings dos termos da query, então
+a latência não cresce com o tamanho do corpus como a tokenização por requisição.
+
+Arquivos:
+- `bm25_meta.json`: parâmetros (k1, b, avgdl, n_docs) e vocabulário (termo -> posição);
+- `bm25_offsets.npy`: (V + 1,) início das postings de cada termo;
+- `bm25_docs.npy` / `bm25_tfs.npy`: linha e frequência de cada posting;
+- `bm25_doclen.npy`: número de tokens de cada linha;
+- `bm25_idf.npy`: idf de cada termo.
+"""
+
+import json
+import os
+import re
+import unicodedata
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+META_FILE = 'bm25_meta.json'
+ARRAY_FILES = {
+    'offsets': 'bm25_offsets.npy',
+    'docs': 'bm25_docs.npy',
+    'tfs': 'bm25_tfs.npy',
+    'doclen': 'bm25_doclen.npy',
+    'idf': 'bm25_idf.npy',
+}
+DEFAULT_K1 = 1.2
+DEFAULT_B = 0.75
+
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Minúsculas, sem acentos ("estação" == "estacao"), tokens alfanuméricos."""
+    if not text:
+        return []
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return _TOKEN_RE.findall(text)
+
+
+class BM25Index:
+    """Postings em formato CSR (numpy) + vocabulário em dicionário."""
+
+    def __init__(self, vocab: dict, offsets, docs, tfs, doclen, idf, avgdl: float, k1: float = DEFAULT_K1, b: float = DEFAULT_B):
+        self.vocab = vocab
+        self.offsets = offsets
+        self.docs = docs
+        self.tfs = tfs
+        self.doclen = doclen
+        self.idf = idf
+        self.avgdl = float(avgdl) or 1.0
+        self.k1 = float(k1)
+        self.b = float(b)
+
+    @property
+    def n_docs(self) -> int:
+        return int(self.doclen.shape[0])
+
+    @classmethod
+    def build(cls, texts: Iterable[str], k1: float = DEFAULT_K1, b: float = DEFAULT_B) -> 'BM25Index':
+        vocab = {}
+        term_ids: List[int] = []
+        doc_ids: List[int] = []
+        counts: List[int] = []
+        doclen = []
+        for row, text in enumerate(texts):
+            tokens = tokenize(text or '')
+            doclen.append(len(tokens))
+            tf = {}
+            for tok in tokens:
+                tf[tok] = tf.get(tok, 0) + 1
+            for tok, c in tf.items():
+                tid = vocab.setdefault(tok, len(vocab))
+                term_ids.append(tid)
+                doc_ids.append(row)
+                counts.append(c)
+
+        term_arr = np.asarray(term_ids, dtype=np.int64)
+        order = np.argsort(term_arr, kind='stable')  # mantém as linhas em ordem dentro de cada termo
+        docs = np.asarray(doc_ids, dtype=np.int32)[order]
+        tfs = np.asarray(counts, dtype=np.float32)[order]
+        df = np.bincount(term_arr, minlength=len(vocab))
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(df, out=offsets[1:])
+
+        doclen_arr = np.asarray(doclen, dtype=np.float32)
+        n_docs = max(len(doclen), 1)
+        idf = np.log(1.0 + (n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        avgdl = float(doclen_arr.mean()) if doclen_arr.size else 1.0
+        return cls(vocab, offsets, docs, tfs, doclen_arr, idf, avgdl, k1, b)
+
+    def save(self, out_dir: Path):
+        out_dir = Path(out_dir)
+        arrays = {'offsets': self.offsets, 'docs': self.docs, 'tfs': self.tfs, 'doclen': self.doclen, 'idf': self.idf}
+        for key, name in ARRAY_FILES.items():
+            tmp = out_dir / (name + '.tmp')
+            with open(tmp, 'wb') as f:
+                np.save(f, arrays[key])
+            os.replace(tmp, out_dir / name)
+        tmp = out_dir / (META_FILE + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'k1': self.k1, 'b': self.b, 'avgdl': self.avgdl, 'n_docs': self.n_docs, 'vocab': self.vocab}, f, ensure_ascii=False)
+        os.replace(tmp, out_dir / META_FILE)
+
+    @classmethod
+    def load(cls, vdir: Path) -> Optional['BM25Index']:
+        vdir = Path(vdir)
+        meta_file = vdir / META_FILE
+        if not meta_file.exists() or not all((vdir / n).exists() for n in ARRAY_FILES.values()):
+            return None
+        with open(meta_file, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        arrays = {key: np.load(str(vdir / name), mmap_mode='r') for key, name in ARRAY_FILES.items()}
+        return cls(meta['vocab'], arrays['offsets'], arrays['docs'], arrays['tfs'], arrays['doclen'], arrays['idf'],
+                   meta.get('avgdl', 1.0), meta.get('k1', DEFAULT_K1), meta.get('b', DEFAULT_B))
+
+    def score(self, query: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Retorna (linhas, scores BM25) das linhas com pelo menos um termo da query."""
+        term_ids = sorted({self.vocab[t] for t in tokenize(query) if t in self.vocab})
+        if not term_ids:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        docs_parts = []
+        contrib_parts = []
+        for tid in term_ids:
+            start, end = int(self.offsets[tid]), int(self.offsets[tid + 1])
+            docs = np.asarray(self.docs[start:end])
+            tfs = np.asarray(self.tfs[start:end])
+            norm = self.k1 * (1.0 - self.b + self.b * np.asarray(self.doclen[docs]) / self.avgdl)
+            docs_parts.append(docs)
+            contrib_parts.append(self.idf[tid] * tfs * (self.k1 + 1.0) / (tfs + norm))
+        docs = np.concatenate(docs_parts)
+        contrib = np.concatenate(contrib_parts)
+        rows, inverse = np.unique(docs, return_inverse=True)
+        scores = np.bincount(inverse, weights=contrib).astype(np.float32)
+        return rows.astype(np.int64), scores
+
+    def search(self, query: str, top_k: int, allowed: Optional[np.ndarray] = None,
+               excluded: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Retorna (linhas, scores) do top_k BM25, em ordem decrescente.
+
+        `allowed` (linhas ordenadas, p.ex. de um filtro de metadados) restringe o resultado;
+        linhas em `excluded` (removidas, tombstones) nunca entram.
+        """
+        rows, scores = self.score(query)
+        if allowed is not None:
+            keep = np.isin(rows, allowed, assume_unique=True)
+            rows, scores = rows[keep], scores[keep]
+        if excluded is not None and excluded.size:
+            keep = ~np.isin(rows, excluded)
+            rows, scores = rows[keep], scores[keep]
+        k = min(int(top_k), rows.size)
+        if k <= 0:
+            return rows[:0], scores[:0]
+        top = np.argpartition(-scores, k - 1)[:k] if k < rows.size else np.arange(rows.size)
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return rows[top], scores[top]
+
+
+def remove(vdir: Path):
+    for name in list(ARRAY_FILES.values()) + [META_FILE]:
+        try:
+            (Path(vdir) / name).unlink()
+        except FileNotFoundError:
+            pass
+
+
+def build_for(vdir: Path, texts: Iterable[str]) -> Optional[dict]:
+    """Constrói e salva o índice BM25 de `vdir`; retorna o trecho para `config.json['bm25']`."""
+    index = BM25Index.build(texts)
+    if index.n_docs == 0:
+        remove(vdir)
+        return None
+    index.save(vdir)
+    print(f"✅ Índice BM25 salvo em: {vdir} ({len(index.vocab)} termos, {index.n_docs} linhas)")
+    return {'n_docs': index.n_docs, 'n_terms': len(index.vocab), 'k1': index.k1, 'b': index.b}
@@ -0,0 +1,174 @@
+"""Eliminação de chunks quase duplicados na ingestão (MinHash + LSH).
+
+O mesmo texto de diretriz aparece em várias edições de PDF e em estações do Firestore;
+sem filtro, cada cópia vira uma chamada de embedding, uma linha a mais na varredura e
+evidência repetida no contexto da Fase 1. Antes do embedding, cada chunk recebe uma
+assinatura MinHash dos seus shingles de palavras (tokenização do BM25: sem acentos nem
+maiúsculas). O LSH (bandas da assinatura) acha candidatos; um chunk cuja similaridade de
+Jaccard estimada com um chunk já indexado passa de `DEDUP_THRESHOLD` é descartado, e o id
+do chunk mantido fica registrado (ver `ingest_manifest`: se ele sair do índice, a fonte
+do descartado é reindexada).
+
+As assinaturas dos chunks indexados ficam em `dedup_index.npz`, ao lado do índice, para
+a deduplicação valer também entre execuções da ingestão incremental.
+"""
+
+import os
+import zlib
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+import bm25_index
+
+DEDUP_FILE = 'dedup_index.npz'
+# Jaccard estimado a partir do qual um chunk é considerado cópia de outro
+DEDUP_THRESHOLD = float(os.getenv('RAG_DEDUP_THRESHOLD', '0.8'))
+SHINGLE_WORDS = 5
+# 10 bandas de 6 permutações: pares com Jaccard 0.8 viram candidatos com ~95% de chance
+LSH_BANDS = 10
+LSH_ROWS = 6
+SEED = 1
+_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+
+class NearDuplicateFilter:
+    """Assinaturas MinHash dos chunks mantidos + buckets LSH para achar quase duplicados."""
+
+    def __init__(self, threshold: float = DEDUP_THRESHOLD, bands: int = LSH_BANDS, rows: int = LSH_ROWS, seed: int = SEED):
+        self.threshold = float(threshold)
+        self.bands = int(bands)
+        self.rows = int(rows)
+        self.seed = int(seed)
+        rng = np.random.default_rng(seed)
+        num_perm = self.bands * self.rows
+        # hashing multiplica-desloca: ((a*x + b) mod 2^64) >> 32, com `a` ímpar
+        self._a = rng.integers(1, 2**63, size=num_perm, dtype=np.uint64) | np.uint64(1)
+        self._b = rng.integers(0, 2**63, size=num_perm, dtype=np.uint64)
+        self.ids: List[str] = []
+        self.sigs: List[np.ndarray] = []
+        self._rows_by_id: Dict[str, int] = {}
+        self._dead = set()
+        self._buckets: List[Dict[int, List[int]]] = [{} for _ in range(self.bands)]
+        self._memo: Dict[str, int] = {}
+        # id descartado -> id do chunk mantido
+        self.dropped: Dict[str, str] = {}
+
+    @property
+    def params(self) -> dict:
+        return {'bands': self.bands, 'rows': self.rows, 'seed': self.seed}
+
+    def __len__(self) -> int:
+        return len(self.ids) - len(self._dead)
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """MinHash (uint32, bands*rows valores) dos shingles de palavras; None sem tokens."""
+        tokens = bm25_index.tokenize(text)
+        if not tokens:
+            return None
+        memo = self._memo
+        h = np.empty(len(tokens), dtype=np.uint64)
+        for i, token in enumerate(tokens):
+            v = memo.get(token)
+            if v is None:
+                v = memo[token] = zlib.crc32(token.encode('utf-8'))
+            h[i] = v
+        with np.errstate(over='ignore'):
+            if len(h) > SHINGLE_WORDS:
+                # hash de cada janela de SHINGLE_WORDS tokens (mistura posicional, aritmética mod 2^64)
+                n = len(h) - SHINGLE_WORDS + 1
+                shingles = h[:n].copy()
+                for j in range(1, SHINGLE_WORDS):
+                    shingles = shingles * _MIX + h[j:j + n]
+            else:
+                shingles = h
+            shingles = np.unique(shingles)
+            hv = (self._a[:, None] * shingles[None, :] + self._b[:, None]) >> np.uint64(32)
+        return hv.min(axis=1).astype(np.uint32)
+
+    def _band_keys(self, sig: np.ndarray):
+        for band in range(self.bands):
+            yield band, hash(sig[band * self.rows:(band + 1) * self.rows].tobytes())
+
+    def find(self, sig: np.ndarray) -> Optional[str]:
+        """Id de um chunk mantido com Jaccard estimado >= threshold, ou None."""
+        candidates = set()
+        for band, key in self._band_keys(sig):
+            candidates.update(self._buckets[band].get(key, ()))
+        candidates.difference_update(self._dead)
+        if not candidates:
+            return None
+        rows = sorted(candidates)
+        sims = (np.vstack([self.sigs[r] for r in rows]) == sig).mean(axis=1)
+        best = int(np.argmax(sims))
+        return self.ids[rows[best]] if sims[best] >= self.threshold else None
+
+    def add(self, doc_id: str, sig: np.ndarray):
+        row = len(self.ids)
+        old = self._rows_by_id.get(doc_id)
+        if old is not None:
+            self._dead.add(old)
+        self.ids.append(doc_id)
+        self.sigs.append(sig)
+        self._rows_by_id[doc_id] = row
+        for band, key in self._band_keys(sig):
+            self._buckets[band].setdefault(key, []).append(row)
+
+    def remove(self, ids: Iterable[str]) -> int:
+        """Tira os chunks `ids` (fontes alteradas/removidas) da comparação."""
+        removed = 0
+        for doc_id in ids:
+            row = self._rows_by_id.pop(doc_id, None)
+            if row is not None:
+                self._dead.add(row)
+                removed += 1
+        return removed
+
+    def filter(self, items: Iterable[dict]) -> Iterator[dict]:
+        """Repassa os itens ({'id', 'text', 'meta'}) que não são quase duplicados de um já visto."""
+        for item in items:
+            sig = self.signature(item.get('text') or '')
+            if sig is None:
+                yield item
+                continue
+            kept = self.find(sig)
+            if kept is not None and kept != item['id']:
+                self.dropped[item['id']] = kept
+                continue
+            self.add(item['id'], sig)
+            yield item
+
+    @classmethod
+    def load(cls, vdir: Path, threshold: float = DEDUP_THRESHOLD) -> 'NearDuplicateFilter':
+        """Filtro com as assinaturas salvas em `vdir` (vazio se não há arquivo ou os parâmetros mudaram)."""
+        dedup = cls(threshold)
+        path = Path(vdir) / DEDUP_FILE
+        if not path.exists():
+            return dedup
+        try:
+            with np.load(str(path), allow_pickle=False) as data:
+                params = {k: int(data[k]) for k in ('bands', 'rows', 'seed')}
+                ids, sigs = data['ids'], data['sigs']
+        except (OSError, KeyError, ValueError) as e:
+            print(f"⚠️ Falha ao ler {path}: {e}; deduplicação recomeça do zero")
+            return dedup
+        if params != dedup.params:
+            return dedup
+        for doc_id, sig in zip(ids.tolist(), sigs):
+            dedup.add(doc_id, sig)
+        return dedup
+
+    def save(self, vdir: Path):
+        live = [r for r in range(len(self.ids)) if r not in self._dead]
+        path = Path(vdir) / DEDUP_FILE
+        tmp = path.with_name(path.name + '.tmp.npz')
+        sigs = np.vstack([self.sigs[r] for r in live]) if live else np.empty((0, self.bands * self.rows), dtype=np.uint32)
+        np.savez(str(tmp), ids=np.array([self.ids[r] for r in live], dtype=str), sigs=sigs, **self.params)
+        os.replace(tmp, path)
+
+
+def remove(vdir: Path):
+    path = Path(vdir) / DEDUP_FILE
+    if path.exists():
+        path.unlink()
@@ -0,0 +1,245 @@
+"""Texto completo dos chunks e acesso aleatório ao `metadata.jsonl`.
+
+O `metadata.jsonl` guarda só um `text_preview` de 500 caracteres; o texto completo de
+cada linha do índice fica aqui, em blocos comprimidos (zlib) com um índice de offsets,
+e é lido só para as evidências retornadas:
+- `chunks.zlib`: blocos comprimidos, cada um com vários chunks concatenados (UTF-8);
+- `chunks_blocks.npy`: (n_blocos + 1,) offset de cada bloco no arquivo;
+- `chunks_index.npy`: (n_linhas, 3) bloco, início e fim do chunk no bloco descomprimido.
+
+`JsonlRecords` dá acesso por linha ao `metadata.jsonl` sem carregar tudo numa lista de
+dicts: só os offsets das linhas ficam em memória (`metadata_offsets.npy`, recalculado
+se o arquivo mudou).
+"""
+
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+import numpy as np
+
+DATA_FILE = 'chunks.zlib'
+BLOCKS_FILE = 'chunks_blocks.npy'
+INDEX_FILE = 'chunks_index.npy'
+METADATA_OFFSETS_FILE = 'metadata_offsets.npy'
+# Tamanho (bytes, descomprimido) a partir do qual um bloco é fechado
+BLOCK_SIZE = 64 * 1024
+# Blocos descomprimidos mantidos em memória (LRU)
+BLOCK_CACHE_SIZE = 32
+
+
+def _save_npy(path: Path, arr: np.ndarray):
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'wb') as f:
+        np.save(f, arr)
+    os.replace(tmp, path)
+
+
+class ChunkStoreWriter:
+    """Grava os chunks em blocos comprimidos, na ordem das linhas do índice."""
+
+    def __init__(self, out_dir: Path, block_size: int = BLOCK_SIZE):
+        self.out_dir = Path(out_dir)
+        self.block_size = block_size
+        self._tmp = self.out_dir / (DATA_FILE + '.tmp')
+        self._f = open(self._tmp, 'wb')
+        self._block: List[bytes] = []
+        self._block_len = 0
+        self._blocks = [0]
+        self._index = []
+
+    def add(self, text: str):
+        data = (text or '').encode('utf-8')
+        self._index.append((len(self._blocks) - 1, self._block_len, self._block_len + len(data)))
+        self._block.append(data)
+        self._block_len += len(data)
+        if self._block_len >= self.block_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._block:
+            return
+        self._f.write(zlib.compress(b''.join(self._block), 6))
+        self._blocks.append(self._f.tell())
+        self._block = []
+        self._block_len = 0
+
+    def close(self) -> int:
+        """Fecha o arquivo e publica os três arquivos; retorna o número de linhas."""
+        self._flush()
+        self._f.close()
+        _save_npy(self.out_dir / BLOCKS_FILE, np.asarray(self._blocks, dtype=np.int64))
+        _save_npy(self.out_dir / INDEX_FILE, np.asarray(self._index, dtype=np.int64).reshape(-1, 3))
+        os.replace(self._tmp, self.out_dir / DATA_FILE)
+        return len(self._index)
+
+
+class ChunkStore:
+    """Leitura preguiçosa dos chunks: um bloco é descomprimido só quando uma linha dele é pedida."""
+
+    def __init__(self, data_path: Path, blocks: np.ndarray, index: np.ndarray):
+        self.data_path = Path(data_path)
+        self.blocks = blocks
+        self.index = index
+        self._cache: "OrderedDict[int, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+        # aberto já no carregamento: uma regravação (os.replace) não mistura arquivos novos
+        # com o índice antigo desta geração
+        self._f = open(self.data_path, 'rb')
+
+    def __len__(self) -> int:
+        return int(self.index.shape[0])
+
+    @classmethod
+    def load(cls, vdir: Path) -> Optional['ChunkStore']:
+        vdir = Path(vdir)
+        files = [vdir / DATA_FILE, vdir / BLOCKS_FILE, vdir / INDEX_FILE]
+        if not all(f.exists() for f in files):
+            return None
+        return cls(files[0], np.load(str(files[1])), np.load(str(files[2]), mmap_mode='r'))
+
+    def _read_block(self, block: int) -> bytes:
+        data = self._cache.get(block)
+        if data is not None:
+            self._cache.move_to_end(block)
+            return data
+        start, end = int(self.blocks[block]), int(self.blocks[block + 1])
+        self._f.seek(start)
+        data = zlib.decompress(self._f.read(end - start))
+        self._cache[block] = data
+        while len(self._cache) > BLOCK_CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return data
+
+    def get(self, row: int) -> Optional[str]:
+        if row < 0 or row >= len(self):
+            return None
+        block, start, end = (int(x) for x in self.index[row])
+        with self._lock:
+            data = self._read_block(block)
+        return data[start:end].decode('utf-8')
+
+    def get_many(self, rows: Iterable[int]) -> List[Optional[str]]:
+        return [self.get(int(r)) for r in rows]
+
+    def close(self):
+        with self._lock:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+            self._cache.clear()
+
+
+def write_store(out_dir: Path, texts: Iterable[str]) -> Optional[dict]:
+    """Grava o chunk store de `out_dir`; retorna o trecho para `config.json['chunk_store']`."""
+    writer = ChunkStoreWriter(out_dir)
+    for text in texts:
+        writer.add(text)
+    n_rows = writer.close()
+    if n_rows == 0:
+        remove(out_dir)
+        return None
+    size = (Path(out_dir) / DATA_FILE).stat().st_size
+    print(f"✅ Texto completo dos chunks salvo em: {Path(out_dir) / DATA_FILE} ({n_rows} linhas, {size} bytes)")
+    return {'rows': n_rows, 'compression': 'zlib', 'block_size': BLOCK_SIZE}
+
+
+def remove(vdir: Path):
+    for name in (DATA_FILE, BLOCKS_FILE, INDEX_FILE):
+        try:
+            (Path(vdir) / name).unlink()
+        except FileNotFoundError:
+            pass
+
+
+# --- metadata.jsonl com acesso por linha -----------------------------------
+
+def line_offsets(path: Path) -> np.ndarray:
+    """Offsets (n_linhas, 2) de início e fim das linhas não vazias de um arquivo JSONL."""
+    starts = []
+    ends = []
+    pos = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                starts.append(pos)
+                ends.append(pos + len(line))
+            pos += len(line)
+    offsets = np.empty((len(starts), 2), dtype=np.int64)
+    if starts:
+        offsets[:, 0] = starts
+        offsets[:, 1] = ends
+    return offsets
+
+
+def write_metadata_offsets(vdir: Path) -> Optional[np.ndarray]:
+    """Calcula e salva `metadata_offsets.npy` para o `metadata.jsonl` de `vdir`.
+
+    Uma linha extra ao final guarda o tamanho do arquivo, para detectar offsets vencidos.
+    """
+    meta_file = Path(vdir) / 'metadata.jsonl'
+    if not meta_file.exists():
+        return None
+    offsets = line_offsets(meta_file)
+    _save_npy(Path(vdir) / METADATA_OFFSETS_FILE, np.vstack([offsets, [[meta_file.stat().st_size, 0]]]))
+    return offsets
+
+
+class JsonlRecords:
+    """Sequência somente leitura sobre um JSONL: cada item é parseado ao ser acessado."""
+
+    def __init__(self, path: Path, offsets: np.ndarray):
+        self.path = Path(path)
+        self.offsets = offsets
+        self._lock = threading.Lock()
+        self._f = open(self.path, 'rb')
+
+    @classmethod
+    def load(cls, vdir: Path) -> Optional['JsonlRecords']:
+        """Abre o `metadata.jsonl` de `vdir`, reaproveitando os offsets salvos se ainda valem."""
+        vdir = Path(vdir)
+        meta_file = vdir / 'metadata.jsonl'
+        if not meta_file.exists():
+            return None
+        offsets = None
+        off_file = vdir / METADATA_OFFSETS_FILE
+        if off_file.exists():
+            saved = np.load(str(off_file))
+            # a última linha guarda o tamanho do arquivo quando os offsets foram gerados
+            if saved.shape[0] >= 1 and int(saved[-1, 0]) == meta_file.stat().st_size:
+                offsets = saved[:-1]
+        if offsets is None:
+            offsets = line_offsets(meta_file)
+        return cls(meta_file, offsets)
+
+    def __len__(self) -> int:
+        return int(self.offsets.shape[0])
+
+    def __getitem__(self, i: int) -> dict:
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError(i)
+        start, end = int(self.offsets[i, 0]), int(self.offsets[i, 1])
+        with self._lock:
+            self._f.seek(start)
+            raw = self._f.read(end - start)
+        return json.loads(raw.decode('utf-8'))
+
+    def __iter__(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+    def close(self):
+        with self._lock:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
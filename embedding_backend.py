@@ -0,0 +1,552 @@
+"""Backend de embeddings compartilhado pelo RAG e pelos indexadores.
+
+O backend é resolvido uma única vez (chave, cliente e modelo) e depois só expõe
+`embed(texts) -> np.ndarray` com shape (N, d) em float32. Assim o `rag_agent` não
+reconfigura a chave nem testa nomes de função a cada consulta, e `ingest_and_index.py`
+e `scripts/reindex_vectors.py` geram os vetores exatamente pelo mesmo caminho.
+
+O cliente Gemini é próprio do backend (`client=` do `embed_content`): o
+`genai.configure` feito na rotação de chaves da geração não troca a chave dos
+embeddings no meio de uma consulta.
+
+Sem rede (CI, API fora do ar), o backend local (`LocalEmbeddingBackend`) gera os vetores
+na CPU: hashing dos tokens + TF-IDF projetado por um SVD aleatorizado ajustado no próprio
+corpus. É escolhido pelo `model` do config.json (`local/<nome>`), como qualquer outro modelo.
+"""
+
+import hashlib
+import json
+import os
+import random
+import shutil
+import threading
+import time
+import zlib
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import bm25_index
+
+# Limite de textos por chamada de embedding em lote (batchEmbedContents)
+EMBED_BATCH_LIMIT = 100
+DEFAULT_TIMEOUT = 15.0
+DEFAULT_MODEL = 'models/embedding-001'
+# Escalonador multi-chave (reindexação): requisições/s e rajada por chave, lotes em
+# andamento (0 = 2 por chave) e tentativas por lote em erros que não são 429
+EMBED_RATE_PER_KEY = float(os.getenv('EMBED_RATE_PER_KEY', '5'))
+EMBED_BURST_PER_KEY = float(os.getenv('EMBED_BURST_PER_KEY', '5'))
+EMBED_MAX_IN_FLIGHT = int(os.getenv('EMBED_MAX_IN_FLIGHT', '0'))
+EMBED_MAX_RETRIES = int(os.getenv('EMBED_MAX_RETRIES', '3'))
+# Backoff após um 429: começa em BACKOFF_INITIAL s e dobra a cada 429 seguido
+BACKOFF_INITIAL = 2.0
+BACKOFF_MAX = 120.0
+# Limite de 429 seguidos num mesmo lote antes de desistir dele
+MAX_RATE_LIMITED_ATTEMPTS = 20
+# Backend local: `--model local` ajusta um modelo novo no corpus; os ajustados se chamam
+# `local/<nome>` e ficam em LOCAL_MODEL_DIR/<nome>/ (projection.npy + meta.json)
+LOCAL_MODEL = 'local'
+LOCAL_MODEL_PREFIX = 'local/'
+LOCAL_MODEL_DIR = Path(os.getenv('RAG_LOCAL_EMBED_DIR', str(Path(__file__).parent / 'memoria' / 'vectors' / 'local_embedders')))
+LOCAL_EMBED_DIM = int(os.getenv('RAG_LOCAL_EMBED_DIM', '256'))
+# buckets do hashing (potência de 2) e textos usados no ajuste (amostra uniforme do corpus)
+LOCAL_EMBED_FEATURES = int(os.getenv('RAG_LOCAL_EMBED_FEATURES', str(1 << 15)))
+LOCAL_FIT_DOCS = int(os.getenv('RAG_LOCAL_EMBED_FIT_DOCS', '20000'))
+LOCAL_OVERSAMPLE = 10
+LOCAL_POWER_ITERS = 2
+# elementos não nulos por bloco no produto esparso x denso
+LOCAL_SPMM_NNZ = 1 << 16
+LOCAL_MEMO_MAX = 1_000_000
+
+
+class EmbeddingError(RuntimeError):
+    """Falha ao resolver o backend ou ao gerar embeddings."""
+
+
+class EmbeddingBackend:
+    """Interface comum: `embed(texts)` retorna uma matriz (N, d) float32."""
+
+    name = 'base'
+    # chama uma API paga/limitada (os caches de embedding só valem a pena nesse caso)
+    remote = True
+
+    def __init__(self, model: str):
+        self.model = model
+
+    def embed(self, texts: Sequence[str], timeout: Optional[float] = None) -> np.ndarray:
+        raise NotImplementedError
+
+    def embed_one(self, text: str, timeout: Optional[float] = None) -> np.ndarray:
+        return self.embed([text], timeout=timeout)[0]
+
+    def probe(self, sample_text: str = 'teste de disponibilidade') -> int:
+        """Gera um embedding de teste e retorna a dimensão (EmbeddingError se falhar)."""
+        return int(self.embed_one(sample_text).shape[0])
+
+    def describe(self) -> dict:
+        return {'backend': self.name, 'model': self.model}
+
+
+class GeminiEmbeddingBackend(EmbeddingBackend):
+    """Embeddings via `google.generativeai.embed_content`, com cliente e chave fixos."""
+
+    name = 'gemini'
+
+    def __init__(self, model: str, key_slot: Optional[str] = None, timeout: float = DEFAULT_TIMEOUT):
+        super().__init__(model)
+        try:
+            import google.generativeai as genai
+            from google.ai import generativelanguage as glm
+        except Exception as e:
+            raise EmbeddingError(f"google.generativeai não disponível: {e}")
+        import gemini_client
+
+        if key_slot:
+            slot = key_slot
+            key = (os.getenv(key_slot) or '').strip() or None
+        else:
+            slot, key = gemini_client.first_available_key()
+        if not key:
+            raise EmbeddingError(f"Nenhuma chave encontrada em {', '.join(gemini_client.KEY_SLOTS)}")
+
+        self._embed_content = getattr(genai, 'embed_content', None)
+        if self._embed_content is None:
+            raise EmbeddingError("google.generativeai sem 'embed_content'; atualize o pacote")
+        self._client = glm.GenerativeServiceClient(client_options={'api_key': key})
+        self.key_slot = slot
+        self.timeout = timeout
+
+    def embed(self, texts: Sequence[str], timeout: Optional[float] = None) -> np.ndarray:
+        """`timeout` é o prazo da chamada inteira (todas as requisições). As novas tentativas
+        internas do SDK (até 60 s em 503) ficam desligadas: quem chama decide se tenta de
+        novo (escalonador, fallback do rag_agent), e a thread não passa do prazo."""
+        texts = list(texts)
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        timeout = timeout or self.timeout
+        deadline = time.monotonic() + timeout
+        parts = []
+        for start in range(0, len(texts), EMBED_BATCH_LIMIT):
+            chunk = texts[start:start + EMBED_BATCH_LIMIT]
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise EmbeddingError(f"embed_content excedeu {timeout:g}s ({self.model})")
+            request_options = {'timeout': remaining, 'retry': None}
+            try:
+                resp = self._embed_content(model=self.model, content=chunk, client=self._client, request_options=request_options)
+            except Exception as e:
+                raise EmbeddingError(f"embed_content falhou ({self.model}): {e}") from e
+            arr = np.asarray(resp.get('embedding') if isinstance(resp, dict) else None, dtype=np.float32)
+            if arr.ndim != 2 or arr.shape[0] != len(chunk) or arr.shape[1] == 0:
+                raise EmbeddingError(f"Resposta de embedding inválida ({self.model}): shape={arr.shape}")
+            parts.append(arr)
+        return parts[0] if len(parts) == 1 else np.vstack(parts)
+
+    def describe(self) -> dict:
+        return {**super().describe(), 'key_slot': self.key_slot}
+
+
+def is_local_model(model: Optional[str]) -> bool:
+    return bool(model) and (model == LOCAL_MODEL or model.startswith(LOCAL_MODEL_PREFIX))
+
+
+def _hash_rows(texts: Sequence[str], n_features: int, memo: Dict[str, int]):
+    """Matriz esparsa (ptr, cols, vals) dos textos: tf sublinear com o sinal do hash do token."""
+    hashes: List[int] = []
+    tfs: List[int] = []
+    ptr = [0]
+    for text in texts:
+        for token, tf in Counter(bm25_index.tokenize(text)).items():
+            h = memo.get(token)
+            if h is None:
+                if len(memo) >= LOCAL_MEMO_MAX:
+                    memo.clear()
+                h = memo[token] = zlib.crc32(token.encode('utf-8'))
+            hashes.append(h)
+            tfs.append(tf)
+        ptr.append(len(hashes))
+    h = np.asarray(hashes, dtype=np.int64)
+    vals = 1.0 + np.log(np.asarray(tfs, dtype=np.float32))
+    vals[(h >> 31) == 0] *= -1.0
+    return np.asarray(ptr, dtype=np.int64), h & (n_features - 1), vals
+
+
+def _spmm(keys: np.ndarray, cols: np.ndarray, vals: np.ndarray, mat: np.ndarray, n_out: int) -> np.ndarray:
+    """out[keys[i]] += vals[i] * mat[cols[i]], com `keys` em ordem crescente (em blocos)."""
+    out = np.zeros((n_out, mat.shape[1]), dtype=np.float32)
+    for start in range(0, len(keys), LOCAL_SPMM_NNZ):
+        k = keys[start:start + LOCAL_SPMM_NNZ]
+        prod = np.asarray(mat[cols[start:start + LOCAL_SPMM_NNZ]], dtype=np.float32) * vals[start:start + LOCAL_SPMM_NNZ, None]
+        heads = np.flatnonzero(np.r_[True, k[1:] != k[:-1]])
+        out[k[heads]] += np.add.reduceat(prod, heads, axis=0)
+    return out
+
+
+class LocalEmbeddingBackend(EmbeddingBackend):
+    """Embeddings na CPU, sem rede: hashing dos tokens -> TF-IDF -> projeção SVD.
+
+    A projeção (n_features x dim, já multiplicada pelo IDF) é ajustada uma vez com
+    `fit` e gravada com o nome do modelo, que inclui um hash dela: um reajuste gera outro
+    modelo, então config.json, segmentos e cache de embeddings não misturam espaços.
+    """
+
+    name = 'local'
+    remote = False
+
+    def __init__(self, model: str, projection: np.ndarray, meta: Optional[dict] = None):
+        super().__init__(model)
+        self.projection = projection
+        self.n_features = int(projection.shape[0])
+        self.dim = int(projection.shape[1])
+        self.meta = meta or {}
+        self._memo: Dict[str, int] = {}
+
+    @staticmethod
+    def model_dir(model: str, base_dir: Optional[Path] = None) -> Path:
+        return Path(base_dir or LOCAL_MODEL_DIR) / model[len(LOCAL_MODEL_PREFIX):]
+
+    @classmethod
+    def load(cls, model: str, base_dir: Optional[Path] = None) -> 'LocalEmbeddingBackend':
+        if model == LOCAL_MODEL:
+            raise EmbeddingError("o modelo 'local' precisa ser ajustado no corpus (ingestão/reindex com --model local)")
+        mdir = cls.model_dir(model, base_dir)
+        try:
+            projection = np.load(str(mdir / 'projection.npy'), mmap_mode='r')
+            with open(mdir / 'meta.json', 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError) as e:
+            raise EmbeddingError(f"Modelo local {model} não encontrado em {mdir}: {e}") from e
+        return cls(model, projection, meta)
+
+    @classmethod
+    def fit(cls, texts: Sequence[str], dim: int = LOCAL_EMBED_DIM, n_features: int = LOCAL_EMBED_FEATURES,
+            max_docs: int = LOCAL_FIT_DOCS, seed: int = 0) -> 'LocalEmbeddingBackend':
+        """Ajusta IDF e projeção numa amostra de `texts` (SVD aleatorizado, Halko et al.)."""
+        texts = [t for t in texts if t]
+        if not texts:
+            raise EmbeddingError("nenhum texto para ajustar o modelo local")
+        if max_docs and len(texts) > max_docs:
+            texts = [texts[i] for i in np.linspace(0, len(texts) - 1, max_docs).astype(np.int64)]
+        n_features = 1 << max(10, int(n_features).bit_length() - 1)
+        ptr, cols, vals = _hash_rows(texts, n_features, {})
+        n = len(texts)
+        rows = np.repeat(np.arange(n, dtype=np.int64), np.diff(ptr))
+        df = np.bincount(np.unique(rows * n_features + cols) % n_features, minlength=n_features)
+        idf = (np.log((1.0 + n) / (1.0 + df)) + 1.0).astype(np.float32)
+        w = vals * idf[cols]
+        norms = np.sqrt(np.bincount(rows, weights=w * w, minlength=n)).astype(np.float32)
+        w /= np.maximum(norms, 1e-12)[rows]
+
+        k = max(1, min(int(dim) + LOCAL_OVERSAMPLE, n, n_features))
+        order = np.argsort(cols, kind='stable')
+        t_keys, t_cols, t_vals = cols[order], rows[order], w[order]
+        rng = np.random.default_rng(seed)
+        y = _spmm(rows, cols, w, rng.standard_normal((n_features, k)).astype(np.float32), n)
+        for _ in range(LOCAL_POWER_ITERS):
+            q, _ = np.linalg.qr(y)
+            z, _ = np.linalg.qr(_spmm(t_keys, t_cols, t_vals, q, n_features))
+            y = _spmm(rows, cols, w, z, n)
+        q, _ = np.linalg.qr(y)
+        # B = Qᵀ X (k x n_features); os vetores singulares à direita dão a projeção
+        _, _, vt = np.linalg.svd(_spmm(t_keys, t_cols, t_vals, q, n_features).T, full_matrices=False)
+        dim = min(int(dim), vt.shape[0])
+        projection = np.ascontiguousarray((idf[:, None] * vt[:dim].T).astype(np.float32))
+        digest = hashlib.sha256(projection.tobytes()).hexdigest()[:12]
+        meta = {'dim': dim, 'n_features': n_features, 'fit_docs': n, 'seed': seed,
+                'tokenizer': 'bm25_index.tokenize', 'created_at': datetime.utcnow().isoformat()}
+        return cls(f"{LOCAL_MODEL_PREFIX}tfidf-svd{dim}-{digest}", projection, meta)
+
+    def save(self, base_dir: Optional[Path] = None) -> Path:
+        mdir = self.model_dir(self.model, base_dir)
+        if (mdir / 'meta.json').exists():
+            return mdir
+        tmp = mdir.with_name(mdir.name + f'.tmp{os.getpid()}')
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir(parents=True)
+        np.save(str(tmp / 'projection.npy'), np.asarray(self.projection))
+        with open(tmp / 'meta.json', 'w', encoding='utf-8') as f:
+            json.dump({**self.meta, 'model': self.model}, f, ensure_ascii=False, indent=2)
+        try:
+            os.replace(tmp, mdir)
+        except OSError:
+            # outro processo gravou o mesmo modelo antes
+            shutil.rmtree(tmp, ignore_errors=True)
+        return mdir
+
+    def embed(self, texts: Sequence[str], timeout: Optional[float] = None) -> np.ndarray:
+        texts = list(texts)
+        ptr, cols, vals = _hash_rows(texts, self.n_features, self._memo)
+        rows = np.repeat(np.arange(len(texts), dtype=np.int64), np.diff(ptr))
+        out = _spmm(rows, cols, vals, self.projection, len(texts))
+        # texto sem nenhum token visto no ajuste fica com vetor nulo (sem direção)
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        return out / np.maximum(norms, 1e-12)
+
+    def describe(self) -> dict:
+        return {**super().describe(), 'dim': self.dim, 'n_features': self.n_features, 'key_slot': None}
+
+
+def fit_local_backend(texts: Sequence[str], **kwargs) -> LocalEmbeddingBackend:
+    """Ajusta, grava em LOCAL_MODEL_DIR e registra um modelo local; retorna o backend."""
+    t0 = time.time()
+    backend = LocalEmbeddingBackend.fit(texts, **kwargs)
+    mdir = backend.save()
+    register_backend(backend.model, backend)
+    print(f"✅ Modelo local ajustado: {backend.model} ({backend.meta['fit_docs']} textos, d={backend.dim}, "
+          f"{time.time() - t0:.1f}s) em {mdir}")
+    return backend
+
+
+def _build_backend(model: str) -> EmbeddingBackend:
+    if is_local_model(model):
+        return LocalEmbeddingBackend.load(model)
+    return GeminiEmbeddingBackend(model)
+
+
+_BACKENDS: Dict[str, Optional[EmbeddingBackend]] = {}
+_BACKENDS_LOCK = threading.Lock()
+
+
+def get_backend(model: Optional[str] = None, strict: bool = False) -> Optional[EmbeddingBackend]:
+    """Retorna o backend do `model`, resolvido na primeira chamada e reutilizado depois.
+
+    Uma falha de resolução (sem chave, SDK ausente) também fica registrada, para não
+    repetir a tentativa a cada consulta; retorna None nesse caso, ou levanta
+    EmbeddingError com `strict=True`.
+    """
+    model = model or DEFAULT_MODEL
+    with _BACKENDS_LOCK:
+        if model in _BACKENDS and not strict:
+            return _BACKENDS[model]
+        try:
+            backend = _BACKENDS.get(model) or _build_backend(model)
+        except EmbeddingError as e:
+            _BACKENDS[model] = None
+            if strict:
+                raise
+            print(f"⚠️ Backend de embeddings indisponível ({model}): {e}")
+            return None
+        if model not in _BACKENDS or _BACKENDS[model] is None:
+            info = backend.describe()
+            print(f"✅ Backend de embeddings: {info['backend']} ({model}, {info.get('key_slot')})")
+        _BACKENDS[model] = backend
+        return backend
+
+
+def register_backend(model: str, backend: EmbeddingBackend):
+    """Registra um backend já construído para `model` (backends locais, benchmarks)."""
+    with _BACKENDS_LOCK:
+        _BACKENDS[model] = backend
+
+
+def reset_backends():
+    """Esquece os backends resolvidos (p.ex. depois de trocar as chaves no .env)."""
+    with _BACKENDS_LOCK:
+        _BACKENDS.clear()
+
+
+# --- escalonador multi-chave -------------------------------------------------
+
+def is_rate_limited(exc: BaseException) -> bool:
+    """True se o erro (ou sua causa) é um 429 / cota esgotada."""
+    while exc is not None:
+        name = type(exc).__name__
+        text = str(exc)
+        if name in ('ResourceExhausted', 'TooManyRequests') or '429' in text or 'RESOURCE_EXHAUSTED' in text or 'quota' in text.lower():
+            return True
+        exc = exc.__cause__
+    return False
+
+
+class TokenBucket:
+    """Limitador por chave: `rate` requisições/s com rajada de até `burst`.
+
+    Um 429 esvazia o balde, bloqueia a chave por um backoff exponencial (com jitter) e
+    reduz a taxa à metade; cada sucesso devolve 10% da taxa máxima (AIMD), então a chave
+    volta ao ritmo configurado quando a cota se recupera.
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None, min_rate: Optional[float] = None):
+        self.max_rate = max(float(rate), 1e-3)
+        self.rate = self.max_rate
+        self.min_rate = min_rate or self.max_rate / 16
+        self.capacity = max(1.0, float(burst or rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.backoff = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        """Segundos até haver uma ficha disponível (0 = agora)."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = max(0.0, self.blocked_until - now)
+            if self.tokens < 1.0:
+                wait = max(wait, (1.0 - self.tokens) / self.rate)
+            return wait
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.blocked_until or self.tokens < 1.0:
+                return False
+            self.tokens -= 1.0
+            return True
+
+    def on_success(self):
+        with self._lock:
+            self.backoff = 0.0
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.1)
+
+    def on_rate_limited(self):
+        with self._lock:
+            now = time.monotonic()
+            self.backoff = min(BACKOFF_MAX, self.backoff * 2 if self.backoff else BACKOFF_INITIAL)
+            self.blocked_until = now + self.backoff * (1.0 + random.random() * 0.25)
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0.0
+            self.updated = now
+
+
+class _KeyState:
+    def __init__(self, slot: str, backend: EmbeddingBackend, bucket: TokenBucket):
+        self.slot = slot
+        self.backend = backend
+        self.bucket = bucket
+        self.stats = {'requests': 0, 'texts': 0, 'rate_limited': 0, 'errors': 0}
+
+
+class EmbeddingScheduler:
+    """Distribui lotes de embedding entre todas as chaves de `gemini_client.KEY_SLOTS`.
+
+    Cada chave tem seu próprio backend (cliente Gemini) e `TokenBucket`; cada lote vai para
+    a chave com ficha disponível mais cedo. Até `max_in_flight` lotes ficam em andamento ao
+    mesmo tempo, então a vazão soma as cotas de todas as chaves. Um 429 só afasta a chave
+    que o recebeu; o lote é reenviado por outra.
+
+    Com `cache` (`embedding_cache.ContentEmbeddingCache`), textos já embedados com o mesmo
+    modelo não vão para a API (nem gastam ficha das chaves).
+    """
+
+    def __init__(self, model: str, slots: Optional[Sequence[str]] = None, rate_per_key: float = EMBED_RATE_PER_KEY,
+                 burst_per_key: float = EMBED_BURST_PER_KEY, max_in_flight: int = EMBED_MAX_IN_FLIGHT,
+                 max_retries: int = EMBED_MAX_RETRIES, timeout: float = DEFAULT_TIMEOUT,
+                 backends: Optional[Sequence[Tuple[str, EmbeddingBackend]]] = None, cache=None):
+        self.model = model
+        self.cache = cache
+        self.timeout = timeout
+        self.max_retries = max(0, int(max_retries))
+        if backends is None:
+            import gemini_client
+            wanted = set(slots) if slots else None
+            backends = []
+            for slot, _ in gemini_client.available_keys():
+                if wanted is not None and slot not in wanted:
+                    continue
+                try:
+                    backends.append((slot, GeminiEmbeddingBackend(model, key_slot=slot, timeout=timeout)))
+                except EmbeddingError as e:
+                    print(f"⚠️ Chave {slot} ignorada pelo escalonador: {e}")
+        if not backends:
+            raise EmbeddingError("Nenhuma chave disponível para o escalonador de embeddings")
+        self.keys: List[_KeyState] = [_KeyState(slot, backend, TokenBucket(rate_per_key, burst_per_key)) for slot, backend in backends]
+        self.max_in_flight = int(max_in_flight) if max_in_flight and max_in_flight > 0 else 2 * len(self.keys)
+        self._lock = threading.Lock()
+        print(f"✅ Escalonador de embeddings: {len(self.keys)} chave(s) ({', '.join(k.slot for k in self.keys)}), "
+              f"{rate_per_key:g} req/s por chave, {self.max_in_flight} lotes em andamento")
+
+    def _acquire(self) -> _KeyState:
+        """Bloqueia até alguma chave ter ficha; retorna a chave escolhida."""
+        while True:
+            waits = [(k.bucket.wait_time(), i) for i, k in enumerate(self.keys)]
+            wait, i = min(waits)
+            if wait <= 0 and self.keys[i].bucket.try_acquire():
+                return self.keys[i]
+            time.sleep(min(max(wait, 0.005), 0.5))
+
+    def embed_batch(self, texts: Sequence[str]) -> np.ndarray:
+        """Embeddings de um lote (até EMBED_BATCH_LIMIT textos), com reenvio em 429/erros."""
+        if self.cache is not None:
+            return self.cache.embed(self.model, texts, self._embed_api)
+        return self._embed_api(texts)
+
+    def _embed_api(self, texts: Sequence[str]) -> np.ndarray:
+        errors = 0
+        rate_limited = 0
+        while True:
+            state = self._acquire()
+            try:
+                emb = state.backend.embed(texts, timeout=self.timeout)
+            except EmbeddingError as e:
+                with self._lock:
+                    if is_rate_limited(e):
+                        state.stats['rate_limited'] += 1
+                    else:
+                        state.stats['errors'] += 1
+                if is_rate_limited(e):
+                    state.bucket.on_rate_limited()
+                    rate_limited += 1
+                    if rate_limited >= MAX_RATE_LIMITED_ATTEMPTS:
+                        raise
+                    continue
+                errors += 1
+                if errors > self.max_retries:
+                    raise
+                time.sleep(min(BACKOFF_MAX, BACKOFF_INITIAL * 2 ** (errors - 1)) * random.random())
+                continue
+            state.bucket.on_success()
+            with self._lock:
+                state.stats['requests'] += 1
+                state.stats['texts'] += len(texts)
+            return emb
+
+    def map(self, batches: Iterable[Sequence[str]]) -> Iterator[Tuple[Sequence[str], Optional[np.ndarray], Optional[BaseException]]]:
+        """Gera (lote, embeddings, erro) na mesma ordem dos lotes de entrada.
+
+        Os lotes são consumidos sob demanda: no máximo `2 * max_in_flight` ficam entre
+        enviados e ainda não entregues.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix='embed-sched') as executor:
+            pending = deque()
+            for batch in batches:
+                pending.append((batch, executor.submit(self.embed_batch, batch)))
+                while len(pending) >= 2 * self.max_in_flight:
+                    yield self._result(pending.popleft())
+            while pending:
+                yield self._result(pending.popleft())
+
+    @staticmethod
+    def _result(item):
+        batch, future = item
+        try:
+            return batch, future.result(), None
+        except Exception as e:
+            return batch, None, e
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """Embeddings de `texts` (lotes de EMBED_BATCH_LIMIT em paralelo); EmbeddingError se algum lote falhar."""
+        texts = list(texts)
+        batches = [texts[i:i + EMBED_BATCH_LIMIT] for i in range(0, len(texts), EMBED_BATCH_LIMIT)]
+        parts = []
+        for _, emb, error in self.map(batches):
+            if error is not None:
+                raise error if isinstance(error, EmbeddingError) else EmbeddingError(str(error))
+            parts.append(emb)
+        if not parts:
+            return np.empty((0, 0), dtype=np.float32)
+        return parts[0] if len(parts) == 1 else np.vstack(parts)
+
+    def stats(self) -> Dict[str, dict]:
+        with self._lock:
+            return {k.slot: {**k.stats, 'rate': round(k.bucket.rate, 3)} for k in self.keys}
@@ -0,0 +1,379 @@
+"""Cache de embeddings de queries do RAG.
+
+As queries montadas pelas Fases 1–3 (p.ex. "{tema} {especialidade} diretrizes protocolo
+tratamento") se repetem entre usuários e lotes; cada repetição custava uma chamada à API
+de embeddings. O cache é chaveado por (modelo de embedding, texto normalizado) e tem
+duas camadas:
+- LRU em memória (por processo);
+- SQLite em `memoria/vectors/query_embedding_cache.sqlite`, compartilhado entre
+  workers e reinícios, com os vetores guardados como BLOB float32.
+
+As duas camadas têm tamanho máximo; no disco são removidas as entradas usadas há mais
+tempo. A contagem de linhas do SQLite é mantida em memória (recontada só quando passa do
+limite ou a cada `DISK_RECOUNT_EVERY` escritas, por causa dos outros workers) e os
+`last_used` dos acertos em disco são gravados em lote, não um commit por leitura.
+Os contadores de acerto/erro ficam em `stats()`.
+
+`ContentEmbeddingCache` é o cache dos textos indexados (chunks), compartilhado entre a
+ingestão e o `scripts/reindex_vectors.py`: chaveado por (modelo, sha256 do texto exato),
+com até `EMBEDDING_CACHE_MAX_ITEMS` vetores (remove os usados há mais tempo). Mudar o
+chunking ou refazer uma ingestão interrompida só paga pelos textos realmente novos.
+Queries não entram nele: ficam só no `QueryEmbeddingCache`, que é limitado por conta própria.
+"""
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+
+# Ao exceder o limite do disco, remove esta fração extra para não podar a cada escrita
+DISK_PRUNE_FRACTION = 0.1
+# Escritas entre recontagens da tabela (outros workers também inserem no mesmo arquivo)
+DISK_RECOUNT_EVERY = 256
+# `last_used` pendentes: grava ao juntar este número de acertos ou após estes segundos
+TOUCH_BATCH = 64
+TOUCH_FLUSH_SECONDS = 30.0
+# Cache de embeddings por conteúdo; EMBEDDING_CACHE_PATH vazio desativa
+CONTENT_CACHE_PATH = os.getenv('EMBEDDING_CACHE_PATH', str(Path(__file__).parent / 'memoria' / 'vectors' / 'embedding_cache.sqlite'))
+# Máximo de vetores no cache por conteúdo (~3 KB cada com 768 dimensões); 0 = sem limite
+CONTENT_CACHE_MAX_ITEMS = int(os.getenv('EMBEDDING_CACHE_MAX_ITEMS', '1000000'))
+# Parâmetros por consulta `IN (...)` (limite do SQLite é 999 nas versões antigas)
+LOOKUP_CHUNK = 500
+
+
+def normalize_query_text(text: str) -> str:
+    """Normaliza a query para a chave do cache (caixa e espaços)."""
+    return re.sub(r"\s+", " ", (text or "")).strip().casefold()
+
+
+class QueryEmbeddingCache:
+    """LRU em memória com persistência em SQLite para embeddings de queries."""
+
+    def __init__(self, db_path: Optional[Path], max_memory_items: int = 2048, max_disk_items: int = 50_000):
+        self.db_path = Path(db_path) if db_path else None
+        self.max_memory_items = max(0, int(max_memory_items))
+        self.max_disk_items = max(0, int(max_disk_items))
+        self._lru: "OrderedDict[tuple, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._disk_count = 0
+        self._puts_since_count = 0
+        self._touched: Dict[tuple, float] = {}
+        self._touched_since = 0.0
+        self._stats = {'hits': 0, 'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'disk_evictions': 0, 'disk_errors': 0}
+
+    # --- SQLite -----------------------------------------------------------
+    def _db(self):
+        if self._conn is None and self.db_path is not None and self.max_disk_items > 0:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.db_path), check_same_thread=False, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings ("
+                " model TEXT NOT NULL, query TEXT NOT NULL, vector BLOB NOT NULL,"
+                " last_used REAL NOT NULL, PRIMARY KEY (model, query))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_query_embeddings_last_used ON query_embeddings(last_used)")
+            conn.commit()
+            self._disk_count = conn.execute("SELECT COUNT(*) FROM query_embeddings").fetchone()[0]
+            self._conn = conn
+        return self._conn
+
+    def _flush_touched(self, conn, commit: bool = True):
+        """Grava os `last_used` acumulados pelos acertos em disco."""
+        if not self._touched:
+            return
+        conn.executemany(
+            "UPDATE query_embeddings SET last_used = ? WHERE model = ? AND query = ?",
+            [(ts, *key) for key, ts in self._touched.items()],
+        )
+        self._touched.clear()
+        if commit:
+            conn.commit()
+
+    def _prune(self, conn):
+        """Reconta a tabela e remove as entradas usadas há mais tempo se passou do limite."""
+        count = conn.execute("SELECT COUNT(*) FROM query_embeddings").fetchone()[0]
+        if count > self.max_disk_items:
+            excess = count - self.max_disk_items + int(self.max_disk_items * DISK_PRUNE_FRACTION)
+            conn.execute(
+                "DELETE FROM query_embeddings WHERE rowid IN ("
+                " SELECT rowid FROM query_embeddings ORDER BY last_used ASC LIMIT ?)",
+                (excess,),
+            )
+            self._stats['disk_evictions'] += excess
+            count -= excess
+        self._disk_count = count
+        self._puts_since_count = 0
+
+    def _disk_get(self, key: tuple) -> Optional[np.ndarray]:
+        try:
+            conn = self._db()
+            if conn is None:
+                return None
+            row = conn.execute("SELECT vector FROM query_embeddings WHERE model = ? AND query = ?", key).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if not self._touched:
+                self._touched_since = now
+            self._touched[key] = now
+            if len(self._touched) >= TOUCH_BATCH or now - self._touched_since >= TOUCH_FLUSH_SECONDS:
+                self._flush_touched(conn)
+            return np.frombuffer(row[0], dtype=np.float32).copy()
+        except sqlite3.Error:
+            self._stats['disk_errors'] += 1
+            return None
+
+    def _disk_put(self, key: tuple, vec: np.ndarray):
+        try:
+            conn = self._db()
+            if conn is None:
+                return
+            conn.execute(
+                "INSERT OR REPLACE INTO query_embeddings (model, query, vector, last_used) VALUES (?, ?, ?, ?)",
+                (*key, np.asarray(vec, dtype=np.float32).tobytes(), time.time()),
+            )
+            # A contagem local só cresce (REPLACE de chave existente conta como nova);
+            # passa do limite ou envelhece -> reconta de verdade antes de podar
+            self._disk_count += 1
+            self._puts_since_count += 1
+            self._flush_touched(conn, commit=False)
+            if self._disk_count > self.max_disk_items or self._puts_since_count >= DISK_RECOUNT_EVERY:
+                self._prune(conn)
+            conn.commit()
+        except sqlite3.Error:
+            self._stats['disk_errors'] += 1
+
+    # --- LRU em memória ---------------------------------------------------
+    def _memory_put(self, key: tuple, vec: np.ndarray):
+        if self.max_memory_items == 0:
+            return
+        self._lru[key] = vec
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_memory_items:
+            self._lru.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    # --- API pública ------------------------------------------------------
+    def get(self, model: str, text: str) -> Optional[np.ndarray]:
+        key = (model or '', normalize_query_text(text))
+        with self._lock:
+            vec = self._lru.get(key)
+            if vec is not None:
+                self._lru.move_to_end(key)
+                self._stats['hits'] += 1
+                self._stats['memory_hits'] += 1
+                return vec
+            vec = self._disk_get(key)
+            if vec is not None:
+                self._memory_put(key, vec)
+                self._stats['hits'] += 1
+                self._stats['disk_hits'] += 1
+                return vec
+            self._stats['misses'] += 1
+            return None
+
+    def put(self, model: str, text: str, vec: np.ndarray):
+        if vec is None:
+            return
+        key = (model or '', normalize_query_text(text))
+        vec = np.asarray(vec, dtype=np.float32).reshape(-1)
+        with self._lock:
+            self._memory_put(key, vec)
+            self._disk_put(key, vec)
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        return [self.get(model, t) for t in texts]
+
+    def clear_memory(self):
+        with self._lock:
+            self._lru.clear()
+
+    def flush(self):
+        """Grava os `last_used` pendentes (chamado no desligamento do servidor)."""
+        with self._lock:
+            if self._conn is None:
+                return
+            try:
+                self._flush_touched(self._conn)
+            except sqlite3.Error:
+                self._stats['disk_errors'] += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            out = dict(self._stats)
+            out['memory_items'] = len(self._lru)
+            out['disk_items'] = self._disk_count
+            out['hit_rate'] = round(self._stats['hits'] / lookups, 4) if lookups else 0.0
+            return out
+
+
+def text_digest(text: str) -> bytes:
+    return hashlib.sha256((text or '').encode('utf-8')).digest()
+
+
+class ContentEmbeddingCache:
+    """Vetores float32 por (modelo, sha256 do texto), num SQLite compartilhado entre processos.
+
+    Cada vetor é um BLOB numa tabela `WITHOUT ROWID` com chave primária (modelo, digest):
+    o índice é o próprio B-tree da chave, e o nome do modelo fica numa tabela à parte.
+    Acima de `max_items` vetores remove os de `last_used` mais antigo (a contagem é mantida
+    em memória e recontada só ao passar do limite, como no `QueryEmbeddingCache`).
+    """
+
+    def __init__(self, db_path: Path, max_items: int = CONTENT_CACHE_MAX_ITEMS):
+        self.db_path = Path(db_path)
+        self.max_items = max(0, int(max_items))
+        self._lock = threading.Lock()
+        self._conn = None
+        self._count = 0
+        self._model_ids: Dict[str, int] = {}
+        self._stats = {'hits': 0, 'misses': 0, 'stored': 0, 'evictions': 0, 'errors': 0}
+
+    def _db(self):
+        if self._conn is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.db_path), check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS models (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS content_embeddings ("
+                " model_id INTEGER NOT NULL, digest BLOB NOT NULL, vector BLOB NOT NULL,"
+                " last_used REAL NOT NULL DEFAULT 0,"
+                " PRIMARY KEY (model_id, digest)) WITHOUT ROWID"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(content_embeddings)")}
+            if 'last_used' not in columns:
+                # Caches criados antes do limite de tamanho: entradas antigas saem primeiro
+                conn.execute("ALTER TABLE content_embeddings ADD COLUMN last_used REAL NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_content_embeddings_last_used ON content_embeddings(last_used)")
+            conn.commit()
+            self._count = conn.execute("SELECT COUNT(*) FROM content_embeddings").fetchone()[0]
+            self._conn = conn
+        return self._conn
+
+    def _model_id(self, conn, model: str) -> int:
+        model = model or ''
+        if model not in self._model_ids:
+            conn.execute("INSERT OR IGNORE INTO models (name) VALUES (?)", (model,))
+            self._model_ids[model] = conn.execute("SELECT id FROM models WHERE name = ?", (model,)).fetchone()[0]
+        return self._model_ids[model]
+
+    def _prune(self, conn):
+        """Reconta a tabela e remove os vetores usados há mais tempo se passou do limite."""
+        count = conn.execute("SELECT COUNT(*) FROM content_embeddings").fetchone()[0]
+        if count > self.max_items:
+            excess = count - self.max_items + int(self.max_items * DISK_PRUNE_FRACTION)
+            conn.execute(
+                "DELETE FROM content_embeddings WHERE (model_id, digest) IN ("
+                " SELECT model_id, digest FROM content_embeddings ORDER BY last_used ASC LIMIT ?)",
+                (excess,),
+            )
+            self._stats['evictions'] += excess
+            count -= excess
+        self._count = count
+
+    def get_many(self, model: str, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """Vetor de cada texto (None onde não há)."""
+        digests = [text_digest(t) for t in texts]
+        found: Dict[bytes, np.ndarray] = {}
+        with self._lock:
+            try:
+                conn = self._db()
+                model_id = self._model_id(conn, model)
+                unique = list(dict.fromkeys(digests))
+                for start in range(0, len(unique), LOOKUP_CHUNK):
+                    chunk = unique[start:start + LOOKUP_CHUNK]
+                    rows = conn.execute(
+                        f"SELECT digest, vector FROM content_embeddings WHERE model_id = ? AND digest IN ({','.join('?' * len(chunk))})",
+                        (model_id, *chunk),
+                    ).fetchall()
+                    for digest, blob in rows:
+                        found[bytes(digest)] = np.frombuffer(blob, dtype=np.float32).copy()
+                if found and self.max_items:
+                    now = time.time()
+                    conn.executemany(
+                        "UPDATE content_embeddings SET last_used = ? WHERE model_id = ? AND digest = ?",
+                        [(now, model_id, digest) for digest in found],
+                    )
+                    conn.commit()
+            except sqlite3.Error:
+                self._stats['errors'] += 1
+            out = [found.get(d) for d in digests]
+            hits = sum(1 for v in out if v is not None)
+            self._stats['hits'] += hits
+            self._stats['misses'] += len(out) - hits
+        return out
+
+    def put_many(self, model: str, texts: Sequence[str], vectors: np.ndarray):
+        rows = [(text_digest(t), np.asarray(v, dtype=np.float32).reshape(-1).tobytes()) for t, v in zip(texts, vectors)]
+        if not rows:
+            return
+        with self._lock:
+            try:
+                conn = self._db()
+                model_id = self._model_id(conn, model)
+                now = time.time()
+                conn.executemany(
+                    "INSERT OR REPLACE INTO content_embeddings (model_id, digest, vector, last_used) VALUES (?, ?, ?, ?)",
+                    [(model_id, digest, blob, now) for digest, blob in rows],
+                )
+                self._count += len(rows)
+                if self.max_items and self._count > self.max_items:
+                    self._prune(conn)
+                conn.commit()
+                self._stats['stored'] += len(rows)
+            except sqlite3.Error:
+                self._stats['errors'] += 1
+
+    def embed(self, model: str, texts: Sequence[str], embed_fn: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        """Embeddings de `texts`: os que já estão no cache (ou repetidos no lote) não vão para `embed_fn`."""
+        texts = list(texts)
+        vectors = self.get_many(model, texts)
+        missing = list(dict.fromkeys(t for t, v in zip(texts, vectors) if v is None))
+        if missing:
+            new = np.asarray(embed_fn(missing), dtype=np.float32)
+            self.put_many(model, missing, new)
+            fresh = dict(zip(missing, new))
+            vectors = [fresh[t] if v is None else v for t, v in zip(texts, vectors)]
+        if not vectors:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.vstack(vectors)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            out = dict(self._stats)
+            out['items'] = self._count
+            out['hit_rate'] = round(self._stats['hits'] / lookups, 4) if lookups else 0.0
+            return out
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+_content_cache: Optional[ContentEmbeddingCache] = None
+_content_cache_lock = threading.Lock()
+
+
+def content_cache() -> Optional[ContentEmbeddingCache]:
+    """Cache por conteúdo do processo (em `CONTENT_CACHE_PATH`), ou None se desativado."""
+    global _content_cache
+    if not CONTENT_CACHE_PATH:
+        return None
+    with _content_cache_lock:
+        if _content_cache is None:
+            _content_cache = ContentEmbeddingCache(Path(CONTENT_CACHE_PATH))
+        return _content_cache
@@ -11,6 +11,30 @@ KEY_SLOTS = ['GOOGLE_API_KEY_5', 'GOOGLE_API_KEY_4', 'GOOGLE_API_KEY_3', 'GOOGLE
 def _is_api_key(val: str) -> bool:
     return isinstance(val, str) and val.startswith('AIza')
 
+def available_keys():
+    """Lista (slot, chave) de todas as chaves configuradas em KEY_SLOTS, sem repetir chaves.
+
+    API keys ('AIza...') vêm primeiro, mantendo a ordem de KEY_SLOTS em cada grupo.
+    """
+    found = []
+    seen = set()
+    for slot in KEY_SLOTS:
+        raw = os.getenv(slot)
+        key = raw.strip() if isinstance(raw, str) else None
+        if key and key not in seen:
+            seen.add(key)
+            found.append((slot, key))
+    return [f for f in found if _is_api_key(f[1])] + [f for f in found if not _is_api_key(f[1])]
+
+def first_available_key():
+    """Retorna (slot, chave) da primeira chave disponível em KEY_SLOTS, sem configurar o genai.
+
+    Mesma ordem de `configure_first_available`: API keys ('AIza...') primeiro.
+    Retorna (None, None) se não houver nenhuma.
+    """
+    found = available_keys()
+    return found[0] if found else (None, None)
+
 def configure_first_available():
     """Configura genai com a primeira chave disponível na ordem KEY_SLOTS.
     Retorna a chave usada ou None.
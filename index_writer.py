@@ -0,0 +1,450 @@
+"""Escrita incremental de um índice RAG completo (usada pela ingestão em streaming).
+
+Os lotes (ids, textos, metadados, vetores) são gravados à medida que chegam, sem manter
+o corpus em memória:
+- vetores normalizados em segmentos `seg_NNNNN.npy` de até `segment_rows` linhas;
+- `metadata.jsonl` e o chunk store (`chunk_store.ChunkStoreWriter`) em streaming.
+
+Tudo vai para `<out_dir>/.staging`. `finalize()` concatena os segmentos em
+`embeddings.npy` (via memmap), monta os índices auxiliares (IVF, compacto, BM25,
+partições) a partir dos arquivos já gravados e publica o resultado em `out_dir` com
+`os.replace`, deixando o `config.json` por último: o `rag_agent` só enxerga o índice novo
+quando ele está completo, e um lote com erro (`abort()`) não toca no índice anterior.
+
+A troca com o servidor no ar só funciona em POSIX, onde quem mapeou os arquivos antigos
+continua lendo-os. No Windows um arquivo aberto por outro processo não pode ser
+substituído nem apagado: antes de publicar, `_check_unlocked` confere todos os arquivos
+e falha sem alterar nada; pare o servidor e rode de novo.
+
+`IndexWriter.append()` grava só os dados novos num segmento (`segment_index`) registrado
+no `segments.json` ao final; `compact_segments()` junta segmentos pequenos (ou tudo na base).
+"""
+
+import json
+import os
+import shutil
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, List, Optional, Sequence, Set
+
+import numpy as np
+
+import vector_store
+import ann_index
+import bm25_index
+import partition_index
+import chunk_store
+import segment_index
+
+STAGING_DIR = '.staging'
+# Linhas por segmento de vetores (~48 MB em float32 com d=768)
+SEGMENT_ROWS = 16384
+PREVIEW_CHARS = 500
+
+
+def text_preview(text: str) -> str:
+    return text[:PREVIEW_CHARS].replace('\n', ' ') + ("..." if len(text) > PREVIEW_CHARS else '')
+
+
+class IndexWriter:
+    """Acumula lotes em segmentos no disco e publica o índice completo em `finalize()`."""
+
+    def __init__(self, out_dir: Path, model: str, segment_rows: int = SEGMENT_ROWS, segment_of: Optional[Path] = None):
+        self.out_dir = Path(out_dir)
+        self.model = model
+        self.segment_rows = max(1, int(segment_rows))
+        # índice (base) ao qual este diretório pertence como segmento; None = grava a base
+        self.segment_of = Path(segment_of) if segment_of is not None else None
+        self.register = False
+        self.drop_ids: Set[str] = set()
+        self.staging = self.out_dir / STAGING_DIR
+        shutil.rmtree(self.staging, ignore_errors=True)
+        self.staging.mkdir(parents=True)
+        self.rows = 0
+        self.dim: Optional[int] = None
+        self._segments: List[Path] = []
+        self._pending: List[np.ndarray] = []
+        self._pending_rows = 0
+        self._meta_f = open(self.staging / 'metadata.jsonl', 'w', encoding='utf-8')
+        self._chunks = chunk_store.ChunkStoreWriter(self.staging)
+
+    @classmethod
+    def append(cls, vdir: Path, model: str, drop_ids: Optional[Iterable[str]] = None, segment_rows: int = SEGMENT_ROWS) -> 'IndexWriter':
+        """Escritor de um segmento novo de `vdir`: grava só os dados novos.
+
+        `finalize()` publica o segmento, marca como removidas as linhas com id em
+        `drop_ids` nas partes já existentes e registra o segmento no `segments.json`.
+        """
+        writer = cls(segment_index.new_segment_dir(vdir), model, segment_rows, segment_of=vdir)
+        writer.register = True
+        writer.drop_ids = set(drop_ids or ())
+        return writer
+
+    def add(self, ids: Sequence[str], texts: Sequence[str], metas: Sequence[Optional[dict]], embeddings: np.ndarray):
+        """Anexa um lote; `embeddings` tem uma linha por id (normalizada aqui)."""
+        embeddings = vector_store.normalize_rows(embeddings)
+        if embeddings.shape[0] != len(ids):
+            raise ValueError(f"lote com {len(ids)} ids e {embeddings.shape[0]} vetores")
+        if self.dim is None:
+            self.dim = int(embeddings.shape[1])
+        elif embeddings.shape[1] != self.dim:
+            raise ValueError(f"dimensão {embeddings.shape[1]} diferente do índice em construção ({self.dim})")
+        now = datetime.utcnow().isoformat()
+        for doc_id, text, meta in zip(ids, texts, metas):
+            record = {'id': doc_id, 'meta': meta or {}, 'text_preview': text_preview(text or ''), 'indexed_at': now}
+            self._meta_f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            self._chunks.add(text or '')
+        self._pending.append(embeddings)
+        self._pending_rows += embeddings.shape[0]
+        self.rows += embeddings.shape[0]
+        if self._pending_rows >= self.segment_rows:
+            self._flush_segment()
+
+    def add_existing(self, vdir: Path, config: Optional[dict], drop_ids: Optional[Set[str]] = None) -> int:
+        """Copia as linhas de um índice já publicado (modo sem `--rebuild`); retorna quantas.
+
+        Linhas com id em `drop_ids` (fontes alteradas/removidas) e linhas já marcadas em
+        `tombstones.npy` ficam de fora: a regravação também compacta o índice.
+        """
+        vdir = Path(vdir)
+        embeddings = vector_store.load_embeddings(vdir, config)
+        records = chunk_store.JsonlRecords.load(vdir)
+        if records is None or len(records) != embeddings.shape[0]:
+            raise ValueError("metadata.jsonl e embeddings.npy do índice atual têm tamanhos diferentes")
+        chunks = chunk_store.ChunkStore.load(vdir)
+        deleted = np.zeros(embeddings.shape[0], dtype=bool)
+        tombstones = vector_store.load_tombstones(vdir)
+        if tombstones is not None:
+            deleted[tombstones[tombstones < deleted.shape[0]]] = True
+        drop_ids = drop_ids or set()
+        kept = 0
+        try:
+            rows, batch = [], []
+            for row, record in enumerate(records):
+                if deleted[row] or record.get('id') in drop_ids:
+                    continue
+                text = chunks.get(row) if chunks is not None else None
+                rows.append(row)
+                batch.append((record.get('id'), text if text is not None else record.get('text_preview', ''), record.get('meta')))
+                if len(batch) == self.segment_rows:
+                    kept += self._add_rows(embeddings, rows, batch)
+                    rows, batch = [], []
+            if batch:
+                kept += self._add_rows(embeddings, rows, batch)
+        finally:
+            records.close()
+            if chunks is not None:
+                chunks.close()
+        return kept
+
+    def _add_rows(self, embeddings: np.ndarray, rows: List[int], batch: list) -> int:
+        ids, texts, metas = zip(*batch)
+        self.add(ids, texts, metas, np.asarray(embeddings[np.asarray(rows)], dtype=np.float32))
+        return len(rows)
+
+    def _flush_segment(self):
+        if not self._pending:
+            return
+        path = self.staging / f"seg_{len(self._segments):05d}.npy"
+        with open(path, 'wb') as f:
+            np.save(f, np.vstack(self._pending))
+        self._segments.append(path)
+        self._pending = []
+        self._pending_rows = 0
+
+    def _write_embeddings(self) -> Path:
+        """Concatena os segmentos em `embeddings.npy` sem carregar todos na memória."""
+        target = self.staging / vector_store.EMBEDDINGS_FILE
+        out = np.lib.format.open_memmap(target, mode='w+', dtype=np.float32, shape=(self.rows, self.dim))
+        start = 0
+        for seg in self._segments:
+            arr = np.load(str(seg), mmap_mode='r')
+            out[start:start + arr.shape[0]] = arr
+            start += arr.shape[0]
+            del arr
+            seg.unlink()
+        out.flush()
+        del out
+        return target
+
+    def _write_id_map(self):
+        # id_map.json escrito em streaming a partir do metadata.jsonl
+        records = chunk_store.JsonlRecords.load(self.staging)
+        with open(self.staging / 'id_map.json', 'w', encoding='utf-8') as f:
+            f.write('{')
+            for row, record in enumerate(records):
+                f.write((', ' if row else '') + json.dumps(str(row)) + ': ' + json.dumps(record.get('id'), ensure_ascii=False))
+            f.write('}')
+        records.close()
+
+    def finalize(self, ann: str = 'auto', ann_lists: Optional[int] = None, quantize: str = 'none', extra_config: Optional[dict] = None) -> Optional[dict]:
+        """Monta os índices auxiliares e publica tudo em `out_dir`; retorna o config.json gravado."""
+        self._flush_segment()
+        self._meta_f.close()
+        self._chunks.close()
+        if self.rows == 0:
+            shutil.rmtree(self.staging, ignore_errors=True)
+            if self.segment_of is not None:
+                shutil.rmtree(self.out_dir, ignore_errors=True)
+            return None
+
+        self._write_embeddings()
+        chunk_store.write_metadata_offsets(self.staging)
+        self._write_id_map()
+
+        saved = vector_store.load_embeddings(self.staging, {'vector_format': vector_store.VECTOR_FORMAT})
+        ann_cfg = ann_index.build_for(self.staging, saved, mode=ann, n_lists=ann_lists)
+        quant_cfg = vector_store.save_quantized(self.staging, saved, quantize)
+        del saved
+        # índices lexical e de partições lidos de volta do disco, linha a linha
+        store = chunk_store.ChunkStore.load(self.staging)
+        try:
+            bm25_cfg = bm25_index.build_for(self.staging, (store.get(row) for row in range(len(store))))
+        finally:
+            store.close()
+        records = chunk_store.JsonlRecords.load(self.staging)
+        partitions_cfg = partition_index.build_for(self.staging, records)
+        records.close()
+
+        config = {
+            'model': self.model,
+            'indexed_at': datetime.utcnow().isoformat(),
+            'items_count': self.rows,
+            'embeddings_file': vector_store.EMBEDDINGS_FILE,
+            'vector_format': vector_store.VECTOR_FORMAT,
+            'quantization': quant_cfg,
+            'ann': ann_cfg,
+            'bm25': bm25_cfg,
+            'partitions': partitions_cfg,
+            'chunk_store': {'rows': self.rows, 'compression': 'zlib', 'block_size': chunk_store.BLOCK_SIZE},
+            **(extra_config or {}),
+        }
+        with open(self.staging / 'config.json', 'w', encoding='utf-8') as f:
+            json.dump(config, f, ensure_ascii=False)
+        self._publish(config)
+        return config
+
+    def _publish(self, config: dict):
+        if self.segment_of is not None:
+            self._replace_files(config)
+            if self.register:
+                with segment_index.locked(self.segment_of):
+                    if self.drop_ids:
+                        _tombstone_ids(self.segment_of, self.drop_ids)
+                    segment_index.register_segment(self.segment_of, self.out_dir, config)
+            return
+        # a base regravada contém tudo: os segmentos anteriores saem do segments.json
+        with segment_index.locked(self.out_dir):
+            self._replace_files(config)
+            segment_index.clear(self.out_dir)
+
+    def _replace_files(self, config: dict):
+        _check_unlocked(self.out_dir, [p.name for p in self.staging.iterdir()] + _INDEX_FILES)
+        # arquivos opcionais que não fazem parte do índice novo saem do diretório publicado
+        if not config.get('ann'):
+            ann_index.remove(self.out_dir)
+        if not config.get('quantization'):
+            vector_store.remove_quantized(self.out_dir)
+        if not config.get('bm25'):
+            bm25_index.remove(self.out_dir)
+        if not config.get('partitions'):
+            partition_index.remove(self.out_dir)
+        # o índice regravado não contém linhas removidas
+        vector_store.remove_tombstones(self.out_dir)
+        names = sorted(p.name for p in self.staging.iterdir() if p.name != 'config.json')
+        for name in names + ['config.json']:
+            os.replace(self.staging / name, self.out_dir / name)
+        shutil.rmtree(self.staging, ignore_errors=True)
+
+    def abort(self):
+        """Descarta o que foi gravado; o índice publicado não é alterado."""
+        if not self._meta_f.closed:
+            self._meta_f.close()
+            self._chunks.close()
+        shutil.rmtree(self.staging, ignore_errors=True)
+        if self.segment_of is not None:
+            shutil.rmtree(self.out_dir, ignore_errors=True)
+
+
+# Windows: arquivos abertos (memmap) por outro processo não podem ser substituídos
+_LOCKING_FS = os.name == 'nt'
+# arquivos que a publicação pode substituir ou apagar (além dos gravados no .staging)
+_INDEX_FILES = [vector_store.EMBEDDINGS_FILE, vector_store.QUANT_FILE, vector_store.QUANT_SCALE_FILE,
+                vector_store.TOMBSTONES_FILE, ann_index.CENTROIDS_FILE, ann_index.LISTS_FILE, ann_index.OFFSETS_FILE,
+                bm25_index.META_FILE, *bm25_index.ARRAY_FILES.values(), partition_index.META_FILE, partition_index.ROWS_FILE]
+
+
+def _check_unlocked(out_dir: Path, names: Iterable[str]):
+    """No Windows, PermissionError se algum arquivo do índice publicado estiver aberto por
+    outro processo (memmap do servidor), antes de substituir qualquer um deles.
+
+    Cada arquivo é renomeado para o lado e de volta: é o que falha quando ele está aberto.
+    """
+    if not _LOCKING_FS:
+        return
+    for name in sorted(set(names)):
+        path = Path(out_dir) / name
+        if not path.exists():
+            continue
+        probe = path.with_name(name + '.probe')
+        try:
+            os.replace(path, probe)
+        except PermissionError as e:
+            raise PermissionError(f"{path} está aberto por outro processo (servidor RAG no ar?); "
+                                  "no Windows o índice só pode ser publicado com o servidor parado") from e
+        os.replace(probe, path)
+
+
+def read_ids(out_dir: Path) -> List[str]:
+    """Ids do `id_map.json` na ordem das linhas.
+
+    Aceita o formato `{"0": id, ...}` (ingestão) e o `{"ids": [...]}` gravado pelo
+    `scripts/reindex_vectors.py`.
+    """
+    path = Path(out_dir) / 'id_map.json'
+    if not path.exists():
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        id_map = json.load(f)
+    if isinstance(id_map, list):
+        return id_map
+    if isinstance(id_map.get('ids'), list):
+        return id_map['ids']
+    return [doc_id for _, doc_id in sorted(id_map.items(), key=lambda item: int(item[0]))]
+
+
+def tombstone_ids(out_dir: Path, ids: Iterable[str]) -> int:
+    """Marca como removidas as linhas com esses ids (base e segmentos), sem regravar nada.
+
+    Cada parte ganha seu `tombstones.npy`; o total vai para o `config.json` da base (o que
+    dispara a recarga do `rag_agent`). Retorna o total de linhas marcadas no índice.
+    """
+    with segment_index.locked(out_dir):
+        return _tombstone_ids(out_dir, ids)
+
+
+def _tombstone_ids(out_dir: Path, ids: Iterable[str]) -> int:
+    out_dir = Path(out_dir)
+    ids = set(ids)
+    total = 0
+    for part in segment_index.part_dirs(out_dir):
+        rows = [row for row, doc_id in enumerate(read_ids(part)) if doc_id in ids]
+        existing = vector_store.load_tombstones(part)
+        if existing is not None:
+            rows.extend(int(r) for r in existing)
+        if rows:
+            vector_store.save_tombstones(part, np.asarray(rows, dtype=np.int64))
+        total += len(set(rows))
+    cfg_file = out_dir / 'config.json'
+    with open(cfg_file, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    config['tombstones'] = total
+    tmp = out_dir / 'config.json.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False)
+    os.replace(tmp, cfg_file)
+    return total
+
+
+def _read_config(vdir: Path) -> dict:
+    with open(Path(vdir) / 'config.json', 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _tombstone_count(vdir: Path) -> int:
+    rows = vector_store.load_tombstones(vdir)
+    return int(rows.size) if rows is not None else 0
+
+
+def compact_segments(vdir: Path, major: bool = False, min_segments: int = segment_index.COMPACT_MIN_SEGMENTS,
+                     small_rows: int = segment_index.COMPACT_SMALL_ROWS, lock_timeout: Optional[float] = segment_index.LOCK_TIMEOUT) -> Optional[dict]:
+    """Junta segmentos do índice de `vdir`; retorna um resumo ou None se nada mudou.
+
+    Compactação menor: os segmentos com até `small_rows` linhas, quando forem pelo menos
+    `min_segments`, viram um só (sem as linhas marcadas como removidas). O segmento novo
+    é montado sem lock; na troca, se algum dos originais saiu do manifesto ou ganhou
+    tombstones nesse meio-tempo, o resultado é descartado e a compactação fica para depois.
+
+    `major=True` regrava base + segmentos numa base nova (segura o lock o tempo todo).
+    """
+    vdir = Path(vdir)
+    base_cfg = _read_config(vdir)
+    quant = (base_cfg.get('quantization') or {}).get('type') or 'none'
+    if major:
+        with segment_index.locked(vdir, timeout=lock_timeout):
+            parts = segment_index.part_dirs(vdir)
+            if len(parts) <= 1 and not _tombstone_count(vdir):
+                return None
+            writer = IndexWriter(vdir, base_cfg.get('model'))
+            try:
+                for part in parts:
+                    writer.add_existing(part, _read_config(part))
+            except BaseException:
+                writer.abort()
+                raise
+            config = writer.finalize(ann='on' if base_cfg.get('ann') else 'auto', quantize=quant)
+        if config is None:
+            return None
+        return {'merged': len(parts), 'rows': config['items_count'], 'major': True}
+
+    manifest = segment_index.load_manifest(vdir)
+    small = [e for e in manifest['segments'] if e.get('rows', 0) <= small_rows]
+    if len(small) < max(2, min_segments):
+        return None
+    snapshot = {e['dir']: _tombstone_count(vdir / e['dir']) for e in small}
+    writer = IndexWriter(segment_index.new_segment_dir(vdir), base_cfg.get('model'), segment_of=vdir)
+    try:
+        for entry in small:
+            writer.add_existing(vdir / entry['dir'], _read_config(vdir / entry['dir']))
+        config = writer.finalize(quantize=quant)
+    except BaseException:
+        writer.abort()
+        raise
+    try:
+        with segment_index.locked(vdir, timeout=lock_timeout):
+            manifest = segment_index.load_manifest(vdir)
+            current = [e['dir'] for e in manifest['segments']]
+            if any(d not in current or _tombstone_count(vdir / d) != n for d, n in snapshot.items()):
+                print("ℹ️ Segmentos alterados durante a compactação; nova tentativa depois")
+                shutil.rmtree(writer.out_dir, ignore_errors=True)
+                return None
+            if config is not None:
+                pos = min(current.index(d) for d in snapshot)
+                manifest['segments'].insert(pos, segment_index.segment_entry(vdir, writer.out_dir, config))
+            segment_index.retire(vdir, manifest, list(snapshot))
+    except TimeoutError:
+        shutil.rmtree(writer.out_dir, ignore_errors=True)
+        return None
+    return {'merged': len(snapshot), 'rows': config['items_count'] if config else 0, 'major': False}
+
+
+def compact_after_append(vdir: Path) -> Optional[dict]:
+    """Compactação menor logo depois de um indexador anexar um segmento.
+
+    A compactação roda só nos indexadores (ingestão, reindex) e na linha de comando, nunca
+    no servidor: cada worker do uvicorn teria a sua e elas disputariam o lock.
+    """
+    try:
+        result = compact_segments(vdir)
+    except TimeoutError as e:
+        print(f"ℹ️ Compactação adiada ({e})")
+        return None
+    if result:
+        print(f"🗜️ Segmentos do índice compactados: {result['merged']} -> 1 ({result['rows']} linhas)")
+    return result
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compacta os segmentos do índice RAG (segments.json)')
+    parser.add_argument('vectors_dir', nargs='?', default='memoria/vectors')
+    parser.add_argument('--major', action='store_true', help='Regrava base + segmentos numa base nova (aplica também os tombstones)')
+    parser.add_argument('--min-segments', type=int, default=2, help='Segmentos pequenos necessários para a compactação menor')
+    args = parser.parse_args()
+    result = compact_segments(Path(args.vectors_dir), major=args.major, min_segments=args.min_segments)
+    if result is None:
+        print("ℹ️ Nada a compactar")
+    else:
+        print(f"✅ {result['merged']} partes compactadas ({result['rows']} linhas)")
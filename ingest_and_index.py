@@ -2,11 +2,20 @@ r"""Ingestão e indexação (Fase 1)
 
 - Varre a pasta `downloads/` procurando arquivos PDF (recursivo).
 - Ignora PDFs que estiverem dentro de qualquer pasta cujo nome seja 'flashcards' ou 'slides'.
-- Extrai texto dos PDFs (PyMuPDF), faz chunking e gera embeddings via Gemini/Gemma.
+- Extrai texto dos PDFs (PyMuPDF), em sequência por padrão ou num pool de processos com
+  `--workers N` (PDFs grandes são divididos por faixas de páginas), faz chunking e gera embeddings via Gemini/Gemma
+  (ou, com `--model local`, na CPU sem API: `embedding_backend.LocalEmbeddingBackend`).
 - Também lê a coleção Firestore `estacoes_clinicas` (se as credenciais estiverem
   disponíveis) e indexa cada estação como um documento adicional.
+- Extração, chunking, embedding e escrita rodam como um pipeline em streaming (filas
+  limitadas entre os estágios): os vetores vão para segmentos no disco (`index_writer`)
+  e a memória não cresce com o tamanho do corpus.
 - Salva embeddings numpy em `memoria/vectors/embeddings.npy` e metadados em
   `memoria/vectors/metadata.jsonl` e `memoria/vectors/id_map.json`.
+- Sem `--rebuild`, só as fontes novas/alteradas são gravadas, num segmento anexado
+  (`memoria/vectors/segments/`, ver `segment_index.py`); o índice existente não é regravado.
+- Chunks quase duplicados (mesmo texto em várias edições de PDF ou estações) são descartados
+  antes do embedding (`chunk_dedup`, MinHash + LSH; `--dedup-threshold 0` desativa).
 
 Como usar (PowerShell):
     py -3 -m venv .venv; .\.venv\Scripts\Activate.ps1
@@ -18,8 +27,12 @@ Como usar (PowerShell):
 import os
 import json
 import sys
+import queue
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from pathlib import Path
-from datetime import datetime
+from typing import List, Optional
 from tqdm import tqdm
 from dotenv import load_dotenv
 load_dotenv()
@@ -30,12 +43,12 @@ except Exception as e:
     print("Erro ao importar PyMuPDF (fitz). Instale 'PyMuPDF' antes de executar.")
     raise
 
-try:
-    import google.generativeai as genai
-except Exception:
-    genai = None
-
-import numpy as np
+import vector_store
+import embedding_backend
+import embedding_cache
+import index_writer
+import ingest_manifest
+import chunk_dedup
 
 try:
     import firebase_admin
@@ -44,6 +57,13 @@ except Exception:
     firebase_admin = None
 
 IGNORED_DIR_NAMES = {"flashcards", "slides"}
+LOCAL_STATIONS_DIR = Path("provas inep")
+# Páginas por tarefa na extração paralela (PDFs maiores são divididos entre os workers)
+PAGES_PER_TASK = 32
+# Itens em espera entre os estágios da ingestão (extração -> embedding -> escrita)
+QUEUE_SIZE = 8
+EMBED_BATCH_SIZE = 16
+_STAGE_END = object()
 
 
 def is_ignored_path(path: Path) -> bool:
@@ -62,20 +82,94 @@ def find_pdfs(base_dir: Path):
         yield p
 
 
-def extract_text_from_pdf(pdf_path: Path) -> str:
-    """Extrai texto simples do PDF usando PyMuPDF (fitz)."""
+def _extract_pages(pdf_path: str, start: int = 0, end: Optional[int] = None) -> List[str]:
+    """Texto das páginas [start, end) não vazias, em ordem (executado também nos workers)."""
     text_parts = []
     doc = fitz.open(str(pdf_path))
-    for page in doc:
-        try:
-            # PyMuPDF: get_text é o método correto; fallback para extrair texto bruto se não existir
-            text = getattr(page, "get_text", lambda: "")()
-        except Exception:
-            text = ""
-        if text:
-            text_parts.append(text)
-    doc.close()
-    return "\n\n".join(text_parts)
+    try:
+        end = doc.page_count if end is None else min(end, doc.page_count)
+        for i in range(start, end):
+            try:
+                # PyMuPDF: get_text é o método correto; fallback para extrair texto bruto se não existir
+                text = getattr(doc[i], "get_text", lambda: "")()
+            except Exception:
+                text = ""
+            if text:
+                text_parts.append(text)
+    finally:
+        doc.close()
+    return text_parts
+
+
+def _page_count(pdf_path: str) -> int:
+    doc = fitz.open(str(pdf_path))
+    try:
+        return doc.page_count
+    finally:
+        doc.close()
+
+
+def extract_text_from_pdf(pdf_path: Path) -> str:
+    """Extrai texto simples do PDF usando PyMuPDF (fitz)."""
+    return "\n\n".join(_extract_pages(str(pdf_path)))
+
+
+def iter_pdf_texts(pdf_paths: List[Path], workers: int = 1, pages_per_task: int = PAGES_PER_TASK):
+    """Extrai o texto dos PDFs, gerando (caminho, texto, erro) na mesma ordem de `pdf_paths`.
+
+    Com `workers > 1` a extração roda num pool de processos: cada PDF é dividido em
+    faixas de até `pages_per_task` páginas (um PDF grande ocupa vários workers) e as
+    faixas são remontadas em ordem. Só `workers * 4` PDFs ficam em andamento por vez,
+    então o texto é consumido (chunking) enquanto os próximos ainda estão sendo extraídos.
+    O texto é idêntico ao de `extract_text_from_pdf`.
+    """
+    if workers <= 1:
+        for p in pdf_paths:
+            try:
+                yield p, extract_text_from_pdf(p), None
+            except Exception as e:
+                yield p, None, e
+        return
+
+    window = workers * 4
+    paths = iter(pdf_paths)
+    # cada entrada: [caminho, future da contagem de páginas, futures das faixas (ou None)]
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        def _fill():
+            for p in paths:
+                pending.append([p, executor.submit(_page_count, str(p)), None])
+                if len(pending) >= window:
+                    break
+
+        def _submit_ranges(entry):
+            n_pages = entry[1].result()
+            entry[2] = [executor.submit(_extract_pages, str(entry[0]), start, start + pages_per_task)
+                        for start in range(0, n_pages, pages_per_task)]
+
+        _fill()
+        while pending:
+            # PDFs com páginas já contadas entram no pool assim que possível
+            for entry in pending:
+                if entry[2] is None and entry[1].done() and entry[1].exception() is None:
+                    _submit_ranges(entry)
+            head = pending[0]
+            if head[1].done() and head[1].exception() is not None:
+                pending.popleft()
+                yield head[0], None, head[1].exception()
+                _fill()
+                continue
+            if head[2] is not None and all(f.done() for f in head[2]):
+                pending.popleft()
+                try:
+                    parts = [part for f in head[2] for part in f.result()]
+                    yield head[0], "\n\n".join(parts), None
+                except Exception as e:
+                    yield head[0], None, e
+                _fill()
+                continue
+            outstanding = [f for entry in pending for f in ([entry[1]] if entry[2] is None else entry[2]) if not f.done()]
+            wait(outstanding, return_when=FIRST_COMPLETED)
 
 
 def chunk_text(text: str, chunk_size: int = 1200, overlap: int = 200):
@@ -99,8 +193,6 @@ def ensure_dir(p: Path):
     p.mkdir(parents=True, exist_ok=True)
 
 
-from typing import Optional
-
 def init_firebase(service_account_path: Optional[Path] = None):
     if firebase_admin is None:
         print("firebase_admin não instalado; pulando ingestão de estações do Firestore.")
@@ -120,218 +212,404 @@ def init_firebase(service_account_path: Optional[Path] = None):
         return None
 
 
-def index_documents(items, model_name, out_dir: Path, rebuild=False):
-    """Gera embeddings via API (google.generativeai) e salva embeddings numpy + metadados.
-
-    A função tenta o `model_name` recebido e, se falhar, testa uma lista de candidatos.
-    """
-    ensure_dir(out_dir)
-    embeddings_file = out_dir / "embeddings.npy"
-    meta_file = out_dir / "metadata.jsonl"
-    id_map_file = out_dir / "id_map.json"
-    config_file = out_dir / "config.json"
-
-    texts = [it['text'] for it in items]
-    ids = [it['id'] for it in items]
+class _StageError:
+    def __init__(self, error: BaseException):
+        self.error = error
 
-    if not texts:
-        print("Nenhum texto para indexar.")
-        return
 
-    # configurar chave (procura GEMINI_API_KEY_* no .env)
-    api_key = None
-    for i in range(1, 6):
-        k = os.getenv(f"GEMINI_API_KEY_{i}")
-        if k:
-            api_key = k
-            break
-    if not api_key and os.getenv('GEMINI_API_KEY'):
-        api_key = os.getenv('GEMINI_API_KEY')
+def _threaded(iterable, maxsize: int = QUEUE_SIZE, name: str = "ingest-stage"):
+    """Consome `iterable` numa thread e entrega os itens por uma fila limitada.
 
-    if not api_key:
-        print("Nenhuma GEMINI_API_KEY encontrada no ambiente. Defina GEMINI_API_KEY or GEMINI_API_KEY_1..5 no .env")
-        return
+    O estágio produtor bloqueia quando a fila enche, então entre dois estágios nunca há
+    mais que `maxsize` itens em memória; uma exceção do produtor é relançada no consumidor.
+    Se o consumidor parar antes do fim, o produtor é interrompido.
+    """
+    q = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
 
-    if genai is None:
-        print("google.generativeai não disponível. Instale 'google-generativeai' e tente novamente.")
-        return
+    def _put(item) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-    # configurar cliente
+    def _run():
+        try:
+            for item in iterable:
+                if not _put(item):
+                    break
+            else:
+                _put(_STAGE_END)
+        except BaseException as e:
+            _put(_StageError(e))
+        finally:
+            close = getattr(iterable, "close", None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=_run, name=name, daemon=True)
+    thread.start()
     try:
-        getattr(genai, "configure")(api_key=api_key)
-    except Exception:
-        print("Erro ao configurar a chave da API do Gemini.")
-
-    print("Gerando embeddings via API — isso consome créditos do Google Cloud.")
-
+        while True:
+            item = q.get()
+            if item is _STAGE_END:
+                return
+            if isinstance(item, _StageError):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+
+
+def _resolve_backend(model_name: Optional[str]):
+    """Testa `model_name` e uma lista de candidatos; retorna o primeiro backend compatível."""
     # candidatos de modelo (começa pelo solicitado)
     candidates = []
     if model_name:
         candidates.append(model_name)
-    # adicionar candidatos conhecidos; 'gemma-3-n4' está incluído
-    extras = ["gemma-3-n4", "gemma-3-nano", "gemma-3-large", "models/embedding-001", "textembedding-gecko-001", "gemini-1.5", "embedding-001"]
+    # adicionar candidatos conhecidos; 'gemma-3-n4' está incluído (um modelo local não cai para a API)
+    extras = [] if embedding_backend.is_local_model(model_name) else ["gemma-3-n4", "gemma-3-nano", "gemma-3-large", "models/embedding-001", "textembedding-gecko-001", "gemini-1.5", "embedding-001"]
     for e in extras:
         if e not in candidates:
             candidates.append(e)
 
-    # testar modelos em ordem até encontrar um compatível
-    chosen_model = None
-    test_input = ["teste de compatibilidade de embeddings"]
-    # configurar chave (usa GEMINI_API_KEY_1..8 na ordem)
-    try:
-        from gemini_client import configure_first_available
-        used = configure_first_available()
-        print(f"Chave usada para teste de embeddings: {used}")
-    except Exception:
-        used = None
-
+    # testar modelos em ordem até encontrar um compatível (mesmo backend usado pelo rag_agent)
     for cand in candidates:
         try:
             print(f"Testando modelo de embeddings: {cand}")
-            resp_test = getattr(genai, "embed_content")(model=cand, content=test_input)
-            if isinstance(resp_test, dict) and resp_test.get('embedding'):
-                chosen_model = cand
-                break
-            if hasattr(resp_test, 'embedding'):
-                chosen_model = cand
-                break
-        except Exception as e:
+            candidate_backend = embedding_backend.get_backend(cand, strict=True)
+            candidate_backend.probe("teste de compatibilidade de embeddings")
+            return candidate_backend
+        except embedding_backend.EmbeddingError as e:
             print(f"Modelo {cand} não é compatível: {e}")
             continue
+    return None
 
-    if not chosen_model:
-        print("Nenhum modelo de embeddings compatível encontrado. Ajuste o parâmetro --model ou verifique a chave/API.")
-        return
 
-    print(f"Usando modelo de embeddings: {chosen_model}")
-
-    batch_size = 16
-    all_embs = []
-    for i in tqdm(range(0, len(texts), batch_size), desc="Chamando API de embeddings"):
-        batch = texts[i:i+batch_size]
-        try:
-            resp = getattr(genai, "embed_content")(model=chosen_model, content=batch)
-            if isinstance(resp, dict) and 'embedding' in resp:
-                emb_vectors = resp['embedding']
-            elif hasattr(resp, 'embedding'):
-                emb_vectors = resp.get('embedding', [])
-            else:
-                emb_vectors = list(resp)
-        except Exception as e:
-            print(f"Erro ao chamar API de embeddings com {chosen_model}: {e}")
-            return
+def _local_model(out_dir: Path, rebuild: bool, head: list, stream) -> str:
+    """Modelo local para `--model local`: o do índice atual (anexação) ou um novo, ajustado
+    nos primeiros `embedding_backend.LOCAL_FIT_DOCS` textos da ingestão (guardados em `head`)."""
+    config_file = out_dir / "config.json"
+    if not rebuild and config_file.exists():
+        with open(config_file, 'r', encoding='utf-8') as f:
+            current = json.load(f).get('model')
+        if embedding_backend.is_local_model(current):
+            print(f"Reaproveitando o modelo local do índice atual: {current}")
+            return current
+    for item in stream:
+        head.append(item)
+        if len(head) >= embedding_backend.LOCAL_FIT_DOCS:
+            break
+    print(f"Ajustando modelo de embeddings local em {len(head)} textos...")
+    return embedding_backend.fit_local_backend([it['text'] for it in head]).model
 
-        for v in emb_vectors:
-            all_embs.append(np.array(v, dtype=np.float32))
 
-    if not all_embs:
-        print("Nenhum embedding gerado.")
-        return
+def embed_batches(items, backend, batch_size: int = EMBED_BATCH_SIZE, cache=None):
+    """Agrupa os itens em lotes e gera (ids, textos, metadados, embeddings) por lote.
 
-    embeddings = np.vstack(all_embs)
-    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
-    norms[norms == 0] = 1.0
-    embeddings = embeddings / norms
+    Com `cache` (`embedding_cache.ContentEmbeddingCache`), só os textos ausentes do cache
+    vão para a API.
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) < batch_size:
+            continue
+        yield _embed_batch(batch, backend, cache)
+        batch = []
+    if batch:
+        yield _embed_batch(batch, backend, cache)
 
-    np.save(str(embeddings_file), embeddings)
 
-    mode = 'w'
-    if meta_file.exists() and not rebuild:
-        mode = 'a'
+def _embed_batch(batch, backend, cache=None):
+    texts = [it['text'] for it in batch]
+    embs = cache.embed(backend.model, texts, backend.embed) if cache is not None else backend.embed(texts)
+    return [it['id'] for it in batch], texts, [it.get('meta', {}) for it in batch], embs
 
-    with open(meta_file, mode, encoding='utf-8') as f:
-        for i, doc_id in enumerate(ids):
-            meta = {
-                'id': doc_id,
-                'meta': items[i].get('meta', {}),
-                'text_preview': items[i]['text'][:500].replace('\n', ' ') + ("..." if len(items[i]['text'])>500 else ''),
-                'indexed_at': datetime.utcnow().isoformat()
-            }
-            f.write(json.dumps(meta, ensure_ascii=False, default=str) + "\n")
 
-    id_map = {str(i): ids[i] for i in range(len(ids))}
-    with open(id_map_file, 'w', encoding='utf-8') as f:
-        json.dump(id_map, f, ensure_ascii=False)
+def index_documents(items, model_name, out_dir: Path, rebuild=False, ann: str = "auto", ann_lists: Optional[int] = None, quantize: str = "none", batch_size: int = EMBED_BATCH_SIZE, drop_ids: Optional[set] = None, embed_cache=None):
+    """Gera embeddings via `embedding_backend` (Gemini ou local) e salva embeddings numpy + metadados.
 
-    with open(config_file, 'w', encoding='utf-8') as f:
-        json.dump({'model': chosen_model, 'indexed_at': datetime.utcnow().isoformat(), 'items_count': len(ids), 'embeddings_file': str(embeddings_file.name)}, f, ensure_ascii=False)
+    `items` pode ser uma lista ou um gerador ({'id', 'text', 'meta'}): o pipeline
+    extração -> embedding -> escrita roda em estágios ligados por filas limitadas, então a
+    extração continua enquanto os lotes anteriores estão na API, e os vetores/textos vão
+    para segmentos no disco (`index_writer`) em vez de acumular na memória.
+    Sem `rebuild`, o índice atual (mesmo modelo) não é regravado: as linhas novas vão para
+    um segmento anexado (`segment_index`) e as com id em `drop_ids` (fontes
+    alteradas/removidas) são marcadas como removidas.
+    Retorna o config.json gravado, ou None se nada foi gravado.
 
-    print(f"Embeddings salvos em: {embeddings_file}\nMetadados em: {meta_file}\nID map em: {id_map_file}")
+    A função tenta o `model_name` recebido e, se falhar, testa uma lista de candidatos.
+    `model_name='local'` usa o backend local (`embedding_backend.LocalEmbeddingBackend`),
+    sem API: ajustado nos primeiros textos ou reaproveitado do índice atual.
+    `ann` controla o índice IVF-flat (`ann_index`): 'auto' constrói a partir de
+    `ann_index.AUTO_BUILD_MIN_ROWS` vetores, 'on' sempre, 'off' nunca.
+    `quantize` ('int8', 'float16' ou 'none') grava a cópia compacta usada na primeira
+    varredura do `rag_agent` (ver `vector_store`).
+    `embed_cache` (`embedding_cache.ContentEmbeddingCache`) evita chamar a API para textos
+    já embedados com o mesmo modelo.
+    """
+    ensure_dir(out_dir)
+    config_file = out_dir / "config.json"
 
+    # a extração já começa enquanto o modelo é testado
+    stream = _threaded(iter(items), maxsize=batch_size * QUEUE_SIZE, name="ingest-extract")
+    first = next(stream, None)
+    if first is None:
+        print("Nenhum texto para indexar.")
+        return
 
-def main(base_dir: str = "downloads", out_dir: str = "memoria/vectors", rebuild: bool = False, service_account: str = "serviceAccountKey.json", model_name: str = "gemini-embedding-1.0"):
-    base = Path(base_dir)
-    out = Path(out_dir)
-    ensure_dir(out)
+    head = [first]
+    try:
+        if model_name == embedding_backend.LOCAL_MODEL:
+            model_name = _local_model(out_dir, rebuild, head, stream)
+        else:
+            print("Gerando embeddings via API — isso consome créditos do Google Cloud.")
+    except embedding_backend.EmbeddingError as e:
+        stream.close()
+        print(f"Falha ao ajustar o modelo de embeddings local: {e}")
+        return
+    backend = _resolve_backend(model_name)
+    if backend is None:
+        stream.close()
+        print("Nenhum modelo de embeddings compatível encontrado. Ajuste o parâmetro --model ou verifique a chave/API.")
+        return
 
-    items = []
+    chosen_model = backend.model
+    print(f"Usando modelo de embeddings: {chosen_model}")
+    if not backend.remote:
+        # calcular localmente sai mais barato que consultar o cache
+        embed_cache = None
+
+    writer = None
+    if not rebuild and config_file.exists():
+        with open(config_file, 'r', encoding='utf-8') as f:
+            current = json.load(f)
+        if current.get('model') == chosen_model:
+            # só os dados novos são gravados, num segmento anexado ao índice atual
+            writer = index_writer.IndexWriter.append(out_dir, chosen_model, drop_ids)
+            print(f"Anexando ao índice atual num segmento novo: {writer.out_dir.name} (use --rebuild para recomeçar)")
+        elif drop_ids is not None:
+            # ingestão incremental: as fontes inalteradas não seriam reindexadas
+            stream.close()
+            print(f"⚠️ Índice atual gerado com {current.get('model')}, diferente de {chosen_model}; use --rebuild")
+            return None
+        else:
+            print(f"⚠️ Índice atual gerado com {current.get('model')}; reconstruindo com {chosen_model}")
+    if writer is None:
+        writer = index_writer.IndexWriter(out_dir, chosen_model)
+    batches = None
+    try:
+        def _items():
+            yield from head
+            yield from stream
+
+        batches = _threaded(embed_batches(_items(), backend, batch_size, embed_cache), maxsize=QUEUE_SIZE, name="ingest-embed")
+        for ids, texts, metas, embs in tqdm(batches, desc="Chamando API de embeddings", unit="lote"):
+            writer.add(ids, texts, metas, embs)
+    except embedding_backend.EmbeddingError as e:
+        writer.abort()
+        print(f"Erro ao chamar API de embeddings com {chosen_model}: {e}")
+        return
+    except BaseException:
+        writer.abort()
+        raise
+    finally:
+        # fechar o último estágio interrompe os anteriores (cada um fecha o seu produtor)
+        if batches is not None:
+            batches.close()
+        else:
+            stream.close()
+
+    if embed_cache is not None:
+        cst = embed_cache.stats()
+        print(f"💾 Cache de embeddings: {cst['hits']} textos reaproveitados, {cst['misses']} enviados à API")
+    config = writer.finalize(ann=ann, ann_lists=ann_lists, quantize=quantize)
+    if config is None:
+        print("Nenhum embedding gerado.")
+        return
+    print(f"Embeddings salvos em: {writer.out_dir / vector_store.EMBEDDINGS_FILE} ({config['items_count']} linhas)\nMetadados em: {writer.out_dir / 'metadata.jsonl'}\nID map em: {writer.out_dir / 'id_map.json'}")
+    if writer.segment_of is not None:
+        index_writer.compact_after_append(out_dir)
+    return config
 
-    # 0) Indexar estações locais (provas INEP) se existir
-    local_stations_dir = Path("provas inep")
-    if local_stations_dir.exists():
-        print(f"Procurando estações locais em: {local_stations_dir.resolve()}")
-        local_count = 0
-        for j in local_stations_dir.rglob("*.json"):
-            try:
-                with open(j, 'r', encoding='utf-8') as fh:
-                    data = json.load(fh)
-                text_parts = []
-                for key in ['titulo', 'title', 'enunciado', 'resumo', 'questao', 'descricao', 'conteudo']:
-                    if isinstance(data.get(key), str):
-                        text_parts.append(data.get(key))
-                if not text_parts:
-                    text_parts.append(json.dumps(data, ensure_ascii=False, default=str))
-                full_text = "\n\n".join(text_parts)
-                doc_id = f"localprova::{j.relative_to(local_stations_dir)}"
-                items.append({'id': doc_id, 'text': full_text, 'meta': {'source': 'local_prova', 'path': str(j)}})
-                local_count += 1
-            except Exception as e:
-                print(f"Falha ao ler estação local {j}: {e}")
-        print(f"Estações locais indexadas (provas inep): {local_count}")
 
-    # 1) Indexar PDFs locais
+def _local_prova_item(path: Path, rel: Path) -> dict:
+    with open(path, 'r', encoding='utf-8') as fh:
+        data = json.load(fh)
+    text_parts = []
+    for key in ['titulo', 'title', 'enunciado', 'resumo', 'questao', 'descricao', 'conteudo']:
+        if isinstance(data.get(key), str):
+            text_parts.append(data.get(key))
+    if not text_parts:
+        text_parts.append(json.dumps(data, ensure_ascii=False, default=str))
+    meta = {'source': 'local_prova', 'path': str(path)}
+    if isinstance(data.get('especialidade'), str):
+        meta['especialidade'] = data['especialidade']
+    return {'id': f"localprova::{rel}", 'text': "\n\n".join(text_parts), 'meta': meta}
+
+
+def _firestore_item(doc_id: str, data: dict) -> dict:
+    text_parts = []
+    for key in ['titulo', 'resumo', 'conteudo', 'descricao']:
+        if key in data and isinstance(data[key], str):
+            text_parts.append(data[key])
+    if not text_parts:
+        text_parts.append(json.dumps(data, ensure_ascii=False, default=str))
+    meta = {'source': 'firestore', 'doc_id': doc_id}
+    if isinstance(data.get('especialidade'), str):
+        meta['especialidade'] = data['especialidade']
+    return {'id': f"estacao::{doc_id}", 'text': "\n\n".join(text_parts), 'meta': meta}
+
+
+def scan_sources(base: Path, service_account: str = "serviceAccountKey.json"):
+    """Lista as fontes a indexar (sem extrair texto): estações locais, PDFs e Firestore.
+
+    Retorna (fontes, raízes varridas por tipo); o Firestore só entra nas raízes se a
+    coleção foi lida por completo.
+    """
+    sources = []
+    roots = {}
+
+    # 0) Estações locais (provas INEP), se existir
+    local_root = str(LOCAL_STATIONS_DIR.resolve())
+    roots['local_prova'] = local_root
+    if LOCAL_STATIONS_DIR.exists():
+        print(f"Procurando estações locais em: {LOCAL_STATIONS_DIR.resolve()}")
+        for j in LOCAL_STATIONS_DIR.rglob("*.json"):
+            sources.append(ingest_manifest.Source(f"localprova::{j.relative_to(LOCAL_STATIONS_DIR)}", 'local_prova', local_root, path=j))
+
+    # 1) PDFs locais
     print(f"Procurando PDFs em: {base.resolve()}")
-    pdf_paths = list(find_pdfs(base))
-    print(f"PDFs encontrados (após filtro): {len(pdf_paths)}")
-    for p in tqdm(pdf_paths, desc="Processando PDFs"):
-        try:
-            text = extract_text_from_pdf(p)
-            if not text or len(text.strip()) < 100:
-                continue
-            chunks = chunk_text(text)
-            for idx, chunk in enumerate(chunks):
-                doc_id = f"pdf::{p.relative_to(base)}::chunk{idx}"
-                items.append({'id': doc_id, 'text': chunk, 'meta': {'source': 'pdf', 'path': str(p), 'chunk_index': idx}})
-        except Exception as e:
-            print(f"Falha ao processar {p}: {e}")
-
-    # 2) Indexar estações do Firestore (se possível)
+    roots['pdf'] = str(base.resolve())
+    pdf_count = 0
+    for p in find_pdfs(base):
+        sources.append(ingest_manifest.Source(f"pdf::{p.relative_to(base)}", 'pdf', roots['pdf'], path=p))
+        pdf_count += 1
+    print(f"PDFs encontrados (após filtro): {pdf_count}")
+
+    # 2) Estações do Firestore (se possível); os dados já vêm na listagem
     db = init_firebase(Path(service_account))
     if db:
         try:
-            docs = db.collection('estacoes_clinicas').stream()
-            count = 0
-            for d in docs:
-                data = d.to_dict() or {}
-                text_parts = []
-                for key in ['titulo', 'resumo', 'conteudo', 'descricao']:
-                    if key in data and isinstance(data[key], str):
-                        text_parts.append(data[key])
-                if not text_parts:
-                    text_parts.append(json.dumps(data, ensure_ascii=False, default=str))
-                full_text = "\n\n".join(text_parts)
-                doc_id = f"estacao::{d.id}"
-                items.append({'id': doc_id, 'text': full_text, 'meta': {'source': 'firestore', 'doc_id': d.id}})
-                count += 1
-            print(f"Estações indexadas do Firestore: {count}")
+            docs = []
+            for d in db.collection('estacoes_clinicas').stream():
+                update_time = getattr(d, 'update_time', None)
+                docs.append(ingest_manifest.Source(f"estacao::{d.id}", 'firestore', 'estacoes_clinicas',
+                                                   update_time=str(update_time) if update_time is not None else None,
+                                                   payload=d.to_dict() or {}))
+            sources.extend(docs)
+            roots['firestore'] = 'estacoes_clinicas'
+            print(f"Estações encontradas no Firestore: {len(docs)}")
         except Exception as e:
             print(f"Erro ao ler estacoes_clinicas do Firestore: {e}")
+    return sources, roots
+
+
+def iter_source_items(sources, base: Path, workers: int = 1, pages_per_task: int = PAGES_PER_TASK):
+    """Gera os itens ({'id', 'text', 'meta'}) das fontes, registrando os ids em cada fonte."""
+    local_count = 0
+    for src in sources:
+        if src.kind != 'local_prova':
+            continue
+        try:
+            item = _local_prova_item(src.path, src.path.relative_to(LOCAL_STATIONS_DIR))
+        except Exception as e:
+            print(f"Falha ao ler estação local {src.path}: {e}")
+            continue
+        src.ids.append(item['id'])
+        yield item
+        local_count += 1
+    if local_count:
+        print(f"Estações locais indexadas (provas inep): {local_count}")
 
-    # 3) Gerar embeddings e salvar índice
-    if items:
-        index_documents(items, model_name=model_name, out_dir=out, rebuild=rebuild)
+    pdf_sources = [src for src in sources if src.kind == 'pdf']
+    # 0 = um processo por CPU (só quando pedido explicitamente)
+    workers = workers or os.cpu_count() or 1
+    if pdf_sources and workers > 1:
+        print(f"Extraindo texto com {workers} processos ({pages_per_task} páginas por tarefa)")
+    extracted = iter_pdf_texts([src.path for src in pdf_sources], workers=workers, pages_per_task=pages_per_task)
+    for src, (p, text, error) in zip(pdf_sources, extracted):
+        if error is not None:
+            print(f"Falha ao processar {p}: {error}")
+            continue
+        if not text or len(text.strip()) < 100:
+            continue
+        for idx, chunk in enumerate(chunk_text(text)):
+            doc_id = f"pdf::{p.relative_to(base)}::chunk{idx}"
+            src.ids.append(doc_id)
+            yield {'id': doc_id, 'text': chunk, 'meta': {'source': 'pdf', 'path': str(p), 'chunk_index': idx}}
+
+    count = 0
+    for src in sources:
+        if src.kind != 'firestore':
+            continue
+        item = _firestore_item(src.key.split('::', 1)[1], src.payload or {})
+        src.ids.append(item['id'])
+        yield item
+        count += 1
+    if count:
+        print(f"Estações indexadas do Firestore: {count}")
+
+
+def main(base_dir: str = "downloads", out_dir: str = "memoria/vectors", rebuild: bool = False, service_account: str = "serviceAccountKey.json", model_name: str = "gemini-embedding-1.0", ann: str = "auto", ann_lists: Optional[int] = None, quantize: str = "none", workers: int = 1, pages_per_task: int = PAGES_PER_TASK, use_embed_cache: bool = True, dedup_threshold: Optional[float] = chunk_dedup.DEDUP_THRESHOLD):
+    base = Path(base_dir)
+    out = Path(out_dir)
+    ensure_dir(out)
+
+    # manifesto das fontes já indexadas: só o que é novo ou mudou volta para a API
+    manifest = None if rebuild else ingest_manifest.IngestManifest.load(out)
+    if manifest is None:
+        if not rebuild and (out / "config.json").exists():
+            print(f"ℹ️ Índice sem {ingest_manifest.MANIFEST_FILE}; reconstruindo para registrar as fontes")
+        rebuild = True
+        manifest = ingest_manifest.IngestManifest()
+
+    sources, roots = scan_sources(base, service_account=service_account)
+    plan = manifest.plan(sources, roots)
+    print(f"Fontes: {plan.summary()}")
+    if plan.empty:
+        manifest.save(out)
+        print("✅ Nenhuma fonte nova, alterada ou removida; índice mantido")
+        return
+
+    # 3) Gerar embeddings das fontes novas/alteradas e salvar índice, à medida que são extraídas
+    items = iter_source_items(plan.changed, base, workers=workers, pages_per_task=pages_per_task)
+    # quase duplicados (entre si e com os chunks já indexados) não chegam ao embedding
+    dedup = None
+    if dedup_threshold:
+        dedup = chunk_dedup.NearDuplicateFilter(dedup_threshold) if rebuild else chunk_dedup.NearDuplicateFilter.load(out, dedup_threshold)
+        dedup.remove(plan.stale_ids)
+        items = dedup.filter(items)
+    drop_ids = None if rebuild else set(plan.stale_ids)
+    config = index_documents(items, model_name=model_name, out_dir=out, rebuild=rebuild, ann=ann, ann_lists=ann_lists, quantize=quantize, drop_ids=drop_ids,
+                             embed_cache=embedding_cache.content_cache() if use_embed_cache else None)
+    if dedup is not None and dedup.dropped:
+        for src in plan.changed:
+            own = set(src.ids)
+            src.dups = sorted({dedup.dropped[i] for i in own if i in dedup.dropped} - own)
+            src.ids = [i for i in src.ids if i not in dedup.dropped]
+        print(f"🧹 Chunks quase duplicados descartados antes do embedding: {len(dedup.dropped)}")
+    if config is None:
+        if any(src.ids for src in plan.changed):
+            # falha no embedding/escrita: o manifesto não avança e a próxima execução tenta de novo
+            return
+        # nenhuma linha nova (fontes sem texto ou só remoções): basta marcar as linhas antigas
+        if plan.stale_ids and (out / "config.json").exists():
+            total = index_writer.tombstone_ids(out, plan.stale_ids)
+            print(f"🗑️ Linhas de fontes removidas/alteradas marcadas: {total} no índice")
+        manifest.apply(plan)
+    else:
+        manifest.apply(plan, model=config.get('model'))
+    manifest.save(out)
+    if dedup is not None:
+        dedup.save(out)
     else:
-        print("Nenhum item para indexar.")
+        # sem as linhas desta execução, as assinaturas salvas deixariam de valer
+        chunk_dedup.remove(out)
 
 
 if __name__ == "__main__":
@@ -341,8 +619,15 @@ if __name__ == "__main__":
     parser.add_argument("--base-dir", type=str, default="downloads")
     parser.add_argument("--out-dir", type=str, default="memoria/vectors")
     parser.add_argument("--rebuild", action="store_true")
-    parser.add_argument("--model", type=str, default="gemini-embedding-1.0", help="Modelo de embedding para tentar primeiro (p.ex. 'gemini-embedding-1.0', 'gemma-3-n4' ou 'gemma-3-nano')")
+    parser.add_argument("--model", type=str, default="gemini-embedding-1.0", help="Modelo de embedding para tentar primeiro (p.ex. 'gemini-embedding-1.0', 'gemma-3-n4' ou 'gemma-3-nano'; 'local' = TF-IDF + SVD na CPU, sem API)")
     parser.add_argument("--service-account", type=str, default="serviceAccountKey.json")
+    parser.add_argument("--ann", choices=["auto", "on", "off"], default="auto", help="Índice aproximado IVF-flat: 'auto' constrói a partir de ann_index.AUTO_BUILD_MIN_ROWS vetores")
+    parser.add_argument("--ann-lists", type=int, default=0, help="Número de listas do IVF (0 = ~4*sqrt(N))")
+    parser.add_argument("--quantize", choices=["none", "int8", "float16"], default="none", help="Cópia compacta dos vetores para a varredura (re-rank exato em float32)")
+    parser.add_argument("--workers", type=int, default=1, help="Processos para extrair texto dos PDFs (padrão 1 = sequencial; N > 1 = pool de N processos; 0 = número de CPUs)")
+    parser.add_argument("--pages-per-task", type=int, default=PAGES_PER_TASK, help="Páginas por tarefa na extração paralela (PDFs maiores são divididos)")
+    parser.add_argument("--dedup-threshold", type=float, default=chunk_dedup.DEDUP_THRESHOLD, help="Jaccard estimado (MinHash) a partir do qual um chunk é descartado como quase duplicado (0 = desativa)")
+    parser.add_argument("--no-embed-cache", action="store_true", help="Não consultar/gravar o cache de embeddings por conteúdo (EMBEDDING_CACHE_PATH)")
     args = parser.parse_args()
 
-    main(base_dir=args.base_dir, out_dir=args.out_dir, rebuild=args.rebuild, service_account=args.service_account, model_name=args.model)
+    main(base_dir=args.base_dir, out_dir=args.out_dir, rebuild=args.rebuild, service_account=args.service_account, model_name=args.model, ann=args.ann, ann_lists=args.ann_lists or None, quantize=args.quantize, workers=args.workers, pages_per_task=max(1, args.pages_per_task), use_embed_cache=not args.no_embed_cache, dedup_threshold=args.dedup_threshold)
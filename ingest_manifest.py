@@ -0,0 +1,181 @@
+"""Manifesto da ingestão incremental (`ingest_manifest.json`, ao lado do índice).
+
+Para cada fonte indexada guarda a impressão digital e os ids das linhas que ela gerou:
+- arquivos (PDFs e JSONs das provas INEP): caminho, tamanho, mtime e sha256;
+- estações do Firestore: `update_time` do documento.
+
+A cada execução `plan()` compara as fontes encontradas com o manifesto. Tamanho e mtime
+iguais bastam para considerar um arquivo inalterado (sem reler o conteúdo); se mudaram, o
+sha256 decide (um `touch` não gera novos embeddings). Fontes novas ou alteradas são
+reindexadas; as linhas das alteradas e das removidas deixam o índice.
+
+Chunks descartados como quase duplicados (`chunk_dedup`) não viram linhas; a fonte guarda
+em `dups` os ids dos chunks mantidos no lugar deles. Se algum desses sair do índice, a
+fonte é reindexada mesmo sem ter mudado, para o texto não sumir da busca.
+"""
+
+import hashlib
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+MANIFEST_FILE = 'ingest_manifest.json'
+MANIFEST_VERSION = 1
+HASH_BLOCK = 1 << 20
+
+
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class Source:
+    """Uma fonte encontrada na varredura (arquivo ou documento do Firestore)."""
+
+    def __init__(self, key: str, kind: str, root: str, path: Optional[Path] = None, update_time: Optional[str] = None, payload=None):
+        self.key = key
+        self.kind = kind
+        self.root = root
+        self.path = path
+        self.update_time = update_time
+        # dados já lidos na varredura (documentos do Firestore)
+        self.payload = payload
+        self.fingerprint: Dict = {}
+        # já estava no manifesto (alterada): as linhas antigas saem do índice
+        self.replaces = False
+        # ids das linhas geradas nesta execução
+        self.ids: List[str] = []
+        # ids (de outras linhas) que substituem os chunks descartados como quase duplicados
+        self.dups: List[str] = []
+
+    def entry(self) -> dict:
+        entry = {'kind': self.kind, 'root': self.root, **self.fingerprint, 'ids': self.ids, 'indexed_at': datetime.utcnow().isoformat()}
+        if self.dups:
+            entry['dups'] = self.dups
+        return entry
+
+
+class IngestPlan:
+    def __init__(self):
+        self.changed: List[Source] = []
+        self.unchanged = 0
+        self.touched: List[Source] = []
+        self.deleted: List[str] = []
+        self.stale_ids: List[str] = []
+
+    @property
+    def empty(self) -> bool:
+        return not self.changed and not self.deleted
+
+    def summary(self) -> str:
+        new = sum(1 for s in self.changed if not s.replaces)
+        return (f"{new} novas, {len(self.changed) - new} alteradas, {len(self.deleted)} removidas, "
+                f"{self.unchanged} inalteradas")
+
+
+class IngestManifest:
+    def __init__(self, entries: Optional[Dict[str, dict]] = None, model: Optional[str] = None):
+        self.entries: Dict[str, dict] = entries or {}
+        self.model = model
+
+    @classmethod
+    def load(cls, vdir: Path) -> Optional['IngestManifest']:
+        path = Path(vdir) / MANIFEST_FILE
+        if not path.exists():
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return cls(data.get('sources', {}), data.get('model'))
+
+    def save(self, vdir: Path):
+        path = Path(vdir) / MANIFEST_FILE
+        tmp = path.with_name(path.name + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'version': MANIFEST_VERSION, 'model': self.model, 'updated_at': datetime.utcnow().isoformat(), 'sources': self.entries}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def plan(self, sources: Iterable[Source], scanned_roots: Dict[str, str]) -> IngestPlan:
+        """Classifica as fontes da varredura em novas/alteradas, inalteradas e removidas.
+
+        `scanned_roots` (tipo -> raiz varrida) limita as remoções ao que de fato foi
+        varrido: se o Firestore estiver indisponível, suas estações não são removidas.
+        """
+        plan = IngestPlan()
+        seen = set()
+        # inalteradas com chunks descartados como duplicados (podem precisar voltar)
+        with_dups = []
+        for src in sources:
+            seen.add(src.key)
+            old = self.entries.get(src.key)
+            if src.path is not None:
+                st = src.path.stat()
+                src.fingerprint = {'path': str(src.path), 'size': st.st_size, 'mtime': st.st_mtime}
+                if old and old.get('size') == st.st_size and old.get('mtime') == st.st_mtime:
+                    plan.unchanged += 1
+                    if old.get('dups'):
+                        with_dups.append(src)
+                    continue
+                src.fingerprint['sha256'] = file_sha256(src.path)
+                if old and old.get('sha256') == src.fingerprint['sha256']:
+                    plan.unchanged += 1
+                    plan.touched.append(src)
+                    if old.get('dups'):
+                        with_dups.append(src)
+                    continue
+            else:
+                src.fingerprint = {'update_time': src.update_time}
+                if old and src.update_time and old.get('update_time') == src.update_time:
+                    plan.unchanged += 1
+                    if old.get('dups'):
+                        with_dups.append(src)
+                    continue
+            if old:
+                src.replaces = True
+                plan.stale_ids.extend(old.get('ids', []))
+            plan.changed.append(src)
+        for key, entry in self.entries.items():
+            if key not in seen and scanned_roots.get(entry.get('kind')) == entry.get('root'):
+                plan.deleted.append(key)
+                plan.stale_ids.extend(entry.get('ids', []))
+        self._requeue_dups(plan, with_dups)
+        return plan
+
+    def _requeue_dups(self, plan: IngestPlan, with_dups: List[Source]):
+        """Reindexa as fontes inalteradas cujos chunks mantidos no lugar dos seus duplicados saem
+        do índice (até estabilizar: uma fonte reindexada também tira as próprias linhas)."""
+        stale = set(plan.stale_ids)
+        pending = list(with_dups)
+        while pending:
+            requeued = [src for src in pending if stale.intersection(self.entries[src.key]['dups'])]
+            if not requeued:
+                break
+            for src in requeued:
+                pending.remove(src)
+                if src in plan.touched:
+                    plan.touched.remove(src)
+                if src.path is not None and 'sha256' not in src.fingerprint:
+                    src.fingerprint['sha256'] = file_sha256(src.path)
+                old_ids = self.entries[src.key].get('ids', [])
+                src.replaces = True
+                plan.stale_ids.extend(old_ids)
+                stale.update(old_ids)
+                plan.changed.append(src)
+                plan.unchanged -= 1
+
+    def apply(self, plan: IngestPlan, model: Optional[str] = None):
+        """Registra o resultado de uma execução bem-sucedida."""
+        for src in plan.touched:
+            entry = self.entries.get(src.key)
+            if entry is not None:
+                entry.update(src.fingerprint)
+        for src in plan.changed:
+            self.entries[src.key] = src.entry()
+        for key in plan.deleted:
+            self.entries.pop(key, None)
+        if model:
+            self.model = model
@@ -1297,6 +1297,42 @@ def log_learning_event():
     if MONITORING_SYSTEM.get('active'):
         MONITORING_SYSTEM['metrics']['learning_events'] += 1
 
+def collect_rag_cache_stats() -> dict:
+    """Atualiza em MONITORING_SYSTEM os contadores do cache de embeddings de queries do RAG"""
+    try:
+        from rag_agent import get_query_embedding_cache_stats
+        stats = get_query_embedding_cache_stats()
+    except Exception as e:
+        print(f"[WARNING] Erro ao obter estatísticas do cache RAG: {e}")
+        return {}
+    if MONITORING_SYSTEM.get('active'):
+        MONITORING_SYSTEM['metrics']['query_embedding_cache'] = stats
+    return stats
+
+def collect_rag_semantic_cache_stats() -> dict:
+    """Atualiza em MONITORING_SYSTEM os contadores do cache semântico do RAG"""
+    try:
+        from rag_agent import get_semantic_cache_stats
+        stats = get_semantic_cache_stats()
+    except Exception as e:
+        print(f"[WARNING] Erro ao obter estatísticas do cache semântico RAG: {e}")
+        return {}
+    if MONITORING_SYSTEM.get('active'):
+        MONITORING_SYSTEM['metrics']['rag_semantic_cache'] = stats
+    return stats
+
+def collect_rag_api_executor_stats() -> dict:
+    """Atualiza em MONITORING_SYSTEM a ocupação do executor de chamadas ao Gemini do RAG"""
+    try:
+        from rag_agent import get_api_executor_stats
+        stats = get_api_executor_stats()
+    except Exception as e:
+        print(f"[WARNING] Erro ao obter estatísticas do executor RAG: {e}")
+        return {}
+    if MONITORING_SYSTEM.get('active'):
+        MONITORING_SYSTEM['metrics']['rag_api_executor'] = stats
+    return stats
+
 def get_monitoring_stats():
     """Retorna estatísticas do sistema de monitoramento"""
     if not MONITORING_SYSTEM.get('active'):
@@ -1325,7 +1361,10 @@ def get_monitoring_stats():
         "versions_created": metrics['versions_created'],
         "learning_events": metrics['learning_events'],
         "recent_alerts": MONITORING_SYSTEM['alerts'][-5:],  # últimos 5 alertas
-        "total_alerts": len(MONITORING_SYSTEM['alerts'])
+        "total_alerts": len(MONITORING_SYSTEM['alerts']),
+        "query_embedding_cache": collect_rag_cache_stats(),
+        "rag_semantic_cache": collect_rag_semantic_cache_stats(),
+        "rag_api_executor": collect_rag_api_executor_stats()
     }
 
 def load_rules_from_firestore():
@@ -1464,7 +1503,18 @@ async def lifespan(app: FastAPI):
     if initialize_firebase():
         load_rules_from_firestore()
     configure_gemini_keys()
+    # Pré-carregar o índice RAG e acompanhar reindexações (recarga sem reiniciar o servidor)
+    try:
+        from rag_agent import start_index_watcher
+        start_index_watcher()
+    except Exception as e:
+        print(f"[WARNING] Não foi possível iniciar o monitor do índice RAG: {e}")
     yield
+    try:
+        from rag_agent import QUERY_EMBEDDING_CACHE
+        QUERY_EMBEDDING_CACHE.flush()
+    except Exception as e:
+        print(f"[WARNING] Não foi possível gravar o cache de embeddings de queries: {e}")
     print("Servidor finalizado.")
 
 # --- Aplicação FastAPI ---
@@ -1473,8 +1523,10 @@ app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True,
 
 # Incluir rota RAG (busca por similaridade usando embeddings locais)
 try:
-    from rag_agent import router as rag_router
+    from rag_agent import router as rag_router, init_embedding_backend
     app.include_router(rag_router)
+    # backend de embeddings resolvido uma vez aqui, não a cada consulta
+    init_embedding_backend()
     print("[SUCCESS] Rota RAG incluída com sucesso!")
 except ImportError as e:
     print(f"[WARNING] Não foi possível incluir rota RAG: erro de importação - {e}")
@@ -1498,40 +1550,100 @@ async def monitoring_middleware(request: Request, call_next):
     return response
 
 # --- Função Auxiliar para RAG ---
-async def perform_rag_search(query: str, top_k: int = 5, generation_model: str = "flash") -> str:
-    """Executa busca RAG usando o sistema de embeddings local"""
+async def perform_rag_search(query: str, top_k: int = 5, generation_model: str = "flash", diversity: float = 0.0) -> str:
+    """Executa busca RAG usando o sistema de embeddings local (somente recuperação, sem geração)"""
     try:
-        # Chamar diretamente a função async rag_query de rag_agent (evita subprocessos)
-        from rag_agent import rag_query, RAGQuery
+        # Chamar diretamente a função async retrieve de rag_agent (evita subprocessos e a geração
+        # de resposta do rag_query, que aqui não é usada)
+        from rag_agent import retrieve, RAGQuery
 
-        body = RAGQuery(query=query, top_k=top_k, generation_model=generation_model)
+        body = RAGQuery(query=query, top_k=top_k, generation_model=generation_model, diversity=diversity)
         # Como estamos em contexto async, await diretamente a coroutine
-        rag_result = await rag_query(body)
+        rag_result = await retrieve(body)
 
         evidence = rag_result.get('evidence', []) if isinstance(rag_result, dict) else []
-        contexts = []
-        for item in evidence[:top_k]:
-            metadata = item.get('metadata', {}) or {}
-            text_preview = metadata.get('text_preview') or metadata.get('text') or ''
-            source_path = (metadata.get('meta') or {}).get('path', 'fonte desconhecida')
-            score = item.get('score', 0)
-            contexts.append(f"**Fonte:** {source_path} (Score: {score:.3f})\n{text_preview}")
-
-        if contexts:
-            return "\n\n---\n\n".join(contexts)
-        return ""
+        return format_rag_evidence(evidence, top_k)
     except Exception as e:
         print(f"[WARNING] Erro no sistema RAG: {e}")
         return ""
 
+def format_rag_evidence(evidence: List[Dict[str, Any]], top_k: int = 5) -> str:
+    """Formata as evidências do RAG como contexto de prompt (fonte, score e trecho)"""
+    contexts = []
+    for item in evidence[:top_k]:
+        metadata = item.get('metadata', {}) or {}
+        # texto completo do chunk quando o índice tem chunk store; senão o preview
+        text_preview = item.get('text') or metadata.get('text_preview') or metadata.get('text') or ''
+        source_path = (metadata.get('meta') or {}).get('path', 'fonte desconhecida')
+        score = item.get('score', 0)
+        contexts.append(f"**Fonte:** {source_path} (Score: {score:.3f})\n{text_preview}")
+
+    if contexts:
+        return "\n\n---\n\n".join(contexts)
+    return ""
+
+def rag_queries_for_theme(tema: str, especialidade: str) -> Dict[str, tuple]:
+    """Queries RAG (texto, top_k) usadas pelas Fases 1, 2 e 3 para um tema"""
+    return {
+        'fase_1': (f"{tema} {especialidade} diretrizes protocolo tratamento", 5),
+        'fase_2': (f"estação {tema} {especialidade} INEP revalida", 3),
+        'fase_3': (f"{tema} {especialidade}", 3),
+    }
+
+# Filtros de metadados por fase (aplicados no rag_agent antes da pontuação):
+# a Fase 3 só usa estações das provas INEP locais como exemplo de estrutura
+RAG_PHASE_FILTERS = {
+    'fase_3': {'source': 'local_prova'},
+}
+
+# Diversificação MMR por fase: a Fase 1 recebia chunks vizinhos (sobrepostos) do mesmo PDF
+RAG_PHASE_DIVERSITY = {
+    'fase_1': float(os.getenv('RAG_FASE_1_DIVERSITY', '0.3')),
+}
+
+async def prefetch_rag_contexts(temas: List[str], especialidade: str) -> Dict[str, Dict[str, list]]:
+    """
+    Busca de uma vez as evidências RAG das Fases 1–3 para todos os temas
+    (um único lote de embeddings e uma única varredura do índice).
+    Retorna {tema: {'fase_1': [...], 'fase_2': [...], 'fase_3': [...]}}; em caso de erro
+    retorna {} e cada fase volta a buscar individualmente.
+    """
+    try:
+        from rag_agent import retrieve_many, RAGQuery
+
+        keys = []
+        bodies = []
+        for tema in temas:
+            for fase, (query, top_k) in rag_queries_for_theme(tema, especialidade).items():
+                keys.append((tema, fase))
+                bodies.append(RAGQuery(query=query, top_k=top_k, filter=RAG_PHASE_FILTERS.get(fase),
+                                       diversity=RAG_PHASE_DIVERSITY.get(fase, 0.0)))
+        if not bodies:
+            return {}
+
+        results = await retrieve_many(bodies)
+        contexts: Dict[str, Dict[str, list]] = defaultdict(dict)
+        for (tema, fase), result in zip(keys, results):
+            contexts[tema][fase] = (result or {}).get('evidence', [])
+        print(f"🔍 Pré-busca RAG em lote: {len(bodies)} queries para {len(temas)} tema(s)")
+        return dict(contexts)
+    except Exception as e:
+        print(f"[WARNING] Erro na pré-busca RAG em lote: {e}")
+        return {}
+
 # --- Funções de Construção de Prompts (build_prompt_fase_1 atualizada com RAG) ---
-async def build_prompt_fase_1(tema: str, especialidade: str) -> str:
-    """Constrói o prompt para a Fase 1 usando RAG para buscar PDFs indexados"""
+async def build_prompt_fase_1(tema: str, especialidade: str, rag_evidence: Optional[list] = None) -> str:
+    """Constrói o prompt para a Fase 1 usando RAG para buscar PDFs indexados
+    (ou as evidências já pré-buscadas em `rag_evidence`)"""
     
     # Executar busca RAG para encontrar PDFs relacionados ao tema
-    print(f"🔍 Buscando PDFs indexados para o tema: {tema}")
-    rag_query = f"{tema} {especialidade} diretrizes protocolo tratamento"
-    pdf_content = await perform_rag_search(rag_query, top_k=5, generation_model="flash")
+    rag_query, rag_top_k = rag_queries_for_theme(tema, especialidade)['fase_1']
+    if rag_evidence is not None:
+        pdf_content = format_rag_evidence(rag_evidence, rag_top_k)
+    else:
+        print(f"🔍 Buscando PDFs indexados para o tema: {tema}")
+        pdf_content = await perform_rag_search(rag_query, top_k=rag_top_k, generation_model="flash",
+                                               diversity=RAG_PHASE_DIVERSITY.get('fase_1', 0.0))
     
     pdf_instruction = ""
     if pdf_content:
@@ -1610,13 +1722,17 @@ Criar um resumo clínico FOCADO ESPECIFICAMENTE no tema "{tema}" em {especialida
 """
 
 # (As outras funções de build_prompt permanecem as mesmas)
-async def build_prompt_fase_2(tema: str, especialidade: str, resumo_clinico: str, abordagens_selecionadas: Optional[List[str]] = None) -> str:
-    """Constrói o prompt da Fase 2 usando RAG para buscar estações INEP similares"""
+async def build_prompt_fase_2(tema: str, especialidade: str, resumo_clinico: str, abordagens_selecionadas: Optional[List[str]] = None, rag_evidence: Optional[list] = None) -> str:
+    """Constrói o prompt da Fase 2 usando RAG para buscar estações INEP similares
+    (ou as evidências já pré-buscadas em `rag_evidence`)"""
     
     # Executar busca RAG para encontrar estações INEP relacionadas
-    print(f"🔍 Buscando estações INEP similares para: {tema} {especialidade}")
-    rag_query = f"estação {tema} {especialidade} INEP revalida"
-    estacoes_content = await perform_rag_search(rag_query, top_k=3, generation_model="flash")
+    rag_query, rag_top_k = rag_queries_for_theme(tema, especialidade)['fase_2']
+    if rag_evidence is not None:
+        estacoes_content = format_rag_evidence(rag_evidence, rag_top_k)
+    else:
+        print(f"🔍 Buscando estações INEP similares para: {tema} {especialidade}")
+        estacoes_content = await perform_rag_search(rag_query, top_k=rag_top_k, generation_model="flash")
     
     # Usar sistema híbrido se disponível
     if LOCAL_MEMORY_SYSTEM:
@@ -3294,8 +3410,9 @@ def _validate_json_structure(json_obj: dict, validation_result: dict) -> None:
     except Exception as e:
         validation_result["warnings"].append(f"Erro na validação estrutural: {str(e)}")
 
-async def build_prompt_fase_3(request: GenerateFinalStationRequest) -> str:
-    """Constrói o prompt da Fase 3 usando seções específicas do referencias.md + gabarito.json + busca semântica nas provas INEP"""
+async def build_prompt_fase_3(request: GenerateFinalStationRequest, rag_evidence: Optional[list] = None) -> str:
+    """Constrói o prompt da Fase 3 usando seções específicas do referencias.md + gabarito.json + busca semântica nas provas INEP
+    (ou as evidências já pré-buscadas em `rag_evidence`)"""
     
     # Usar sistema híbrido se disponível
     if LOCAL_MEMORY_SYSTEM:
@@ -3339,29 +3456,28 @@ async def build_prompt_fase_3(request: GenerateFinalStationRequest) -> str:
         print("🔍 Buscando provas INEP similares para referência...")
         
         # Criar query de busca baseada no tema e especialidade
-        search_query = f"{request.tema} {request.especialidade}"
+        search_query, search_top_k = rag_queries_for_theme(request.tema, request.especialidade)['fase_3']
         
         # Usar sistema RAG local via função interna (evita subprocess)
         try:
-            from rag_agent import rag_query, RAGQuery
+            if rag_evidence is not None:
+                items = rag_evidence
+            else:
+                from rag_agent import retrieve, RAGQuery
 
-            # Montar o corpo da query e chamar a função async rag_query diretamente
-            rag_body = RAGQuery(query=search_query, top_k=3)
+                # Montar o corpo da query e chamar a função async retrieve diretamente (sem geração)
+                rag_body = RAGQuery(query=search_query, top_k=search_top_k, filter=RAG_PHASE_FILTERS['fase_3'])
 
-            # Estamos em função async: await diretamente
-            resultados_dict = await rag_query(rag_body)
+                # Estamos em função async: await diretamente
+                resultados_dict = await retrieve(rag_body)
+                items = resultados_dict.get('evidence') or resultados_dict.get('results') or []
 
-            # Processar resultados retornados (estrutura do rag_agent: dict com 'evidence' ou 'results')
-            provas_inep = []
-            items = resultados_dict.get('evidence') or resultados_dict.get('results') or []
-            for r in items:
-                metadata = r.get('metadata', {})
-                if 'inep' in str(metadata).lower() or 'prova' in str(metadata).lower():
-                    provas_inep.append(r)
+            # O filtro source=local_prova já restringe a busca às provas INEP locais
+            provas_inep = list(items)
 
             if provas_inep:
                 exemplos_texto = "\n\n".join([
-                    f"**EXEMPLO INEP {i+1}** (Score: {r.get('score', 0):.3f}):\n```json\n{str(r.get('metadata', {}).get('text_preview', r.get('text','')))[:800]}...\n```"
+                    f"**EXEMPLO INEP {i+1}** (Score: {r.get('score', 0):.3f}):\n```json\n{str(r.get('text') or (r.get('metadata') or {}).get('text_preview', ''))[:800]}...\n```"
                     for i, r in enumerate(provas_inep[:3])
                 ])
                 exemplos_inep = exemplos_texto
@@ -3593,7 +3709,7 @@ async def call_gemini_api(prompt: str, preferred_model: str = 'pro', timeout: in
     raise HTTPException(status_code=503, detail="Falha ao processar com todas as chaves.")
 
 # --- Função Helper para Geração Individual (Múltiplas Estações) ---
-async def generate_single_station_internal(tema: str, especialidade: str, abordagem_id: str, enable_web_search: bool = False, skip_firestore: bool = False):
+async def generate_single_station_internal(tema: str, especialidade: str, abordagem_id: str, enable_web_search: bool = False, skip_firestore: bool = False, rag_contexts: Optional[Dict[str, list]] = None):
     """
     Função interna para gerar uma única estação seguindo o fluxo Fase 1 → 2 → 3
     
@@ -3603,6 +3719,8 @@ async def generate_single_station_internal(tema: str, especialidade: str, aborda
     - abordagem_id: Tipo de abordagem
     - enable_web_search: Habilitar busca web
     - skip_firestore: Se True, salva apenas localmente (usado na geração múltipla)
+    - rag_contexts: Evidências RAG já pré-buscadas ({'fase_1', 'fase_2', 'fase_3'});
+      se None, as três buscas do tema são feitas aqui num único lote
     
     Retorna: (success: bool, result: dict, error_message: str)
     """
@@ -3610,9 +3728,13 @@ async def generate_single_station_internal(tema: str, especialidade: str, aborda
         logger = logging.getLogger("agent.multiple_generation")
         logger.info(f"Iniciando geração para tema: {tema}")
         
+        # --- Pré-busca RAG das três fases (um único lote de embeddings/varredura) ---
+        if rag_contexts is None:
+            rag_contexts = (await prefetch_rag_contexts([tema], especialidade)).get(tema, {})
+
         # --- FASE 1: Análise Clínica ---
         logger.info(f"[FASE 1] Executando análise clínica para: {tema}")
-        prompt_fase_1 = await build_prompt_fase_1(tema, especialidade)
+        prompt_fase_1 = await build_prompt_fase_1(tema, especialidade, rag_evidence=rag_contexts.get('fase_1'))
         
         # Adicionar busca web se habilitada (simplificada para modo múltiplo)
         web_search_summary = ""
@@ -3643,7 +3765,7 @@ async def generate_single_station_internal(tema: str, especialidade: str, aborda
         
         # --- FASE 2: Geração de Proposta com Abordagem Específica ---
         logger.info(f"[FASE 2] Gerando proposta com abordagem: {abordagem_id}")
-        prompt_fase_2 = await build_prompt_fase_2(tema, especialidade, resumo_clinico, [abordagem_id])
+        prompt_fase_2 = await build_prompt_fase_2(tema, especialidade, resumo_clinico, [abordagem_id], rag_evidence=rag_contexts.get('fase_2'))
         proposta_resultado = await call_gemini_api(prompt_fase_2, preferred_model='flash')
         
         # Extrair primeira proposta (já filtrada pela abordagem)
@@ -3659,7 +3781,7 @@ async def generate_single_station_internal(tema: str, especialidade: str, aborda
             especialidade=especialidade
         )
         
-        prompt_fase_3 = await build_prompt_fase_3(request_fase_3)
+        prompt_fase_3 = await build_prompt_fase_3(request_fase_3, rag_evidence=rag_contexts.get('fase_3'))
         json_output_str = await call_gemini_api(prompt_fase_3, preferred_model='pro')
         
         # Extrair JSON usando o helper extract_json_from_text
@@ -4781,6 +4903,9 @@ async def generate_multiple_stations(request: MultipleGenerationRequest):
     if MONITORING_SYSTEM.get('active'):
         MONITORING_SYSTEM['metrics']['multiple_generation_sessions'] = MONITORING_SYSTEM['metrics'].get('multiple_generation_sessions', 0) + 1
     
+    # Pré-buscar em lote as evidências RAG das Fases 1–3 de todos os temas
+    rag_contexts_por_tema = await prefetch_rag_contexts([t.strip() for t in request.temas], request.especialidade)
+    
     # Processar cada tema sequencialmente
     for idx, tema in enumerate(request.temas, 1):
         logger.info(f"[{idx}/{total_temas}] 🔄 INICIANDO processamento sequencial do tema: '{tema.strip()}'")
@@ -4796,7 +4921,8 @@ async def generate_multiple_stations(request: MultipleGenerationRequest):
                 especialidade=request.especialidade,
                 abordagem_id=request.abordagem_selecionada,
                 enable_web_search=enable_web_search_bool,
-                skip_firestore=True  # DESABILITAR Firestore na geração múltipla
+                skip_firestore=True,  # DESABILITAR Firestore na geração múltipla
+                rag_contexts=rag_contexts_por_tema.get(tema.strip())
             )
             
             if success:
@@ -5441,6 +5567,11 @@ def get_current_metrics():
                     "versions_created": metrics['versions_created'],
                     "learning_events": metrics['learning_events'],
                     "search_count": metrics.get('search_count', 0)
+                },
+                "rag": {
+                    "query_embedding_cache": collect_rag_cache_stats(),
+                    "semantic_cache": collect_rag_semantic_cache_stats(),
+                    "api_executor": collect_rag_api_executor_stats()
                 }
             },
             "timestamp": datetime.now().isoformat()
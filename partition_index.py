@@ -0,0 +1,150 @@
+"""Partições de metadados do RAG (filtros antes da pontuação).
+
+Para cada campo filtrável (`meta.source`, `meta.especialidade`) guarda, por valor, a
+lista ordenada das linhas do índice com aquele valor. Uma consulta com filtro pontua só
+essas linhas, em vez de varrer o índice inteiro e descartar o que não casa depois.
+
+Arquivos gravados ao lado de `embeddings.npy`:
+- `partitions.json`: campo -> valor normalizado -> [início, fim) em `partitions_rows.npy`;
+- `partitions_rows.npy`: linhas (int64) concatenadas, ordenadas dentro de cada valor.
+
+Índices sem esses arquivos têm as partições montadas em memória a partir do
+`metadata.jsonl` no carregamento.
+"""
+
+import json
+import os
+import re
+import unicodedata
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Union
+
+import numpy as np
+
+META_FILE = 'partitions.json'
+ROWS_FILE = 'partitions_rows.npy'
+FIELDS = ('source', 'especialidade')
+
+FilterValue = Union[str, List[str]]
+
+
+def normalize_value(value) -> str:
+    """Minúsculas, sem acentos e com espaços simples ("Clínica  Médica" == "clinica medica")."""
+    text = unicodedata.normalize('NFKD', str(value).lower())
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def field_value(md: Optional[dict], field: str) -> Optional[str]:
+    """Valor normalizado de `field` numa linha do metadata.jsonl (em `meta` ou na raiz)."""
+    if not md:
+        return None
+    value = (md.get('meta') or {}).get(field)
+    if value is None:
+        value = md.get(field)
+    if value is None or value == '':
+        return None
+    return normalize_value(value)
+
+
+class PartitionIndex:
+    """Linhas por (campo, valor), em formato CSR."""
+
+    def __init__(self, fields: Dict[str, Dict[str, List[int]]], rows: np.ndarray, n_rows: int):
+        self.fields = fields
+        self.rows = rows
+        self.n_rows = int(n_rows)
+
+    @classmethod
+    def build(cls, metadatas: Iterable[Optional[dict]], fields=FIELDS) -> 'PartitionIndex':
+        groups: Dict[str, Dict[str, List[int]]] = {f: {} for f in fields}
+        n_rows = 0
+        for row, md in enumerate(metadatas):
+            n_rows = row + 1
+            for field in fields:
+                value = field_value(md, field)
+                if value is not None:
+                    groups[field].setdefault(value, []).append(row)
+        parts = []
+        spans: Dict[str, Dict[str, List[int]]] = {f: {} for f in fields}
+        offset = 0
+        for field in fields:
+            for value, rows in sorted(groups[field].items()):
+                spans[field][value] = [offset, offset + len(rows)]
+                parts.append(np.asarray(rows, dtype=np.int64))
+                offset += len(rows)
+        rows = np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+        return cls(spans, rows, n_rows)
+
+    def save(self, out_dir: Path):
+        out_dir = Path(out_dir)
+        tmp = out_dir / (ROWS_FILE + '.tmp')
+        with open(tmp, 'wb') as f:
+            np.save(f, self.rows)
+        os.replace(tmp, out_dir / ROWS_FILE)
+        tmp = out_dir / (META_FILE + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'n_rows': self.n_rows, 'fields': self.fields}, f, ensure_ascii=False)
+        os.replace(tmp, out_dir / META_FILE)
+
+    @classmethod
+    def load(cls, vdir: Path) -> Optional['PartitionIndex']:
+        vdir = Path(vdir)
+        if not (vdir / META_FILE).exists() or not (vdir / ROWS_FILE).exists():
+            return None
+        with open(vdir / META_FILE, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        return cls(meta.get('fields', {}), np.load(str(vdir / ROWS_FILE), mmap_mode='r'), meta.get('n_rows', 0))
+
+    def values(self, field: str) -> List[str]:
+        return sorted(self.fields.get(field, {}))
+
+    def rows_for(self, field: str, values: FilterValue) -> np.ndarray:
+        """Linhas (ordenadas) com `field` igual a qualquer um de `values`."""
+        if field not in FIELDS:
+            raise ValueError(f"campo de filtro desconhecido: {field} (use {', '.join(FIELDS)})")
+        if isinstance(values, str):
+            values = [values]
+        spans = self.fields.get(field, {})
+        parts = []
+        for value in values:
+            span = spans.get(normalize_value(value))
+            if span:
+                parts.append(np.asarray(self.rows[span[0]:span[1]]))
+        if not parts:
+            return np.empty(0, dtype=np.int64)
+        if len(parts) == 1:
+            return parts[0]
+        return np.unique(np.concatenate(parts))
+
+    def select(self, filters: Optional[Dict[str, FilterValue]]) -> Optional[np.ndarray]:
+        """Linhas que atendem o filtro (E entre campos, OU entre valores); None sem filtro."""
+        if not filters:
+            return None
+        selected = None
+        for field, values in filters.items():
+            rows = self.rows_for(field, values)
+            selected = rows if selected is None else np.intersect1d(selected, rows, assume_unique=True)
+            if selected.size == 0:
+                break
+        return selected
+
+
+def remove(vdir: Path):
+    for name in (META_FILE, ROWS_FILE):
+        try:
+            (Path(vdir) / name).unlink()
+        except FileNotFoundError:
+            pass
+
+
+def build_for(vdir: Path, metadatas: Iterable[Optional[dict]]) -> Optional[dict]:
+    """Constrói e salva as partições de `vdir`; retorna o trecho para `config.json['partitions']`."""
+    index = PartitionIndex.build(metadatas)
+    if index.n_rows == 0:
+        remove(vdir)
+        return None
+    index.save(vdir)
+    counts = {field: len(values) for field, values in index.fields.items()}
+    print(f"✅ Partições de metadados salvas em: {vdir} ({counts})")
+    return {'fields': list(FIELDS), 'values': counts}
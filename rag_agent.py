@@ -1,15 +1,28 @@
-import google.generativeai as genai
 from google.generativeai.generative_models import GenerativeModel
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 from pathlib import Path
 import numpy as np
 import json
-from typing import List
+from typing import Dict, List, Literal, Optional, Union
 import re
 import threading
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import os
 from dotenv import load_dotenv
+import vector_store
+import ann_index
+import embedding_cache
+import bm25_index
+import embedding_backend
+import partition_index
+import chunk_store
+import segment_index
+import index_writer
+import semantic_cache
+import gemini_client
 
 # Carregar variáveis de ambiente
 load_dotenv()
@@ -37,305 +50,972 @@ ALLOWED_MODELS = {
 
 router = APIRouter()
 
+# Chamadas síncronas ao SDK do Gemini (embedding/geração) rodam num executor próprio e
+# limitado, com timeout, para não bloquear o event loop (/health, monitoramento etc.)
+RAG_API_MAX_CONCURRENCY = int(os.getenv('RAG_API_MAX_CONCURRENCY', '4'))
+RAG_EMBED_TIMEOUT = float(os.getenv('RAG_EMBED_TIMEOUT', '15'))
+RAG_GENERATION_TIMEOUT = float(os.getenv('RAG_GENERATION_TIMEOUT', '90'))
+_API_EXECUTOR = ThreadPoolExecutor(max_workers=RAG_API_MAX_CONCURRENCY, thread_name_prefix='rag-api')
+
+
+# Ocupação do executor (exibida no monitoramento): chamadas na fila e em execução, e
+# quantas continuaram rodando depois que quem esperava desistiu (timeout)
+_API_STATS = {'queued': 0, 'running': 0, 'calls': 0, 'timeouts': 0, 'overruns': 0}
+_API_STATS_LOCK = threading.Lock()
+
+
+async def _run_api_call(fn, *args, timeout: float):
+    """Executa `fn(*args)` no executor da API com timeout (asyncio.TimeoutError ao estourar).
+
+    O timeout só libera quem espera: `fn` deve limitar as próprias chamadas de rede ao mesmo
+    prazo, senão a thread continua ocupando uma das RAG_API_MAX_CONCURRENCY vagas.
+    """
+    timed_out = threading.Event()
+
+    def _call():
+        with _API_STATS_LOCK:
+            _API_STATS['queued'] -= 1
+            _API_STATS['running'] += 1
+        try:
+            return fn(*args)
+        finally:
+            with _API_STATS_LOCK:
+                _API_STATS['running'] -= 1
+                if timed_out.is_set():
+                    _API_STATS['overruns'] += 1
+
+    def _done(cf):
+        if cf.cancelled():
+            # cancelada ainda na fila (timeout antes de começar)
+            with _API_STATS_LOCK:
+                _API_STATS['queued'] -= 1
+
+    with _API_STATS_LOCK:
+        _API_STATS['queued'] += 1
+        _API_STATS['calls'] += 1
+    cf = _API_EXECUTOR.submit(_call)
+    cf.add_done_callback(_done)
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(cf), timeout)
+    except asyncio.TimeoutError:
+        timed_out.set()
+        with _API_STATS_LOCK:
+            _API_STATS['timeouts'] += 1
+        raise
+
+
+def get_api_executor_stats() -> dict:
+    """Ocupação do executor das chamadas ao Gemini (exibida no monitoramento)."""
+    with _API_STATS_LOCK:
+        stats = dict(_API_STATS)
+    stats['max_workers'] = RAG_API_MAX_CONCURRENCY
+    stats['saturated'] = stats['running'] >= RAG_API_MAX_CONCURRENCY
+    return stats
+
 class RAGQuery(BaseModel):
     query: str
     top_k: int = 5
     generation_model: str = "pro"  # 'pro' or 'flash'
     max_output_tokens: int = 512
+    # Knob recall x latência do índice IVF (None = valor do config.json); ignorado sem índice ANN
+    nprobe: Optional[int] = None
+    # 'dense' (embeddings, com fallback lexical), 'lexical' (somente BM25, sem chamar a API)
+    # ou 'hybrid' (denso + BM25 em paralelo, fundidos por reciprocal-rank fusion)
+    mode: Literal['dense', 'lexical', 'hybrid'] = 'dense'
+    # Parâmetros do modo 'hybrid': pesos de cada lista, constante k do RRF e
+    # profundidade de candidatos por lado (None = max(4*top_k, 20))
+    dense_weight: float = 1.0
+    lexical_weight: float = 1.0
+    rrf_k: int = 60
+    candidate_depth: Optional[int] = None
+    # Filtro de metadados aplicado antes da pontuação: {campo: valor ou [valores]}, com
+    # campos 'source' (local_prova, pdf, firestore) e 'especialidade'; E entre campos,
+    # OU entre valores. Ex.: {"source": "local_prova", "especialidade": ["pediatria"]}
+    filter: Optional[Dict[str, Union[str, List[str]]]] = None
+    # Diversificação MMR das evidências (0 = desligada, 1 = só diversidade): evita
+    # devolver chunks vizinhos/sobrepostos do mesmo PDF
+    diversity: float = 0.0
+    # Reaproveitar resultados de queries semanticamente próximas (cache semântico). Opt-in:
+    # queries de temas diferentes montadas com o mesmo modelo de texto podem ficar próximas
+    use_cache: bool = False
+
+# Diretório padrão do índice (gerado por ingest_and_index.py / scripts/reindex_vectors.py)
+VECTORS_DIR = Path(__file__).parent / 'memoria' / 'vectors'
+# Intervalo (s) de verificação do config.json para recarga automática; 0 desativa
+INDEX_WATCH_INTERVAL = float(os.getenv('RAG_INDEX_WATCH_INTERVAL', '10'))
+
 
-# Lazy-loaded globals
+class IndexGeneration:
+    """Uma versão imutável do índice carregado (vetores, metadados, ANN e config).
+
+    Cada consulta pega a geração corrente uma única vez (`_acquire_generation`) e a usa
+    até o fim; uma recarga apenas troca a referência `_current`, então consultas em
+    andamento continuam na geração antiga até terminarem. A geração aposentada fecha seus
+    arquivos (memmaps, metadata.jsonl, chunk store) quando a última consulta a libera.
+    """
+
+    def __init__(self, generation: int, vdir: Path, signature, embeddings, metadata, id_map, config, ann, bm25=None, quant=None, partitions=None, chunks=None, tombstones=None):
+        self.generation = generation
+        self.vdir = vdir
+        self.signature = signature
+        self.embeddings = embeddings
+        self.metadata = metadata
+        self.id_map = id_map
+        self.config = config
+        self.ann = ann
+        self.bm25 = bm25
+        self.quant = quant
+        self.partitions = partitions
+        self.chunks = chunks
+        # linhas removidas pela ingestão incremental (ordenadas), ignoradas nas buscas
+        self.tombstones = tombstones
+        # segmentos anexados à base (segment_index), vistos como um índice só
+        self.segments = 0
+        self.loaded_at = time.time()
+        self._users = 0
+        self._retired = False
+        self.closed = False
+        self._state_lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        """Marca uma consulta em andamento; False se a geração já foi fechada."""
+        with self._state_lock:
+            if self.closed:
+                return False
+            self._users += 1
+            return True
+
+    def release(self):
+        with self._state_lock:
+            self._users -= 1
+            if not (self._retired and self._users == 0):
+                return
+        self.close()
+
+    def retire(self):
+        """Substituída por uma geração nova: fecha já ou ao fim da última consulta."""
+        with self._state_lock:
+            self._retired = True
+            if self._users > 0:
+                return
+        self.close()
+
+    def close(self):
+        """Fecha os arquivos abertos e solta as referências aos memmaps."""
+        with self._state_lock:
+            if self.closed:
+                return
+            self.closed = True
+        for handle in (self.metadata, self.chunks):
+            if handle is not None and hasattr(handle, 'close'):
+                handle.close()
+        # os mapeamentos são desfeitos quando não há mais referências aos arrays
+        self.embeddings = self.quant = self.ann = self.bm25 = self.partitions = None
+        self.metadata = self.chunks = None
+
+    def info(self) -> dict:
+        return {
+            'generation': self.generation,
+            'vectors_dir': str(self.vdir),
+            'rows': int(self.embeddings.shape[0]) if self.embeddings is not None else 0,
+            'model': (self.config or {}).get('model'),
+            'ann': bool(self.ann),
+            'bm25': bool(self.bm25),
+            'quantization': self.quant.kind if self.quant is not None else None,
+            'chunk_store': self.chunks is not None,
+            'tombstones': int(self.tombstones.size) if self.tombstones is not None else 0,
+            'segments': self.segments,
+            'partitions': {f: self.partitions.values(f) for f in partition_index.FIELDS} if self.partitions is not None else None,
+            'loaded_at': self.loaded_at,
+        }
+
+
+# Geração corrente (trocada atomicamente) e locks de carga/recarga
 _vectors_lock = threading.Lock()
-_embeddings = None
-_metadata = None
-_id_map = None
-_config = None
+_current: Optional[IndexGeneration] = None
+_generation_counter = 0
+_watcher_thread = None
 
-def _load_vectors(base_path: Path):
-    global _embeddings, _metadata, _id_map, _config
-    with _vectors_lock:
-        if _embeddings is not None:
-            return
-        vdir = base_path
-        emb_file = vdir / 'embeddings.npy'
-        meta_file = vdir / 'metadata.jsonl'
-        id_file = vdir / 'id_map.json'
-        cfg_file = vdir / 'config.json'
-
-        if not emb_file.exists():
-            raise FileNotFoundError(str(emb_file))
-
-        _embeddings = np.load(str(emb_file))
-
-        # load metadata
-        _metadata = []
-        if meta_file.exists():
-            with open(meta_file, 'r', encoding='utf-8') as f:
-                for line in f:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    _metadata.append(json.loads(line))
-
-        # load id_map
+
+def _index_signature(vdir: Path):
+    """Assinatura (mtime, tamanho) do config.json, que os indexadores gravam por último,
+    e do segments.json (segmentos anexados/compactados)."""
+    cfg_file = vdir / 'config.json'
+    emb_file = vdir / 'embeddings.npy'
+    segments = segment_index.manifest_signature(vdir)
+    try:
+        st = cfg_file.stat()
+        return (st.st_mtime_ns, st.st_size, segments)
+    except FileNotFoundError:
         try:
-            if id_file.exists():
-                with open(id_file, 'r', encoding='utf-8') as f:
-                    _id_map = json.load(f)
-        except Exception:
-            _id_map = None
+            st = emb_file.stat()
+            return (st.st_mtime_ns, st.st_size, segments)
+        except FileNotFoundError:
+            return None
+
+
+def _read_generation(vdir: Path, generation: int) -> IndexGeneration:
+    """Lê o índice de `vdir` (base + segmentos do segments.json) numa nova geração."""
+    signature = _index_signature(vdir)
+    base = _read_part(vdir, generation, signature)
+    seg_dirs = segment_index.segment_dirs(vdir)
+    if not seg_dirs:
+        return base
+    parts = [base] + [_read_part(d, generation, signature) for d in seg_dirs]
+    return _combine_parts(parts, generation, vdir, signature)
+
+
+def _combine_parts(parts: List[IndexGeneration], generation: int, vdir: Path, signature) -> IndexGeneration:
+    """Uma geração sobre base + segmentos, com as linhas numeradas em sequência."""
+    base = parts[0]
+    sizes = [int(p.embeddings.shape[0]) for p in parts]
+    embeddings = segment_index.SegmentedVectors([p.embeddings for p in parts])
+    quant = None
+    if all(p.quant is not None for p in parts) and len({p.quant.kind for p in parts}) == 1:
+        quant = segment_index.SegmentedQuantized([p.quant for p in parts])
+    # IVF só vale a pena se a base tiver; segmentos pequenos são varridos por inteiro
+    ann = segment_index.SegmentedIVF([p.ann for p in parts], sizes) if base.ann is not None else None
+    bm25 = segment_index.SegmentedBM25([p.bm25 for p in parts], sizes) if all(p.bm25 is not None for p in parts) else None
+    partitions = None
+    if all(p.partitions is not None for p in parts):
+        partitions = segment_index.SegmentedPartitions([p.partitions for p in parts], sizes)
+    metadata = segment_index.SegmentedRecords([p.metadata for p in parts], sizes)
+    chunks = None
+    if any(p.chunks is not None for p in parts):
+        chunks = segment_index.SegmentedChunks([p.chunks for p in parts], sizes)
+    tombstones = segment_index.combine_tombstones([p.tombstones for p in parts], sizes)
+    config = dict(base.config or {})
+    if quant is None:
+        config['quantization'] = None
+    gen = IndexGeneration(generation, vdir, signature, embeddings, metadata, base.id_map, config, ann, bm25, quant, partitions, chunks, tombstones)
+    gen.segments = len(parts) - 1
+    return gen
+
+
+def _read_part(vdir: Path, generation: int, signature=None) -> IndexGeneration:
+    """Lê os arquivos de um diretório de índice (base ou segmento)."""
+    emb_file = vdir / 'embeddings.npy'
+    meta_file = vdir / 'metadata.jsonl'
+    id_file = vdir / 'id_map.json'
+    cfg_file = vdir / 'config.json'
 
-        # load config
+    if not emb_file.exists():
+        raise FileNotFoundError(str(emb_file))
+
+    # load config (define o formato dos vetores)
+    config = None
+    try:
+        if cfg_file.exists():
+            with open(cfg_file, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+    except Exception:
+        config = None
+
+    # formato normalizado: memmap somente leitura (páginas compartilhadas entre workers)
+    embeddings = vector_store.load_embeddings(vdir, config)
+
+    # cópia compacta (int8/float16) para a primeira varredura, com re-rank em float32
+    quant = None
+    if (config or {}).get('quantization'):
         try:
-            if cfg_file.exists():
-                with open(cfg_file, 'r', encoding='utf-8') as f:
-                    _config = json.load(f)
-        except Exception:
-            _config = None
+            quant = vector_store.load_quantized(vdir, config)
+        except Exception as e:
+            print(f"⚠️ Falha ao carregar vetores compactos, usando float32: {e}")
+            quant = None
 
-def configure_gemini_keys():
-    """Configuração simples das chaves Gemini para RAG"""
+    # índice aproximado opcional (IVF-flat), construído pelo ingest/reindex
+    ann = None
+    if (config or {}).get('ann'):
+        try:
+            ann = ann_index.IVFIndex.load(vdir)
+        except Exception as e:
+            print(f"⚠️ Falha ao carregar índice IVF, usando busca exata: {e}")
+            ann = None
+
+    # índice lexical BM25 (fallback sem embedding e modo 'lexical')
+    bm25 = None
+    if (config or {}).get('bm25'):
+        try:
+            bm25 = bm25_index.BM25Index.load(vdir)
+        except Exception as e:
+            print(f"⚠️ Falha ao carregar índice BM25, usando fallback por tokens: {e}")
+            bm25 = None
+
+    # metadata.jsonl com acesso por linha: só os offsets ficam em memória
+    metadata = chunk_store.JsonlRecords.load(vdir) if meta_file.exists() else None
+
+    # texto completo dos chunks (blocos comprimidos), lido só para as evidências retornadas
+    chunks = None
     try:
-        # Usar a primeira chave disponível
-        print(f"DEBUG: Tentando GOOGLE_API_KEY: {os.getenv('GOOGLE_API_KEY')}")
-        print(f"DEBUG: Tentando GOOGLE_API_KEY_1: {os.getenv('GOOGLE_API_KEY_1')}")
-        print(f"DEBUG: Tentando GOOGLE_API_KEY_2: {os.getenv('GOOGLE_API_KEY_2')}")
-        print(f"DEBUG: Tentando GOOGLE_API_KEY_3: {os.getenv('GOOGLE_API_KEY_3')}")
-        print(f"DEBUG: Tentando GOOGLE_API_KEY_4: {os.getenv('GOOGLE_API_KEY_4')}")
-        print(f"DEBUG: Tentando GOOGLE_API_KEY_5: {os.getenv('GOOGLE_API_KEY_5')}")
-        print(f"DEBUG: Tentando GEMINI_API_KEY_1: {os.getenv('GEMINI_API_KEY_1')}")
-        print(f"DEBUG: Tentando GEMINI_API_KEY_2: {os.getenv('GEMINI_API_KEY_2')}")
-        print(f"DEBUG: Tentando GEMINI_API_KEY_3: {os.getenv('GEMINI_API_KEY_3')}")
-        print(f"DEBUG: Tentando GEMINI_API_KEY_4: {os.getenv('GEMINI_API_KEY_4')}")
-
-        api_key = (os.getenv("GOOGLE_API_KEY") or
-                   os.getenv("GOOGLE_API_KEY_1") or # Adicionado para corresponder ao .env
-                   os.getenv("GOOGLE_API_KEY_2") or # Adicionado para corresponder ao .env
-                   os.getenv("GOOGLE_API_KEY_3") or # Adicionado para corresponder ao .env
-                   os.getenv("GOOGLE_API_KEY_4") or # Adicionado para corresponder ao .env
-                   os.getenv("GOOGLE_API_KEY_5") or # Adicionado para corresponder ao .env
-                   os.getenv("GEMINI_API_KEY_1") or
-                   os.getenv("GEMINI_API_KEY_2") or
-                   os.getenv("GEMINI_API_KEY_3") or
-                   os.getenv("GEMINI_API_KEY_4"))
-        
-        if api_key:
-            print("✅ Gemini configurado para RAG")
-            return True
-        else:
-            print("⚠️ Nenhuma chave Gemini encontrada para RAG")
-            return False
+        chunks = chunk_store.ChunkStore.load(vdir)
     except Exception as e:
-        print(f"❌ Erro ao configurar Gemini para RAG: {e}")
-        return False
+        print(f"⚠️ Falha ao abrir texto completo dos chunks, usando text_preview: {e}")
+        chunks = None
 
-def _cosine_similarity(a: np.ndarray, b: np.ndarray):
-    # a: (d,), b: (n,d)
-    if a.ndim==1:
-        a = a.reshape(1, -1)
-    # normalize
-    an = a / np.linalg.norm(a, axis=1, keepdims=True)
-    bn = b / np.linalg.norm(b, axis=1, keepdims=True)
-    sims = (an @ bn.T).squeeze(0)
-    return sims
+    # load id_map
+    id_map = None
+    try:
+        if id_file.exists():
+            with open(id_file, 'r', encoding='utf-8') as f:
+                id_map = json.load(f)
+    except Exception:
+        id_map = None
 
+    # partições por source/especialidade (filtros); índices antigos: montadas do metadata
+    partitions = None
+    try:
+        if (config or {}).get('partitions'):
+            partitions = partition_index.PartitionIndex.load(vdir)
+        if partitions is None:
+            partitions = partition_index.PartitionIndex.build(metadata or [])
+    except Exception as e:
+        print(f"⚠️ Falha ao carregar partições de metadados, filtros indisponíveis: {e}")
+        partitions = None
 
-@router.post('/rag/query')
-async def rag_query(body: RAGQuery):
-    """Retorna os top_k trechos mais similares à query usando embeddings salvos.
+    # linhas de fontes removidas/alteradas ainda não compactadas (ingestão incremental)
+    tombstones = None
+    try:
+        tombstones = vector_store.load_tombstones(vdir)
+    except Exception as e:
+        print(f"⚠️ Falha ao ler tombstones.npy, linhas removidas podem aparecer: {e}")
+
+    return IndexGeneration(generation, vdir, signature, embeddings, metadata, id_map, config, ann, bm25, quant, partitions, chunks, tombstones)
+
+
+def _load_vectors(base_path: Path) -> IndexGeneration:
+    """Retorna a geração corrente, carregando-a na primeira chamada."""
+    current = _current
+    if current is not None:
+        return current
+    with _vectors_lock:
+        if _current is None:
+            _swap_generation(base_path)
+        return _current
+
+
+def _swap_generation(vdir: Path) -> IndexGeneration:
+    """Constrói uma nova geração e a publica. Chamar com `_vectors_lock` adquirido."""
+    global _current, _generation_counter
+    new_gen = _read_generation(Path(vdir), _generation_counter + 1)
+    # resolve o backend do modelo da nova geração antes de ela atender consultas
+    embedding_backend.get_backend(_index_model(new_gen.config))
+    _generation_counter = new_gen.generation
+    old, _current = _current, new_gen
+    if old is not None:
+        old.retire()
+    return new_gen
+
+
+def _acquire_generation(base_path: Path) -> IndexGeneration:
+    """Geração corrente marcada como em uso; devolver com `release()` ao fim da consulta."""
+    while True:
+        gen = _load_vectors(base_path)
+        if gen.acquire():
+            return gen
+        # aposentada e fechada entre a leitura de `_current` e o acquire: pega a nova
+
+
+def reload_index(base_path: Optional[Path] = None, force: bool = False) -> dict:
+    """Recarrega o índice se o config.json mudou (ou sempre, com `force`).
+
+    A nova geração é montada enquanto a antiga continua atendendo consultas; só a troca
+    da referência é feita ao final. Retorna o estado resultante.
+    """
+    vdir = Path(base_path) if base_path else (_current.vdir if _current is not None else VECTORS_DIR)
+    with _vectors_lock:
+        current = _current
+        if not force and current is not None and current.signature == _index_signature(vdir):
+            return {'reloaded': False, **current.info()}
+        new_gen = _swap_generation(vdir)
+    print(f"🔄 Índice RAG recarregado: geração {new_gen.generation} ({new_gen.info()['rows']} vetores)")
+    return {'reloaded': True, **new_gen.info()}
+
+
+def _watch_index(vdir: Path, interval: float):
+    while True:
+        time.sleep(interval)
+        try:
+            current = _current
+            if current is None or current.signature != _index_signature(vdir):
+                reload_index(vdir)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"⚠️ Falha ao recarregar índice RAG (geração atual mantida): {e}")
+
+
+def start_index_watcher(base_path: Optional[Path] = None, interval: Optional[float] = None):
+    """Pré-carrega o índice e acompanha o config.json em segundo plano (idempotente).
+
+    Chamado na inicialização do servidor, para que a primeira consulta não pague a
+    carga e para que um reindex seja aplicado sem reiniciar. Os segmentos anexados são
+    compactados pelos indexadores (`index_writer.compact_after_append`), não aqui.
+    """
+    global _watcher_thread
+    vdir = Path(base_path) if base_path else VECTORS_DIR
+    interval = INDEX_WATCH_INTERVAL if interval is None else interval
+
+    def _run():
+        try:
+            _load_vectors(vdir)
+        except FileNotFoundError:
+            print(f"⚠️ Índice RAG ainda não existe em {vdir}; aguardando indexação")
+        except Exception as e:
+            print(f"⚠️ Falha ao pré-carregar índice RAG: {e}")
+        if interval > 0:
+            _watch_index(vdir, interval)
+
+    if _watcher_thread is not None and _watcher_thread.is_alive():
+        return
+    _watcher_thread = threading.Thread(target=_run, name='rag-index-watcher', daemon=True)
+    _watcher_thread.start()
+
+
+def _index_model(config: Optional[dict]) -> str:
+    """Modelo de embedding com que o índice foi gerado (config.json)."""
+    return (config or {}).get('model') or embedding_backend.DEFAULT_MODEL
+
+
+def init_embedding_backend(base_path: Optional[Path] = None):
+    """Resolve e valida o backend de embeddings uma única vez (chamado ao incluir o router).
 
-    Observação: usa embedding via cliente global configurado em `main.py`.
+    Lê só o `model` do config.json; se o índice ainda não existe, usa o modelo padrão.
+    Retorna o backend ou None (consultas densas caem na busca lexical).
     """
-    import os
-    from dotenv import load_dotenv
-    load_dotenv()
-    import google.generativeai as genai
-    # Usar helper centralizado para escolher a primeira chave disponível (prioriza GEMINI_API_KEY_4 conforme gemini_client)
+    cfg_file = (Path(base_path) if base_path else VECTORS_DIR) / 'config.json'
+    config = None
     try:
-        from gemini_client import configure_first_available
-        chosen_slot = configure_first_available()
+        with open(cfg_file, 'r', encoding='utf-8') as f:
+            config = json.load(f)
     except Exception:
-        chosen_slot = None
-
-    base = Path(__file__).parent / 'memoria' / 'vectors'
-    # Lista de modelos permitidos (conforme MODELOS_GEMINI_ATUAIS.md)
-    ALLOWED_MODELS = {
-        'models/gemini-1.5-pro-002',
-        'models/gemini-1.5-pro',
-        'models/gemini-1.5-flash',
-        'models/gemini-1.5-flash-002',
-        'models/gemini-1.5-flash-8b',
-        'models/gemini-1.5-flash-8b-001',
-        'models/gemini-2.5-flash',
-        'models/gemini-2.5-flash-lite',
-        'models/gemini-2.0-flash-exp',
-        'models/gemini-2.5-pro',
-        'models/gemini-2.0-flash',
-        'models/gemini-2.0-flash-001',
-        'models/gemini-2.0-flash-lite-001',
-        'models/gemini-2.0-flash-lite',
-        'models/gemini-2.0-flash-preview-image-generation',
-        'models/embedding-001',
-        'models/text-embedding-004',
-    }
+        config = None
+    return embedding_backend.get_backend(_index_model(config))
+
+
+# Cache de embeddings de queries: LRU em memória + SQLite em memoria/vectors
+QUERY_EMBEDDING_CACHE = embedding_cache.QueryEmbeddingCache(
+    Path(__file__).parent / 'memoria' / 'vectors' / 'query_embedding_cache.sqlite',
+    max_memory_items=int(os.getenv('RAG_QUERY_CACHE_MAX_MEMORY', '2048')),
+    max_disk_items=int(os.getenv('RAG_QUERY_CACHE_MAX_DISK', '50000')),
+)
+
+def _lexical_search(gen: IndexGeneration, query: str, top_k: int, rows: Optional[np.ndarray] = None):
+    """Busca lexical: BM25 persistido quando existe, senão sobreposição de tokens.
+
+    `rows` (linhas de um filtro de metadados) restringe a busca.
+    """
+    if gen.bm25 is not None:
+        return gen.bm25.search(query, top_k, allowed=rows, excluded=gen.tombstones)
+    scores = _lexical_scores(query, gen.metadata)
+    if rows is None:
+        return vector_store.top_k(_mask_tombstones(gen, scores), top_k)
+    rows = rows[rows < scores.shape[0]]
+    idx, top = vector_store.top_k(scores[rows], top_k)
+    return rows[idx], top
+
+
+def _dense_search_rows(gen: IndexGeneration, q: np.ndarray, rows: np.ndarray, top_k: int):
+    """Busca densa restrita às linhas `rows` (filtro de metadados), sem varrer o resto."""
+    if rows.size == 0:
+        return rows, np.empty(0, dtype=np.float32)
+    if gen.quant is not None:
+        cand, _ = vector_store.top_k(gen.quant.score_rows(rows, q), vector_store.rerank_depth(top_k, gen.config))
+        return vector_store.rerank(q, gen.embeddings, rows[cand], top_k)
+    idx, scores = vector_store.top_k(np.asarray(gen.embeddings[rows], dtype=np.float32) @ q, top_k)
+    return rows[idx], scores
+
+
+def _filter_rows(gen: IndexGeneration, body: 'RAGQuery') -> Optional[np.ndarray]:
+    """Linhas que atendem `body.filter` (None sem filtro); HTTP 400 em filtro inválido."""
+    if not body.filter:
+        return None
+    if gen.partitions is None:
+        raise HTTPException(status_code=503, detail='Filtros de metadados indisponíveis neste índice')
     try:
-        _load_vectors(base)
+        rows = gen.partitions.select(body.filter)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if gen.tombstones is not None:
+        rows = np.setdiff1d(rows, gen.tombstones, assume_unique=True)
+    return rows
+
+
+def _mask_tombstones(gen: IndexGeneration, scores: np.ndarray) -> np.ndarray:
+    """Score -inf nas linhas removidas (varreduras completas, 1-D ou uma linha por query):
+    elas nunca entram no top, então a profundidade da busca não cresce com os tombstones."""
+    if gen.tombstones is not None:
+        scores[..., gen.tombstones[gen.tombstones < scores.shape[-1]]] = -np.inf
+    return scores
+
+
+def _live_rows(gen: IndexGeneration, rows: np.ndarray) -> np.ndarray:
+    """`rows` sem as linhas removidas (candidatos do IVF)."""
+    if gen.tombstones is None or rows.size == 0:
+        return rows
+    return rows[~np.isin(rows, gen.tombstones)]
+
+
+def _drop_tombstones(gen: IndexGeneration, idx, scores, depth: int):
+    """Descarta linhas removidas que ainda estejam na lista (p.ex. com score -inf, quando há
+    menos linhas vivas que `depth`) e corta na profundidade pedida."""
+    idx, scores = np.asarray(idx), np.asarray(scores)
+    if gen.tombstones is not None and len(idx):
+        keep = ~np.isin(idx, gen.tombstones)
+        idx, scores = idx[keep], scores[keep]
+    return idx[:depth], scores[:depth]
+
+
+def _lexical_scores(query: str, metadata: Optional[list]) -> np.ndarray:
+    """Sobreposição de tokens sobre os metadados (índices sem BM25)."""
+    def tokenize_text(t: str):
+        if not t:
+            return set()
+        return set(re.findall(r"\w+", t.lower()))
+
+    q_tokens = tokenize_text(query)
+    sims_list = []
+    for md in (metadata or []):
+        # visões segmentadas têm None onde uma parte não tem o registro
+        md = md or {}
+        text_candidate = md.get('text_preview') or md.get('text') or json.dumps(md.get('meta', {}))
+        doc_tokens = tokenize_text(text_candidate)
+        if not q_tokens or not doc_tokens:
+            score = 0.0
+        else:
+            overlap = q_tokens.intersection(doc_tokens)
+            score = len(overlap) / (len(q_tokens) + 1)
+        sims_list.append(score)
+    return np.array(sims_list, dtype=float)
+
+
+def _embed_queries(queries: List[str], model_name: str):
+    """Embeddings de várias queries, consultando antes o cache de queries.
+
+    Só as queries ausentes do cache vão à API (numa única chamada em lote). O cache por
+    conteúdo da ingestão não é usado aqui: ele guarda os chunks indexados e não é lugar
+    para o texto livre dos usuários.
+    Retorna (lista com um embedding ou None por query, slot usado).
+    """
+    embs = QUERY_EMBEDDING_CACHE.get_many(model_name, queries)
+    missing = [i for i, emb in enumerate(embs) if emb is None]
+    used_embed_slot = None
+    if missing:
+        fresh, used_embed_slot = _embed_queries_api([queries[i] for i in missing], model_name)
+        for i, emb in zip(missing, fresh):
+            if emb is not None:
+                QUERY_EMBEDDING_CACHE.put(model_name, queries[i], emb)
+            embs[i] = emb
+    return embs, used_embed_slot
+
+
+def get_query_embedding_cache_stats() -> dict:
+    """Contadores do cache de embeddings de queries (exibidos no monitoramento)."""
+    return QUERY_EMBEDDING_CACHE.stats()
+
+
+# Cache semântico de evidências (/rag/retrieve) e respostas (/rag/query): reaproveita o
+# resultado de uma query a até RAG_SEMANTIC_CACHE_DISTANCE (cosseno) de outra já
+# respondida com os mesmos parâmetros; limpo quando a geração do índice muda. Só vale
+# para requisições com `use_cache=true`; RAG_SEMANTIC_CACHE_MAX_ITEMS=0 desativa.
+SEMANTIC_CACHE = semantic_cache.SemanticCache(
+    max_items=int(os.getenv('RAG_SEMANTIC_CACHE_MAX_ITEMS', '2048')),
+    ttl=float(os.getenv('RAG_SEMANTIC_CACHE_TTL', '3600')),
+    max_distance=float(os.getenv('RAG_SEMANTIC_CACHE_DISTANCE', '0.02')),
+)
+
+
+def get_semantic_cache_stats() -> dict:
+    """Contadores do cache semântico (exibidos no monitoramento)."""
+    return SEMANTIC_CACHE.stats()
+
+
+def _embed_queries_api(queries: List[str], model_name: str):
+    """Gera os embeddings de várias queries pelo backend resolvido na inicialização.
+
+    Retorna (lista com um embedding ou None por query, slot usado). Se a chamada em
+    lote falhar, tenta query a query. Um vetor nulo (p.ex. modelo local sem nenhum token
+    da query no vocabulário) conta como falha: a query cai na busca lexical.
+    """
+    backend = embedding_backend.get_backend(model_name)
+    if backend is None:
+        return [None] * len(queries), None
+    used_embed_slot = getattr(backend, 'key_slot', None)
+    # prazo único para o lote e as tentativas query a query: a thread do executor não
+    # continua presa depois que o `_run_api_call` desistiu
+    deadline = time.monotonic() + RAG_EMBED_TIMEOUT
+    try:
+        return [_usable_embedding(emb) for emb in backend.embed(queries, timeout=RAG_EMBED_TIMEOUT)], used_embed_slot
+    except embedding_backend.EmbeddingError:
+        pass
+    embs = []
+    for q in queries:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            embs.append(None)
+            continue
+        try:
+            embs.append(_usable_embedding(backend.embed_one(q, timeout=remaining)))
+        except embedding_backend.EmbeddingError:
+            embs.append(None)
+    return embs, used_embed_slot
+
+
+def _usable_embedding(emb):
+    """`emb`, ou None se ele é nulo/não finito (sem direção, não serve para o cosseno)."""
+    if emb is None:
+        return None
+    norm = float(np.linalg.norm(emb))
+    return emb if np.isfinite(norm) and norm > 0 else None
+
+
+class RAGBatchQuery(BaseModel):
+    queries: List[RAGQuery]
+
+
+def _top_k_of(body: RAGQuery) -> int:
+    topk = int(body.top_k)
+    return topk if topk > 0 else 5
+
+
+def _candidate_depth(body: RAGQuery) -> int:
+    """Profundidade de candidatos antes da fusão ('hybrid') e/ou da diversificação MMR."""
+    topk = _top_k_of(body)
+    if body.mode != 'hybrid' and body.diversity <= 0:
+        return topk
+    if body.candidate_depth:
+        return max(int(body.candidate_depth), topk)
+    return max(topk * 4, 20)
+
+
+def _retrieval_cache_key(body: RAGQuery) -> tuple:
+    """Parâmetros que mudam o resultado da busca (a query entra pela proximidade)."""
+    filters = tuple(sorted(
+        (field, tuple(sorted(values)) if isinstance(values, list) else (values,))
+        for field, values in (body.filter or {}).items()
+    ))
+    return (_top_k_of(body), body.mode, body.nprobe, body.dense_weight, body.lexical_weight,
+            body.rrf_k, body.candidate_depth, body.diversity, filters)
+
+
+def _answer_cache_key(body: RAGQuery) -> tuple:
+    return ('answer', body.generation_model, body.max_output_tokens) + _retrieval_cache_key(body)
+
+
+def _evidence(gen: IndexGeneration, idx, scores) -> List[dict]:
+    results = []
+    for i, score in zip(idx, scores):
+        meta = gen.metadata[i] if gen.metadata and i < len(gen.metadata) else None
+        results.append({
+            'index': int(i),
+            'score': float(score),
+            'metadata': meta,
+            # texto completo do chunk (None em índices sem chunk store: usar text_preview)
+            'text': gen.chunks.get(int(i)) if gen.chunks is not None else None,
+        })
+    return results
+
+
+def _diversify(gen: IndexGeneration, idx, scores, top_k: int, diversity: float, cosine_scores: bool):
+    """Reordena os candidatos por MMR e mantém top_k (scores originais de relevância).
+
+    `cosine_scores` indica scores já em escala de cosseno (busca densa); BM25 e RRF são
+    reescalados.
+    """
+    idx = np.asarray(idx, dtype=np.int64)
+    if idx.size <= 1:
+        return idx[:top_k], scores[:top_k]
+    order = np.argsort(idx)  # leitura ordenada do memmap
+    vectors = np.empty((idx.size, gen.embeddings.shape[1]), dtype=np.float32)
+    vectors[order] = np.asarray(gen.embeddings[idx[order]], dtype=np.float32)
+    pick = vector_store.mmr(scores, vectors, top_k, diversity, rescale=not cosine_scores)
+    return idx[pick], np.asarray(scores)[pick]
+
+
+def _rrf_fuse(rankings, rrf_k: int, top_k: int):
+    """Reciprocal-rank fusion: soma de peso / (rrf_k + posição) de cada lista ranqueada.
+
+    `rankings` é uma lista de (linhas ordenadas, peso). Retorna (linhas, scores fundidos).
+    """
+    rows_parts = []
+    contrib_parts = []
+    for rows, weight in rankings:
+        rows = np.asarray(rows, dtype=np.int64)
+        if rows.size == 0 or weight <= 0:
+            continue
+        rows_parts.append(rows)
+        contrib_parts.append(weight / (rrf_k + np.arange(1, rows.size + 1, dtype=np.float64)))
+    if not rows_parts:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    rows, inverse = np.unique(np.concatenate(rows_parts), return_inverse=True)
+    fused = np.bincount(inverse, weights=np.concatenate(contrib_parts)).astype(np.float32)
+    idx, scores = vector_store.top_k(fused, top_k)
+    return rows[idx], scores
+
+
+async def retrieve_many(bodies: List[RAGQuery], q_embs: Optional[List[Optional[np.ndarray]]] = None) -> List[dict]:
+    """Recupera evidências para N queries de uma vez (sem geração).
+
+    Os embeddings das queries são gerados numa única chamada e, na busca exata, todas
+    são pontuadas com um único produto (N×d)·(d×M); o top_k usa `np.argpartition`.
+    Com vetores compactos (int8/float16) a varredura usa a cópia compacta e os melhores
+    candidatos são reordenados com o produto exato em float32.
+    No modo 'hybrid' a busca lexical (BM25) roda em paralelo com o embedding e as
+    duas listas são fundidas por RRF.
+    `q_embs` traz embeddings já calculados pelo chamador (`rag_query`, que com eles já
+    consultou o cache semântico): essas queries não vão à API nem ao cache de novo.
+    Retorna uma resposta por query, no mesmo formato de `retrieve`.
+    """
+    try:
+        # geração corrente, usada do início ao fim desta consulta mesmo se houver recarga
+        gen = _acquire_generation(VECTORS_DIR)
     except FileNotFoundError as e:
         raise HTTPException(status_code=500, detail=f'Vectors not found: {e}')
+    try:
+        return await _retrieve_many(gen, bodies, q_embs)
+    finally:
+        gen.release()
 
-    if _embeddings is None:
+
+async def _retrieve_many(gen: IndexGeneration, bodies: List[RAGQuery], q_embs: Optional[List[Optional[np.ndarray]]]) -> List[dict]:
+    given = {pos: emb for pos, emb in enumerate(q_embs or []) if emb is not None}
+    if gen.embeddings is None:
         raise HTTPException(status_code=500, detail='Embeddings not loaded')
 
-    # determine model
-    model_name = (_config or {}).get('model') if _config else None
-    if not model_name:
-        # fallback to a reasonable default used earlier
-        model_name = 'models/embedding-001'
+    # modelo de embedding com que o índice foi gerado
+    model_name = _index_model(gen.config)
 
-    # pick an API key via configure function if available
+    target_dim = None
     try:
-        configure_gemini_keys()
+        target_dim = int(gen.embeddings.shape[1])
     except Exception:
-        pass
+        target_dim = None
 
-    # Tentar gerar embedding da query usando genai configurado por gemini_client (se disponível).
-    q_emb = None
-    used_embed_slot = None
-    target_dim = None
-    try:
-        if _embeddings is not None:
-            try:
-                target_dim = int(_embeddings.shape[1])
-            except Exception:
-                target_dim = None
+    # o modo 'lexical' não usa embedding da query (nenhuma chamada à API)
+    dense_pos = [pos for pos, b in enumerate(bodies) if b.mode != 'lexical' and pos not in given]
+    lexical_pos = [pos for pos, b in enumerate(bodies) if b.mode in ('lexical', 'hybrid')]
 
-        # Configure a primeira chave disponível via gemini_client (se existir)
+    def _embed_dense():
         try:
-            from gemini_client import configure_first_available
-            slot = configure_first_available()
-            if slot:
-                used_embed_slot = slot
+            if not dense_pos:
+                return [], None
+            return _embed_queries([bodies[pos].query for pos in dense_pos], model_name)
         except Exception:
-            # fallback: try specific KEY_SLOTS later
-            slot = None
-
-        # Tentar diversos nomes públicos de função de embeddings no pacote genai
-        emb_fn_names = ['get_embeddings', 'get_embedding', 'embed_text', 'embed', 'embeddings']
-        emb_resp = None
-        for name in emb_fn_names:
-            fn = getattr(genai, name, None)
-            if not fn:
-                continue
-            try:
-                # tentar chamada comum (modelo, input)
-                try:
-                    emb_resp = fn(model=model_name, input=body.query)
-                except TypeError:
-                    # alguns wrappers esperam (input, model)
-                    emb_resp = fn(body.query, model=model_name)
-                except Exception:
-                    emb_resp = fn(body.query)
-                # extrair embedding de resposta
-                def _extract_embedding(resp):
-                    if resp is None:
-                        return None
-                    if isinstance(resp, dict):
-                        if 'data' in resp and resp['data']:
-                            first = resp['data'][0]
-                            if isinstance(first, dict) and 'embedding' in first:
-                                return np.array(first['embedding'], dtype=float)
-                        if 'embedding' in resp:
-                            return np.array(resp['embedding'], dtype=float)
-                    if hasattr(resp, 'embedding'):
-                        attr = getattr(resp, 'embedding')
-                        try:
-                            arr = np.array(attr, dtype=float)
-                            if arr.ndim == 1:
-                                return arr
-                            if arr.ndim > 1:
-                                return arr[0]
-                        except Exception:
-                            pass
-                    # última tentativa: transformar em array direto
-                    try:
-                        arr = np.array(resp, dtype=float)
-                        if arr.ndim == 1:
-                            return arr
-                        if arr.ndim > 1:
-                            return arr[0]
-                    except Exception:
-                        return None
-
-                candidate = _extract_embedding(emb_resp)
-                if candidate is not None and candidate.size > 0:
-                    q_emb = candidate.astype(float)
-                    break
-            except Exception:
-                continue
+            return [None] * len(dense_pos), None
 
-    except Exception:
-        q_emb = None
+    # linhas de cada filtro de metadados, resolvidas uma vez pelas partições
+    filter_rows = {pos: _filter_rows(gen, b) for pos, b in enumerate(bodies) if b.filter}
+
+    def _lexical_all():
+        return {pos: _lexical_search(gen, bodies[pos].query, _candidate_depth(bodies[pos]), filter_rows.get(pos)) for pos in lexical_pos}
 
-    # Se obtivemos embedding, validar dimensão contra o index
-    if q_emb is not None and target_dim is not None:
+    async def _embed_dense_bounded():
         try:
-            if q_emb.shape[0] != target_dim:
-                # informar que é necessário reindexar com o modelo atual
-                return {
-                    'query': body.query,
-                    'reindex_required': True,
-                    'expected_dim': target_dim,
-                    'got_dim': int(q_emb.shape[0]),
-                    'generation_model': None,
-                    'generation_key_slot': used_embed_slot,
-                    'answer': None,
-                    'evidence': [],
-                    'generation_error': 'embedding_dimension_mismatch'
-                }
-        except Exception:
-            pass
+            return await _run_api_call(_embed_dense, timeout=RAG_EMBED_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"⚠️ Embedding da query excedeu {RAG_EMBED_TIMEOUT}s; usando busca lexical")
+            return [None] * len(dense_pos), None
+
+    # embedding (rede, executor limitado) e busca lexical (CPU) em paralelo
+    (embs, used_embed_slot), lexical = await asyncio.gather(
+        _embed_dense_bounded(),
+        asyncio.to_thread(_lexical_all),
+    )
+    q_embs = [given.get(pos) for pos in range(len(bodies))]
+    for pos, emb in zip(dense_pos, embs):
+        q_embs[pos] = emb
+
+    responses: List[Optional[dict]] = [None] * len(bodies)
+    dense = {}  # posição da query -> (índices, scores, nprobe)
+    cached = {}  # posição da query -> (resultado, similaridade, query original) do cache semântico
+
+    for pos, (body, q_emb) in enumerate(zip(bodies, q_embs)):
+        # Se obtivemos embedding, validar dimensão contra o index
+        if q_emb is not None and target_dim is not None and q_emb.shape[0] != target_dim:
+            # informar que é necessário reindexar com o modelo atual
+            responses[pos] = {
+                'query': body.query,
+                'reindex_required': True,
+                'expected_dim': target_dim,
+                'got_dim': int(q_emb.shape[0]),
+                'embedding_key_slot': used_embed_slot,
+                'retrieval_mode': None,
+                'evidence': [],
+            }
+            continue
+        if q_emb is not None and body.use_cache and pos not in given:
+            hit = SEMANTIC_CACHE.lookup(gen.generation, _retrieval_cache_key(body), q_emb)
+            if hit is not None:
+                cached[pos] = hit
+                continue
+        if q_emb is not None and pos in filter_rows:
+            # com filtro, só as linhas da partição são pontuadas (varredura exata reduzida)
+            idx, scores = _dense_search_rows(gen, vector_store.normalize_query(q_emb), filter_rows[pos], _candidate_depth(body))
+            dense[pos] = (idx, scores, None)
+            continue
+        if q_emb is not None and gen.ann is not None:
+            # busca aproximada: só as listas IVF mais próximas da query são varridas
+            nprobe = body.nprobe or ((gen.config or {}).get('ann') or {}).get('nprobe') or ann_index.DEFAULT_NPROBE
+            q = vector_store.normalize_query(q_emb)
+            if gen.quant is not None or gen.tombstones is not None:
+                # candidatos das listas sem as linhas removidas; compacto + re-rank se houver
+                idx, scores = _dense_search_rows(gen, q, _live_rows(gen, gen.ann.candidates(q, nprobe)), _candidate_depth(body))
+            else:
+                idx, scores = gen.ann.search(q, gen.embeddings, _candidate_depth(body), nprobe=nprobe)
+            dense[pos] = (idx, scores, nprobe)
+
+    # busca exata: todas as queries densas restantes num único produto de matrizes
+    exact = [pos for pos, q_emb in enumerate(q_embs) if q_emb is not None and responses[pos] is None and pos not in dense and pos not in cached]
+    if exact:
+        q_matrix = np.vstack([q_embs[pos] for pos in exact])
+        if gen.quant is not None:
+            # varredura na cópia compacta e re-rank exato (float32) dos melhores candidatos
+            sims = _mask_tombstones(gen, gen.quant.scores_batch(q_matrix))
+            for row, pos in enumerate(exact):
+                depth = _candidate_depth(bodies[pos])
+                cand, _ = vector_store.top_k(sims[row], vector_store.rerank_depth(depth, gen.config))
+                idx, scores = vector_store.rerank(q_matrix[row], gen.embeddings, cand, depth)
+                dense[pos] = (idx, scores, None)
+        else:
+            sims = _mask_tombstones(gen, vector_store.dense_scores_batch(q_matrix, gen.embeddings))
+            for row, pos in enumerate(exact):
+                idx, scores = vector_store.top_k(sims[row], _candidate_depth(bodies[pos]))
+                dense[pos] = (idx, scores, None)
+
+    for pos, body in enumerate(bodies):
+        if responses[pos] is not None:
+            continue
+        topk = _top_k_of(body)
+        ann_nprobe = None
+        cache_info = None
+        if pos in cached:
+            (idx, scores, retrieval_mode, ann_nprobe), similarity, cached_query = cached[pos]
+            cache_info = {'hit': True, 'similarity': round(similarity, 4), 'query': cached_query}
+        elif pos in dense and body.mode == 'hybrid' and pos in lexical:
+            d_idx, _, ann_nprobe = dense[pos]
+            l_idx, _ = lexical[pos]
+            idx, scores = _rrf_fuse([(d_idx, body.dense_weight), (l_idx, body.lexical_weight)], body.rrf_k, _candidate_depth(body))
+            retrieval_mode = 'hybrid'
+        elif pos in dense:
+            idx, scores, ann_nprobe = dense[pos]
+            retrieval_mode = 'dense'
+        else:
+            # modo lexical ou fallback quando não conseguimos embedding via API
+            idx, scores = lexical[pos] if pos in lexical else _lexical_search(gen, body.query, _candidate_depth(body), filter_rows.get(pos))
+            retrieval_mode = 'lexical'
 
-    # Se não conseguimos embedding via API, usar fallback por similaridade de tokens/strings
-    if q_emb is None:
-        def tokenize_text(t: str):
-            if not t:
-                return set()
-            return set(re.findall(r"\w+", t.lower()))
-
-        q_tokens = tokenize_text(body.query)
-        sims_list = []
-        for md in (_metadata or []):
-            text_candidate = md.get('text_preview') or md.get('text') or json.dumps(md.get('meta', {}))
-            doc_tokens = tokenize_text(text_candidate)
-            if not q_tokens or not doc_tokens:
-                score = 0.0
+        if cache_info is None:
+            idx, scores = _drop_tombstones(gen, idx, scores, _candidate_depth(body))
+            if body.diversity > 0:
+                idx, scores = _diversify(gen, idx, scores, topk, body.diversity, retrieval_mode == 'dense')
             else:
-                overlap = q_tokens.intersection(doc_tokens)
-                score = len(overlap) / (len(q_tokens) + 1)
-            sims_list.append(score)
-        sims = np.array(sims_list, dtype=float)
-    else:
-        sims = _cosine_similarity(q_emb, _embeddings)
-    topk = int(body.top_k)
-    if topk <=0: topk = 5
-    sims = np.array(sims, dtype=float)
-    idx = np.argsort(-sims)[:topk]
+                idx, scores = idx[:topk], scores[:topk]
+
+        if cache_info is None and q_embs[pos] is not None and body.use_cache:
+            SEMANTIC_CACHE.put(gen.generation, _retrieval_cache_key(body), q_embs[pos], body.query,
+                               (idx, scores, retrieval_mode, ann_nprobe))
+
+        responses[pos] = {
+            'query': body.query,
+            'embedding_key_slot': used_embed_slot,
+            'retrieval_mode': retrieval_mode,
+            'ann_nprobe': ann_nprobe,
+            'filter': body.filter,
+            'filtered_rows': int(filter_rows[pos].size) if pos in filter_rows else None,
+            'index_generation': gen.generation,
+            'semantic_cache': cache_info,
+            'evidence': _evidence(gen, idx, scores),
+        }
+    return responses
+
+
+@router.post('/rag/retrieve')
+async def retrieve(body: RAGQuery):
+    """Retorna os top_k trechos mais similares à query, sem etapa de geração.
+
+    Usado na montagem dos prompts (Fases 1–3), que só consomem `evidence`;
+    os campos `generation_model` e `max_output_tokens` são ignorados aqui.
+    """
+    return (await retrieve_many([body]))[0]
+
+
+@router.post('/rag/retrieve/batch')
+async def retrieve_batch(body: RAGBatchQuery):
+    """Versão em lote de `/rag/retrieve`: um embedding e uma varredura para todas as queries."""
+    return {'results': await retrieve_many(body.queries)}
+
+
+@router.post('/rag/admin/reload')
+async def admin_reload_index(force: bool = True):
+    """Recarrega o índice de `memoria/vectors` sem reiniciar o servidor.
+
+    A nova geração é construída numa thread; consultas em andamento terminam na geração
+    anterior. Com `force=false`, só recarrega se o config.json mudou.
+    """
+    try:
+        return await asyncio.to_thread(reload_index, None, force)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=500, detail=f'Vectors not found: {e}')
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f'Falha ao recarregar índice (geração atual mantida): {e}')
 
-    results = []
-    for i in idx:
-        meta = _metadata[i] if _metadata and i < len(_metadata) else None
-        score = float(sims[i])
-        results.append({
-            'index': int(i),
-            'score': score,
-            'metadata': meta
-        })
+
+@router.get('/rag/admin/index')
+async def admin_index_status():
+    """Estado da geração do índice atualmente em uso."""
+    current = _current
+    if current is None:
+        return {'loaded': False}
+    return {'loaded': True, **current.info()}
+
+
+@router.post('/rag/query')
+async def rag_query(body: RAGQuery):
+    """Retorna os top_k trechos mais similares à query e uma resposta gerada a partir deles.
+
+    A busca é feita por `retrieve`; quem só precisa das evidências deve chamar
+    `retrieve` diretamente e evitar o custo da geração. Uma pergunta próxima (cosseno)
+    de outra já respondida com os mesmos parâmetros devolve a resposta do cache semântico.
+    """
+    q_emb = None
+    generation = None
+    if body.use_cache and body.mode != 'lexical' and SEMANTIC_CACHE.enabled:
+        try:
+            gen = _load_vectors(VECTORS_DIR)
+            generation = gen.generation
+            # o embedding fica no cache de queries: o retrieve abaixo não chama a API de novo
+            embs, _ = await _run_api_call(_embed_queries, [body.query], _index_model(gen.config), timeout=RAG_EMBED_TIMEOUT)
+            q_emb = embs[0]
+        except Exception:
+            q_emb = None
+        hit = SEMANTIC_CACHE.lookup(generation, _answer_cache_key(body), q_emb) if q_emb is not None else None
+        if hit is not None:
+            payload, similarity, cached_query = hit
+            return {**payload, 'query': body.query,
+                    'semantic_cache': {'hit': True, 'similarity': round(similarity, 4), 'query': cached_query}}
+
+    # com o embedding já calculado, a busca não repete a chamada nem a consulta ao cache
+    retrieval = (await retrieve_many([body], q_embs=[q_emb]))[0]
+    if retrieval.get('reindex_required'):
+        return {
+            'query': body.query,
+            'reindex_required': True,
+            'expected_dim': retrieval.get('expected_dim'),
+            'got_dim': retrieval.get('got_dim'),
+            'generation_model': None,
+            'generation_key_slot': retrieval.get('embedding_key_slot'),
+            'answer': None,
+            'evidence': [],
+            'generation_error': 'embedding_dimension_mismatch'
+        }
+    results = retrieval['evidence']
 
     # Montar prompt/contexto para geração final (RAG)
     # Limitar tamanho do contexto concatenado
     contexts = []
     for r in results:
-        txt = r['metadata'].get('text_preview') if r['metadata'] else ''
-        contexts.append(f"[source: {r['metadata'].get('meta',{}).get('path','?')}]\n{txt}\n")
+        md = r.get('metadata') or {}
+        txt = r.get('text') or md.get('text_preview') or ''
+        contexts.append(f"[source: {(md.get('meta') or {}).get('path', '?')}]\n{txt}\n")
 
     context_combined = '\n---\n'.join(contexts[:body.top_k])
     # construir prompt de sistema/usuario simples
@@ -352,38 +1032,30 @@ async def rag_query(body: RAGQuery):
     }
     chosen_gen = gen_model_map.get(body.generation_model, 'gemini-2.5-pro')
 
+    # Validação do modelo de geração
+    if f"models/{chosen_gen}" not in ALLOWED_MODELS:
+        raise HTTPException(status_code=400, detail=f"Modelo de geração '{chosen_gen}' não permitido. Consulte MODELOS_GEMINI_ATUAIS.md.")
+
     # chamar gerador com rotação automática de chaves
-    try:
-        from gemini_client import KEY_SLOTS
-        # Ajuste: configure_specific deve aceitar 'slot' como parâmetro
-        def configure_specific(slot):
-            try:
-                import gemini_client as gc
-                return gc.configure_specific(slot)
-            except Exception:
-                return None
-    except Exception:
-        # fallback para ordem simples
-        KEY_SLOTS = ['GOOGLE_API_KEY_5', 'GOOGLE_API_KEY_4', 'GOOGLE_API_KEY_3', 'GOOGLE_API_KEY_2', 'GOOGLE_API_KEY_1']
-
-        # Validação do modelo de geração
-        if f"models/{chosen_gen}" not in ALLOWED_MODELS:
-            raise HTTPException(status_code=400, detail=f"Modelo de geração '{chosen_gen}' não permitido. Consulte MODELOS_GEMINI_ATUAIS.md.")
-        def configure_specific(slot):
-            try:
-                import gemini_client as gc
-                return gc.configure_specific(slot)
-            except Exception:
-                return None
-
-    import google.generativeai as genai
-
-    def _try_generate_with_client():
-        """Tenta geração usando genai.generate_content (método oficial)."""
+    def _try_generate_with_client(slot):
+        """Configura o slot e tenta geração usando generate_content (método oficial).
+
+        Roda no executor da API; configuração e chamada ficam na mesma thread.
+        """
+        try:
+            configured = gemini_client.configure_specific(slot)
+        except Exception:
+            configured = None
+        if not configured:
+            return None, None
         try:
             # Usar o método oficial generate_content
             model = GenerativeModel(chosen_gen)
-            response = model.generate_content(prompt_system + "\n\n" + prompt_user)
+            response = model.generate_content(
+                prompt_system + "\n\n" + prompt_user,
+                # sem as novas tentativas do SDK (até 600 s): a thread termina no prazo
+                request_options={'timeout': RAG_GENERATION_TIMEOUT, 'retry': None},
+            )
 
             # Extrair texto da resposta
             if response and response.candidates:
@@ -402,18 +1074,23 @@ async def rag_query(body: RAGQuery):
     used_slot = None
     generated_text = None
 
-    for slot in KEY_SLOTS:
-        # tentar configurar este slot
+    for slot in gemini_client.KEY_SLOTS:
+        # configurar este slot e tentar gerar, fora do event loop
         try:
-            configured = configure_specific(slot)
-        except Exception:
-            configured = None
-        if not configured:
+            text, err = await _run_api_call(_try_generate_with_client, slot, timeout=RAG_GENERATION_TIMEOUT)
+        except asyncio.TimeoutError:
+            used_slot = slot
+            last_error = Exception(f'generation timeout after {RAG_GENERATION_TIMEOUT}s')
+            # timeout não depende da chave: não insistir nas demais
+            break
+        except Exception as e:
+            last_error = e
+            continue
+        if text is None and err is None:
+            # slot sem chave configurada
             continue
         used_slot = slot
-        # tentar gerar
         try:
-            text, err = _try_generate_with_client()
             if err is None and text:
                 generated_text = text
                 break
@@ -442,10 +1119,13 @@ async def rag_query(body: RAGQuery):
             'generation_error': err_msg,
         }
 
-    return {
+    response = {
         'query': body.query,
         'generation_model': chosen_gen,
         'generation_key_slot': used_slot,
         'answer': generated_text,
         'evidence': results,
     }
+    if q_emb is not None:
+        SEMANTIC_CACHE.put(retrieval.get('index_generation'), _answer_cache_key(body), q_emb, body.query, response)
+    return {**response, 'semantic_cache': None}
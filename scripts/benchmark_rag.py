@@ -0,0 +1,399 @@
+"""
+Benchmark do RAG (`rag_agent.retrieve_many`) sobre corpora sintéticos.
+
+O que faz:
+- Gera, para cada tamanho pedido (padrão 10k, 100k e 1M vetores), um índice completo no
+  mesmo formato do `ingest_and_index.py` (vetores normalizados, IVF, int8, BM25,
+  partições, chunk store, metadata.jsonl) num diretório temporário.
+- Mede o tempo de carga da geração (`reload_index`), a memória (RSS do processo e
+  tamanho em disco) e, para cada modo de busca, a latência p50/p99 por consulta e o
+  recall@k contra a busca exata em float32.
+- Grava o resultado em JSON; com `--baseline` compara com uma execução anterior e aponta
+  regressões de latência ou recall.
+
+Roda offline: os embeddings vêm de um backend determinístico local (`HashingEmbedder`,
+soma de vetores aleatórios fixos por token), registrado no `embedding_backend` no lugar
+do Gemini. Documentos e queries usam o mesmo vocabulário sintético, então o vizinho mais
+próximo de uma query é o documento de onde seus tokens foram sorteados.
+
+Uso:
+    python scripts/benchmark_rag.py --sizes 10000,100000 --queries 200
+    python scripts/benchmark_rag.py --baseline memoria/benchmarks/rag_anterior.json --fail-on-regression
+
+Notas:
+- 1M vetores com `--dim 768` (dimensão do embedding-001) precisam de ~3 GB só para o
+  float32; o padrão `--dim 256` mantém o índice de 1M em ~1 GB.
+- As latências incluem o embedding (local) e a montagem das evidências; o cache de
+  embeddings de queries e o cache semântico ficam desligados.
+"""
+
+import os
+import gc
+import sys
+import copy
+import json
+import time
+import zlib
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+BASE = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE))  # Adicionar diretório raiz ao path
+
+import embedding_backend
+import embedding_cache
+import vector_store
+import ann_index
+import bm25_index
+import partition_index
+import chunk_store
+import rag_agent
+
+try:
+    import psutil
+except Exception:
+    psutil = None
+
+BENCH_MODEL = 'bench/hashing'
+DEFAULT_SIZES = '10000,100000,1000000'
+TOKENS_PER_DOC = 24
+TOKENS_PER_QUERY = 6
+TOPIC_WORDS = 64
+# Fração dos tokens de cada documento sorteada das palavras do tópico
+TOPIC_FRACTION = 0.7
+EMBED_CHUNK = 8192
+SOURCES = ('pdf', 'firestore', 'local_prova')
+SOURCE_WEIGHTS = (0.8, 0.15, 0.05)
+ESPECIALIDADES = ('clinica medica', 'cirurgia', 'pediatria', 'ginecologia e obstetricia', 'medicina preventiva')
+FILTER = {'source': 'pdf'}
+
+
+class HashingEmbedder(embedding_backend.EmbeddingBackend):
+    """Embedding determinístico sem rede: soma de um vetor aleatório fixo por token."""
+
+    name = 'hashing'
+
+    def __init__(self, model: str, dim: int, seed: int = 0):
+        super().__init__(model)
+        self.dim = int(dim)
+        self.seed = int(seed)
+        self._vectors: Dict[str, np.ndarray] = {}
+
+    def token_vector(self, token: str) -> np.ndarray:
+        vec = self._vectors.get(token)
+        if vec is None:
+            rng = np.random.default_rng((self.seed, zlib.crc32(token.encode('utf-8'))))
+            vec = rng.standard_normal(self.dim).astype(np.float32)
+            self._vectors[token] = vec
+        return vec
+
+    def table(self, words: Sequence[str]) -> np.ndarray:
+        return np.vstack([self.token_vector(w) for w in words])
+
+    def embed(self, texts: Sequence[str], timeout: Optional[float] = None) -> np.ndarray:
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for token in bm25_index.tokenize(text):
+                out[i] += self.token_vector(token)
+        return out
+
+    def describe(self) -> dict:
+        return {**super().describe(), 'dim': self.dim, 'key_slot': None}
+
+
+def _rss_mb() -> Optional[float]:
+    if psutil is None:
+        return None
+    return round(psutil.Process().memory_info().rss / 2**20, 1)
+
+
+def _disk_mb(vdir: Path) -> dict:
+    sizes = {p.name: round(p.stat().st_size / 2**20, 2) for p in sorted(vdir.iterdir()) if p.is_file()}
+    return {'total': round(sum(sizes.values()), 2), 'files': sizes}
+
+
+def build_corpus(vdir: Path, n_rows: int, embedder: HashingEmbedder, vocab: int, seed: int, quantize: str):
+    """Gera o corpus sintético e grava o índice em `vdir`; retorna (tokens, sources)."""
+    rng = np.random.default_rng(seed)
+    words = [f"t{i}" for i in range(vocab)]
+    n_topics = max(16, int(np.sqrt(n_rows)))
+    topic_words = rng.integers(0, vocab, size=(n_topics, TOPIC_WORDS))
+    topics = rng.integers(0, n_topics, size=n_rows)
+    from_topic = rng.random((n_rows, TOKENS_PER_DOC)) < TOPIC_FRACTION
+    tokens = np.where(
+        from_topic,
+        topic_words[topics[:, None], rng.integers(0, TOPIC_WORDS, size=(n_rows, TOKENS_PER_DOC))],
+        rng.integers(0, vocab, size=(n_rows, TOKENS_PER_DOC)),
+    ).astype(np.int32)
+    sources = rng.choice(len(SOURCES), size=n_rows, p=SOURCE_WEIGHTS)
+
+    # mesmos vetores que o embedder usa nas queries: soma dos vetores dos tokens
+    table = embedder.table(words)
+    embeddings = np.empty((n_rows, embedder.dim), dtype=np.float32)
+    for start in range(0, n_rows, EMBED_CHUNK):
+        embeddings[start:start + EMBED_CHUNK] = table[tokens[start:start + EMBED_CHUNK]].sum(axis=1)
+    del table
+
+    vector_store.save_embeddings(vdir, embeddings)
+    del embeddings
+    saved = vector_store.load_embeddings(vdir, {'vector_format': vector_store.VECTOR_FORMAT})
+    ann_cfg = ann_index.build_for(vdir, saved, mode='on')
+    quant_cfg = vector_store.save_quantized(vdir, saved, quantize)
+    del saved
+
+    texts = [' '.join(words[t] for t in row) for row in tokens]
+    metadatas = [
+        {
+            'id': f"bench::{i}",
+            'meta': {'source': SOURCES[sources[i]], 'especialidade': ESPECIALIDADES[topics[i] % len(ESPECIALIDADES)]},
+            'text_preview': texts[i][:500],
+        }
+        for i in range(n_rows)
+    ]
+    bm25_cfg = bm25_index.build_for(vdir, texts)
+    partitions_cfg = partition_index.build_for(vdir, metadatas)
+    chunks_cfg = chunk_store.write_store(vdir, texts)
+    del texts
+
+    with open(vdir / 'metadata.jsonl', 'w', encoding='utf-8') as f:
+        for md in metadatas:
+            f.write(json.dumps(md, ensure_ascii=False) + "\n")
+    chunk_store.write_metadata_offsets(vdir)
+    with open(vdir / 'id_map.json', 'w', encoding='utf-8') as f:
+        json.dump({str(i): md['id'] for i, md in enumerate(metadatas)}, f)
+    del metadatas
+
+    with open(vdir / 'config.json', 'w', encoding='utf-8') as f:
+        json.dump({'model': BENCH_MODEL, 'indexed_at': datetime.utcnow().isoformat(), 'items_count': n_rows,
+                   'embeddings_file': vector_store.EMBEDDINGS_FILE, 'vector_format': vector_store.VECTOR_FORMAT,
+                   'quantization': quant_cfg, 'ann': ann_cfg, 'bm25': bm25_cfg, 'partitions': partitions_cfg,
+                   'chunk_store': chunks_cfg}, f, ensure_ascii=False)
+    return tokens, sources
+
+
+def make_queries(tokens: np.ndarray, n_queries: int, seed: int) -> List[str]:
+    """Queries com alguns tokens de documentos sorteados (o documento de origem é o alvo)."""
+    rng = np.random.default_rng(seed + 1)
+    rows = rng.choice(tokens.shape[0], size=min(n_queries, tokens.shape[0]), replace=False)
+    queries = []
+    for row in rows:
+        picked = rng.choice(TOKENS_PER_DOC, size=TOKENS_PER_QUERY, replace=False)
+        queries.append(' '.join(f"t{t}" for t in tokens[row, picked]))
+    return queries
+
+
+def exact_top_k(q_embs: np.ndarray, embeddings: np.ndarray, k: int, rows: Optional[np.ndarray] = None) -> List[np.ndarray]:
+    """Verdade de referência: top-k exato em float32 (opcionalmente só entre `rows`)."""
+    truth = []
+    for start in range(0, q_embs.shape[0], 64):
+        q = vector_store.normalize_rows(q_embs[start:start + 64])
+        if rows is None:
+            sims = vector_store.dense_scores_batch(q, embeddings)
+            truth.extend(vector_store.top_k(s, k)[0] for s in sims)
+        else:
+            sims = vector_store.dense_scores_batch(q, np.asarray(embeddings[rows], dtype=np.float32))
+            truth.extend(rows[vector_store.top_k(s, k)[0]] for s in sims)
+    return truth
+
+
+def _percentile_ms(latencies: np.ndarray, p: float) -> float:
+    return round(float(np.percentile(latencies, p)) * 1000, 3)
+
+
+def run_mode(loop, gen, queries: List[str], truth: List[np.ndarray], k: int, warmup: int, **body_kwargs) -> dict:
+    """Executa as queries uma a uma em `gen` e mede latência, recall@k e fallbacks."""
+    rag_agent._current = gen
+    expected = body_kwargs.get('mode', 'dense')
+    bodies = [rag_agent.RAGQuery(query=q, top_k=k, use_cache=False, **body_kwargs) for q in queries]
+    for body in bodies[:warmup]:
+        loop.run_until_complete(rag_agent.retrieve_many([body]))
+
+    latencies = np.empty(len(bodies), dtype=np.float64)
+    recalls = np.empty(len(bodies), dtype=np.float64)
+    fallbacks = 0
+    for i, body in enumerate(bodies):
+        t0 = time.perf_counter()
+        resp = loop.run_until_complete(rag_agent.retrieve_many([body]))[0]
+        latencies[i] = time.perf_counter() - t0
+        got = [item['index'] for item in resp['evidence']]
+        recalls[i] = len(set(got) & set(int(r) for r in truth[i])) / max(len(truth[i]), 1)
+        if resp['retrieval_mode'] != expected:
+            fallbacks += 1
+    return {
+        'p50_ms': _percentile_ms(latencies, 50),
+        'p99_ms': _percentile_ms(latencies, 99),
+        'mean_ms': round(float(latencies.mean()) * 1000, 3),
+        'max_ms': round(float(latencies.max()) * 1000, 3),
+        'qps': round(len(bodies) / float(latencies.sum()), 1),
+        'recall_at_k': round(float(recalls.mean()), 4),
+        'fallbacks': fallbacks,
+    }
+
+
+def bench_size(n_rows: int, args, work_dir: Path, loop) -> dict:
+    vdir = work_dir / f"rows_{n_rows}"
+    vdir.mkdir(parents=True, exist_ok=True)
+    embedder = HashingEmbedder(BENCH_MODEL, args.dim, seed=args.seed)
+    embedding_backend.register_backend(BENCH_MODEL, embedder)
+
+    print(f"\n🧪 Corpus sintético: {n_rows} vetores (d={args.dim})")
+    t0 = time.perf_counter()
+    tokens, sources = build_corpus(vdir, n_rows, embedder, args.vocab, args.seed, args.quantize)
+    build_seconds = time.perf_counter() - t0
+    queries = make_queries(tokens, args.queries, args.seed)
+    del tokens
+    gc.collect()
+
+    rag_agent._current = None
+    rss_before = _rss_mb()
+    t0 = time.perf_counter()
+    rag_agent.reload_index(vdir, force=True)
+    load_seconds = time.perf_counter() - t0
+    rss_after_load = _rss_mb()
+    base = rag_agent._current
+
+    q_embs = embedder.embed(queries)
+    truth = exact_top_k(q_embs, base.embeddings, args.k)
+    pdf_rows = np.flatnonzero(sources == SOURCES.index(FILTER['source']))
+    truth_filtered = exact_top_k(q_embs, base.embeddings, args.k, rows=pdf_rows)
+
+    def variant(ann=False, quant=False):
+        gen = copy.copy(base)
+        gen.ann = base.ann if ann else None
+        gen.quant = base.quant if quant else None
+        return gen
+
+    # (nome, geração, parâmetros da consulta, verdade de referência)
+    modes = [('dense_exact', variant(), {}, truth)]
+    if base.quant is not None:
+        modes.append((f"dense_{base.quant.kind}", variant(quant=True), {}, truth))
+    if base.ann is not None:
+        modes.append(('dense_ann', variant(ann=True), {'nprobe': args.nprobe or None}, truth))
+        if base.quant is not None:
+            modes.append((f"dense_ann_{base.quant.kind}", variant(ann=True, quant=True), {'nprobe': args.nprobe or None}, truth))
+    modes.append(('lexical', variant(), {'mode': 'lexical'}, truth))
+    modes.append(('hybrid', variant(), {'mode': 'hybrid'}, truth))
+    modes.append(('dense_filtered', variant(), {'filter': FILTER}, truth_filtered))
+
+    results = {}
+    for name, gen, kwargs, mode_truth in modes:
+        results[name] = run_mode(loop, gen, queries, mode_truth, args.k, args.warmup, **kwargs)
+        r = results[name]
+        print(f"  {name:<18} p50={r['p50_ms']:.2f}ms p99={r['p99_ms']:.2f}ms recall@{args.k}={r['recall_at_k']:.3f}")
+
+    entry = {
+        'rows': n_rows,
+        'build_seconds': round(build_seconds, 3),
+        'load_seconds': round(load_seconds, 4),
+        'memory_mb': {'rss_before_load': rss_before, 'rss_after_load': rss_after_load, 'rss_after_queries': _rss_mb()},
+        'disk_mb': _disk_mb(vdir),
+        'ann': (base.config or {}).get('ann'),
+        'modes': results,
+    }
+
+    rag_agent._current = None
+    for res in (base.chunks, base.metadata):
+        if res is not None:
+            res.close()
+    del base, modes, q_embs, truth, truth_filtered
+    gc.collect()
+    if not args.keep:
+        shutil.rmtree(vdir, ignore_errors=True)
+    return entry
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Regressões em relação a uma execução anterior (latência acima da tolerância ou recall menor)."""
+    regressions = []
+    old_by_rows = {r['rows']: r for r in baseline.get('results', [])}
+    for entry in report['results']:
+        old = old_by_rows.get(entry['rows'])
+        if old is None:
+            continue
+        for name, cur in entry['modes'].items():
+            prev = old.get('modes', {}).get(name)
+            if prev is None:
+                continue
+            for metric in ('p50_ms', 'p99_ms'):
+                if prev[metric] > 0 and cur[metric] > prev[metric] * (1 + tolerance):
+                    regressions.append(f"{entry['rows']} {name} {metric}: {prev[metric]} -> {cur[metric]}")
+            if cur['recall_at_k'] < prev['recall_at_k'] - 0.01:
+                regressions.append(f"{entry['rows']} {name} recall_at_k: {prev['recall_at_k']} -> {cur['recall_at_k']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de latência e recall do RAG em corpora sintéticos (offline)')
+    parser.add_argument('--sizes', type=str, default=DEFAULT_SIZES, help='Tamanhos dos corpora, separados por vírgula')
+    parser.add_argument('--dim', type=int, default=256, help='Dimensão dos embeddings sintéticos')
+    parser.add_argument('--queries', type=int, default=200, help='Consultas medidas por modo')
+    parser.add_argument('--warmup', type=int, default=10, help='Consultas de aquecimento por modo (não medidas)')
+    parser.add_argument('--k', type=int, default=10, help='top_k das consultas (recall@k)')
+    parser.add_argument('--vocab', type=int, default=20000, help='Tamanho do vocabulário sintético')
+    parser.add_argument('--nprobe', type=int, default=0, help='nprobe do IVF (0 = valor do config.json)')
+    parser.add_argument('--quantize', choices=['none', 'int8', 'float16'], default='int8', help='Cópia compacta medida nos modos dense_<tipo>')
+    parser.add_argument('--seed', type=int, default=0, help='Semente do corpus e das queries')
+    parser.add_argument('--work-dir', type=str, default=None, help='Onde gravar os índices (padrão: diretório temporário)')
+    parser.add_argument('--keep', action='store_true', help='Manter os índices gerados')
+    parser.add_argument('--output', type=str, default=None, help='Arquivo JSON de saída (padrão: memoria/benchmarks/rag_<data>.json)')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON de uma execução anterior para comparar')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Aumento relativo de latência tolerado na comparação')
+    parser.add_argument('--fail-on-regression', action='store_true', help='Sair com código 1 se houver regressão em relação ao baseline')
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(',') if s.strip()]
+    work_dir = Path(args.work_dir) if args.work_dir else Path(tempfile.mkdtemp(prefix='rag_bench_'))
+    work_dir.mkdir(parents=True, exist_ok=True)
+
+    # sem cache de embeddings de queries (nem SQLite em memoria/vectors) e sem cache semântico
+    rag_agent.QUERY_EMBEDDING_CACHE = embedding_cache.QueryEmbeddingCache(None, max_memory_items=0, max_disk_items=0)
+    loop = asyncio.new_event_loop()
+    report = {
+        'benchmark': 'rag_retrieval',
+        'created_at': datetime.utcnow().isoformat(),
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'params': {k: getattr(args, k) for k in ('dim', 'queries', 'warmup', 'k', 'vocab', 'nprobe', 'quantize', 'seed')},
+        'results': [],
+    }
+    try:
+        for n_rows in sizes:
+            report['results'].append(bench_size(n_rows, args, work_dir, loop))
+    finally:
+        loop.close()
+        if not args.keep and not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    out = Path(args.output) if args.output else BASE / 'memoria' / 'benchmarks' / f"rag_{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    with open(out, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n✅ Resultados salvos em: {out}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print("⚠️ Regressões em relação ao baseline:")
+            for line in regressions:
+                print(f"  - {line}")
+            if args.fail_on_regression:
+                sys.exit(1)
+        else:
+            print("✅ Sem regressões em relação ao baseline")
+
+
+if __name__ == '__main__':
+    main()
@@ -3,23 +3,37 @@ Script de reindexação de embeddings para o repositório.
 
 O que faz:
 - Lê `memoria/vectors/metadata.jsonl` para obter documentos e textos.
-- Gera embeddings usando a API configurada por `gemini_client` + `google.generativeai` (tenta vários métodos públicos).
-- Salva `embeddings.npy`, `id_map.json` e `config.json` em `memoria/vectors/`.
+- Gera embeddings pelo backend compartilhado com o RAG (`embedding_backend`, chaves via `gemini_client`),
+  em lotes distribuídos entre todas as chaves configuradas (`EmbeddingScheduler`: limite de taxa
+  por chave, backoff em 429 e vários lotes em andamento). Textos já embedados com o mesmo modelo
+  vêm do cache por conteúdo (`embedding_cache.ContentEmbeddingCache`), sem chamar a API.
+- Grava os lotes já embedados em checkpoints (`memoria/vectors/.reindex`: segmentos append-only
+  + diário); se a execução cair (quota, rede, Ctrl+C), `--resume` continua do último checkpoint.
+- Regrava o índice em `memoria/vectors/` pelo `index_writer.IndexWriter` (`embeddings.npy`,
+  `metadata.jsonl`, `id_map.json`, chunk store, BM25, partições e `config.json`, na mesma ordem).
+  Com `--incremental`, os documentos novos viram um segmento anexado (`segment_index`), sem
+  regravar as linhas existentes.
 - Faz backup do `embeddings.npy` anterior.
 
 Uso:
-    python scripts/reindex_vectors.py --model models/text-embedding-004 --batch 16
+    python scripts/reindex_vectors.py --model models/text-embedding-004 --batch 32 --max-in-flight 8
+    python scripts/reindex_vectors.py --model models/text-embedding-004 --resume
 
 Notas:
 - Requer chaves configuradas nas variáveis de ambiente (KEY_SLOTS no `gemini_client`).
-- Se preferir outro provedor, modifique a função `generate_embedding`.
+- Sem API: `--model local` ajusta o backend local (hashing + TF-IDF + SVD, na CPU) nos textos
+  a indexar; com `--incremental` reaproveita o modelo local do índice atual.
+- Se preferir outro provedor, implemente um `EmbeddingBackend` em `embedding_backend.py`.
 """
 
 import os
 import json
 import time
+import shutil
+import hashlib
 import argparse
 from pathlib import Path
+from typing import Optional
 import numpy as np
 
 BASE = Path(__file__).resolve().parent.parent
@@ -28,38 +42,61 @@ METADATA_FILE = VECTORS_DIR / 'metadata.jsonl'
 EMB_FILE = VECTORS_DIR / 'embeddings.npy'
 ID_MAP_FILE = VECTORS_DIR / 'id_map.json'
 CFG_FILE = VECTORS_DIR / 'config.json'
+# checkpoints da reindexação em andamento (segmentos + diário)
+WORK_DIR = VECTORS_DIR / '.reindex'
 
-# Try to import clients
-try:
-    import sys
-    sys.path.insert(0, str(BASE))  # Adicionar diretório raiz ao path
-    from gemini_client import configure_first_available
-except Exception as e:
-    print(f"⚠️ Falha ao importar gemini_client: {e}")
-    configure_first_available = None
+import sys
+sys.path.insert(0, str(BASE))  # Adicionar diretório raiz ao path
 
-try:
-    import google.generativeai as genai
-except Exception:
-    genai = None
+import embedding_backend
+import embedding_cache
+import vector_store
+import chunk_store
+import index_writer
+import segment_index
 
 
 def load_metadata():
+    """Documentos da base e dos segmentos anexados (`segment_index`), na ordem das linhas
+    (base primeiro, depois os segmentos do mais antigo ao mais novo).
+
+    Linhas marcadas em `tombstones.npy` (fontes alteradas/removidas) ficam de fora: o
+    índice regravado não as traz de volta.
+    Retorna triplas (registro do metadata.jsonl, texto completo do chunk store ou None,
+    (diretório da parte, linha na parte)).
+    """
     docs = []
-    if not METADATA_FILE.exists():
-        print(f"Arquivo de metadata não encontrado: {METADATA_FILE}")
-        return docs
-    with open(METADATA_FILE, 'r', encoding='utf-8') as f:
-        for i, line in enumerate(f):
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                obj = json.loads(line)
-                docs.append(obj)
-            except Exception as e:
-                print(f"⚠️ Falha ao ler linha {i} do metadata.jsonl: {e}")
-    print(f"📚 Carregados {len(docs)} documentos do metadata.jsonl")
+    skipped = 0
+    parts = segment_index.part_dirs(VECTORS_DIR) or [VECTORS_DIR]
+    for part in parts:
+        meta_file = part / 'metadata.jsonl'
+        if not meta_file.exists():
+            print(f"Arquivo de metadata não encontrado: {meta_file}")
+            continue
+        tombstones = vector_store.load_tombstones(part)
+        dead = set(tombstones.tolist()) if tombstones is not None else set()
+        store = chunk_store.ChunkStore.load(part)
+        try:
+            with open(meta_file, 'r', encoding='utf-8') as f:
+                row = 0
+                for i, line in enumerate(f):
+                    line = line.strip()
+                    if not line:
+                        continue
+                    if row in dead:
+                        skipped += 1
+                        row += 1
+                        continue
+                    try:
+                        obj = json.loads(line)
+                        docs.append((obj, store.get(row) if store is not None else None, (part, row)))
+                    except Exception as e:
+                        print(f"⚠️ Falha ao ler linha {i} de {meta_file}: {e}")
+                    row += 1
+        finally:
+            if store is not None:
+                store.close()
+    print(f"📚 Carregados {len(docs)} documentos do metadata.jsonl ({len(parts)} partes, {skipped} linhas removidas ignoradas)")
     return docs
 
 
@@ -86,142 +123,28 @@ def extract_text_from_meta(md):
     return ''
 
 
-def configure_api():
-    used = None
-    if configure_first_available:
-        try:
-            used = configure_first_available()
-            print(f"🔑 Chave configurada via gemini_client: {used}")
-        except Exception as e:
-            print(f"⚠️ gemini_client.configure_first_available falhou: {e}")
-    else:
-        print("ℹ️ gemini_client não disponível; tentativa de usar google.generativeai diretamente se instalado.")
-        # tentar configurar genai diretamente a partir de variáveis de ambiente comuns
-        try:
-            if genai is None:
-                print("⚠️ google.generativeai não encontrado no ambiente (não instalado).")
-                # listar possíveis variáveis de ambiente que podem conter chaves para ajudar o diagnóstico
-                candidates = ['GEMINI_API_KEY_4'] + [f'GEMINI_API_KEY_{i}' for i in range(1,9) if i != 4] + ['GOOGLE_API_KEY', 'OPENAI_API_KEY']
-                found = [k for k in candidates if os.getenv(k)]
-                if found:
-                    print(f"ℹ️ Variáveis de ambiente potencialmente presentes: {found}")
-                else:
-                    print("ℹ️ Nenhuma variável de ambiente de chave encontrada entre opções comuns.")
-                return None
-            # se genai instalado, tentar configurar com a primeira variável de ambiente disponível
-            candidates = ['GEMINI_API_KEY_4'] + [f'GEMINI_API_KEY_{i}' for i in range(1,9) if i != 4] + ['GOOGLE_API_KEY', 'OPENAI_API_KEY']
-            for var in candidates:
-                val = os.getenv(var)
-                if not val:
-                    continue
-                try:
-                    if hasattr(genai, 'configure'):
-                        getattr(genai, 'configure')(api_key=val)
-                        print(f"🔑 Chave configurada via variável de ambiente: {var}")
-                        return var
-                except Exception as e:
-                    print(f"⚠️ Falha ao configurar genai com {var}: {e}")
-                    continue
-        except Exception as e:
-            print(f"⚠️ Erro ao tentar configurar google.generativeai diretamente: {e}")
+def configure_api(model_name=None):
+    """Resolve o backend de embeddings compartilhado (`embedding_backend`). Retorna o slot usado."""
+    try:
+        backend = embedding_backend.get_backend(model_name, strict=True)
+    except embedding_backend.EmbeddingError as e:
+        print(f"⚠️ Backend de embeddings indisponível: {e}")
+        return None
+    used = getattr(backend, 'key_slot', None)
+    print(f"🔑 Chave configurada via gemini_client: {used}")
     return used
 
 
 def generate_embedding_text(text, model_name=None):
     """Gera embedding para um texto. Retorna numpy array ou None."""
-    # Tenta funções comuns do genai na ordem
-    if genai is None:
+    backend = embedding_backend.get_backend(model_name)
+    if backend is None:
         return None
-    
-    # 1) Tentativa principal: genai.embed_content (sabemos que funciona)
-    try:
-        # Usar getattr para evitar warning do linter sobre função não exportada
-        embed_fn = getattr(genai, 'embed_content', None)
-        if embed_fn:
-            resp = embed_fn(model=model_name, content=text)
-            if isinstance(resp, dict) and 'embedding' in resp:
-                emb = resp['embedding']
-                arr = np.array(emb, dtype=float)
-                return arr
-    except Exception as e:
-        print(f"ℹ️ tentativa via genai.embed_content falhou: {e}")
-
-    # 2) Tentativa alternativa: genai.embeddings.create
     try:
-        emb_mod = getattr(genai, 'embeddings', None)
-        if emb_mod:
-            # muitos SDKs aceitam embeddings.create(model=..., input=[...])
-            if hasattr(emb_mod, 'create'):
-                try:
-                    resp = emb_mod.create(model=model_name, input=[text])
-                except TypeError:
-                    try:
-                        resp = emb_mod.create(input=[text], model=model_name)
-                    except Exception:
-                        resp = emb_mod.create(text)
-                # extrair embedding da resposta
-                emb = None
-                # resposta pode ser um dict com 'data'
-                if isinstance(resp, dict):
-                    if 'data' in resp and resp['data']:
-                        first = resp['data'][0]
-                        if isinstance(first, dict):
-                            emb = first.get('embedding') or first.get('embeddings')
-                elif hasattr(resp, 'data'):
-                    try:
-                        first = resp.data[0]
-                        if hasattr(first, 'embedding'):
-                            emb = getattr(first, 'embedding')
-                    except Exception:
-                        pass
-                if emb is not None:
-                    arr = np.array(emb, dtype=float)
-                    return arr
-    except Exception as e:
-        print(f"ℹ️ tentativa via genai.embeddings.create falhou: {e}")
-
-    # 3) Tentativas por nomes de função antigos/comuns
-    fn_names = ['get_embeddings', 'get_embedding', 'embed_text', 'embed', 'embeddings']
-    for name in fn_names:
-        fn = getattr(genai, name, None)
-        if not fn:
-            continue
-        try:
-            # algumas APIs aceitam lista de inputs; aqui enviamos single
-            try:
-                resp = fn(model=model_name, input=text)
-            except TypeError:
-                # fallback argumentos alternativos
-                try:
-                    resp = fn(text, model=model_name)
-                except Exception:
-                    resp = fn(text)
-            # extrair embedding
-            emb = None
-            if isinstance(resp, dict):
-                if 'data' in resp and resp['data']:
-                    first = resp['data'][0]
-                    emb = first.get('embedding') if isinstance(first, dict) else None
-                elif 'embedding' in resp:
-                    emb = resp.get('embedding')
-            elif hasattr(resp, 'embedding'):
-                emb = getattr(resp, 'embedding')
-            else:
-                # última tentativa: converter diretamente
-                try:
-                    arr = np.array(resp, dtype=float)
-                    if arr.ndim == 1:
-                        emb = arr.tolist()
-                except Exception:
-                    emb = None
-            if emb is not None:
-                arr = np.array(emb, dtype=float)
-                return arr
-        except Exception as e:
-            # tentar próxima função
-            print(f"ℹ️ tentativa de {name} falhou: {e}")
-            continue
-    return None
+        return backend.embed_one(text)
+    except embedding_backend.EmbeddingError as e:
+        print(f"ℹ️ tentativa via embedding_backend falhou: {e}")
+        return None
 
 
 def check_api_available(model_name=None, sample_text="teste de disponibilidade"):
@@ -229,7 +152,7 @@ def check_api_available(model_name=None, sample_text="teste de disponibilidade")
     Retorna (ok: bool, info: str).
     """
     try:
-        used = configure_api()
+        used = configure_api(model_name)
         emb = generate_embedding_text(sample_text, model_name=model_name)
         if emb is None:
             return False, "Nenhuma resposta de embedding retornada (verifique chaves/quota)."
@@ -240,148 +163,380 @@ def check_api_available(model_name=None, sample_text="teste de disponibilidade")
         return False, str(e)
 
 
+def build_scheduler(args):
+    """Escalonador que espalha os lotes entre as chaves de `gemini_client.KEY_SLOTS`."""
+    slots = [k.strip() for k in args.keys.split(',') if k.strip()] if args.keys else None
+    rate = args.rate_per_key
+    if not rate:
+        # --sleep-between (legado) vira a taxa por chave
+        rate = 1.0 / args.sleep_between if args.sleep_between > 0 else embedding_backend.EMBED_RATE_PER_KEY
+    if embedding_backend.is_local_model(args.model):
+        # sem API: um único "slot", sem limite de taxa nem cache
+        backend = embedding_backend.get_backend(args.model, strict=True)
+        return embedding_backend.EmbeddingScheduler(args.model, backends=[('local', backend)], rate_per_key=1e6, max_in_flight=1)
+    cache = None if args.no_embed_cache else embedding_cache.content_cache()
+    return embedding_backend.EmbeddingScheduler(args.model, slots=slots, rate_per_key=rate, max_in_flight=args.max_in_flight, cache=cache)
+
+
+def current_model() -> Optional[str]:
+    """Modelo de embeddings do índice atual (config.json da base), ou None."""
+    if not CFG_FILE.exists():
+        return None
+    with open(CFG_FILE, 'r', encoding='utf-8') as f:
+        return json.load(f).get('model')
+
+
+def resolve_local_model(args, to_index):
+    """`--model local`: no modo incremental, o modelo local do índice atual; senão ajusta um
+    modelo novo nos textos a indexar. Retorna o nome (`local/...`) ou None."""
+    if args.incremental:
+        current = current_model()
+        if embedding_backend.is_local_model(current):
+            return current
+        print(f"❌ O índice atual foi gerado com {current}; rode um reindex completo com --model local")
+        return None
+    try:
+        return embedding_backend.fit_local_backend([txt for _, txt in to_index]).model
+    except embedding_backend.EmbeddingError as e:
+        print(f"❌ Falha ao ajustar o modelo local: {e}")
+        return None
+
+
 def backup_existing():
     if EMB_FILE.exists():
         ts = int(time.time())
         target = VECTORS_DIR / f"embeddings_backup_{ts}.npy"
         try:
-            EMB_FILE.replace(target)
+            # link (ou cópia): o índice atual continua no lugar até o novo ser publicado
+            try:
+                os.link(EMB_FILE, target)
+            except OSError:
+                shutil.copy2(EMB_FILE, target)
             print(f"🔁 Backup criado: {target}")
         except Exception as e:
             print(f"⚠️ Falha ao criar backup do embeddings: {e}")
 
 
+class ReindexCheckpoint:
+    """Segmentos append-only dos lotes já embedados + diário de progresso (`journal.jsonl`).
+
+    A cada `commit()` os vetores (normalizados) vão para `seg_NNNNN.npy` — arquivo temporário,
+    fsync e `os.replace` — e só então uma linha é anexada ao diário. Uma linha no diário é um
+    checkpoint confirmado: ao retomar (`--resume`), segmentos sem linha (execução interrompida
+    no meio da escrita) são descartados e a geração continua da posição `done`.
+
+    A primeira linha do diário identifica o plano (modelo + hash dos ids/textos a indexar);
+    se o metadata.jsonl mudou, o trabalho anterior não é reaproveitado.
+    """
+
+    def __init__(self, work_dir: Path):
+        self.work_dir = Path(work_dir)
+        self.journal = self.work_dir / 'journal.jsonl'
+        self.header = None
+        self.entries = []
+
+    @property
+    def done(self) -> int:
+        return self.entries[-1]['end'] if self.entries else 0
+
+    def _read_journal(self):
+        header, entries = None, []
+        if not self.journal.exists():
+            return header, entries
+        with open(self.journal, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except json.JSONDecodeError:
+                    # linha incompleta no fim (interrupção durante a escrita)
+                    break
+                if rec.get('type') == 'header':
+                    header = rec
+                elif rec.get('type') == 'segment':
+                    if not (self.work_dir / rec['file']).exists():
+                        break
+                    entries.append(rec)
+        return header, entries
+
+    def pending_info(self):
+        """(feito, total) de uma reindexação interrompida, ou None."""
+        header, entries = self._read_journal()
+        if header is None:
+            return None
+        return (entries[-1]['end'] if entries else 0), header.get('total')
+
+    def start(self, model: str, plan: str, total: int):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        self.work_dir.mkdir(parents=True)
+        self.header = {'type': 'header', 'model': model, 'plan': plan, 'total': total, 'started_at': int(time.time())}
+        self.entries = []
+        self._append(self.header)
+
+    def resume(self, model: str, plan: str, total: int) -> bool:
+        """Carrega os checkpoints confirmados; False se não houver trabalho compatível."""
+        header, entries = self._read_journal()
+        if header is None or header.get('model') != model or header.get('plan') != plan or header.get('total') != total:
+            return False
+        self.header, self.entries = header, entries
+        # reescreve o diário só com as linhas válidas e remove segmentos órfãos
+        tmp = self.journal.with_name(self.journal.name + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for rec in [header] + entries:
+                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.journal)
+        keep = {rec['file'] for rec in entries}
+        for seg in self.work_dir.glob('seg_*.npy*'):
+            if seg.name not in keep:
+                seg.unlink()
+        return True
+
+    def commit(self, vectors: np.ndarray, start: int, end: int):
+        name = f"seg_{len(self.entries):05d}.npy"
+        tmp = self.work_dir / (name + '.tmp')
+        with open(tmp, 'wb') as f:
+            np.save(f, vector_store.normalize_rows(vectors))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.work_dir / name)
+        entry = {'type': 'segment', 'file': name, 'start': start, 'end': end, 'rows': int(vectors.shape[0]), 'committed_at': int(time.time())}
+        self._append(entry)
+        self.entries.append(entry)
+
+    def _append(self, rec: dict):
+        with open(self.journal, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def segments(self):
+        """(início, fim, vetores em memmap) de cada checkpoint, em ordem."""
+        for rec in self.entries:
+            yield rec['start'], rec['end'], np.load(str(self.work_dir / rec['file']), mmap_mode='r')
+
+    def clear(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+def plan_hash(model: str, to_index) -> str:
+    h = hashlib.sha256(model.encode('utf-8'))
+    for doc_id, txt in to_index:
+        h.update(b'\0' + str(doc_id).encode('utf-8') + b'\0' + txt.encode('utf-8'))
+    return h.hexdigest()
+
+
+def write_checkpoints(writer: index_writer.IndexWriter, ckpt: ReindexCheckpoint, to_index, texts_by_id, meta_by_id, args,
+                      dim: Optional[int] = None, carry=()) -> dict:
+    """Grava os vetores dos checkpoints pelo `writer`, com textos e metadados de cada id, e
+    publica o índice. Com `dim`, recusa vetores de outra dimensão. `carry` ([(id, (parte,
+    linha))]) são linhas sem texto cujo vetor atual é copiado. Retorna o config."""
+    try:
+        for start, end, arr in ckpt.segments():
+            if dim is not None and arr.shape[1] != dim:
+                raise ValueError(f"Dimensão incompatível: índice atual d={dim}, novos d={arr.shape[1]}. Reindex completo necessário.")
+            ids = [to_index[i][0] for i in range(start, end)]
+            metas = [(meta_by_id.get(doc_id) or {}).get('meta') for doc_id in ids]
+            writer.add(ids, [texts_by_id.get(doc_id, '') for doc_id in ids], metas, np.asarray(arr, dtype=np.float32))
+        by_part = {}
+        for doc_id, (part, row) in carry:
+            by_part.setdefault(part, []).append((doc_id, row))
+        for part, items in by_part.items():
+            # lido antes da publicação, que substitui o embeddings.npy da base
+            emb = np.load(str(part / 'embeddings.npy'), mmap_mode='r')
+            ids = [doc_id for doc_id, _ in items]
+            vectors = np.asarray(emb[[row for _, row in items]], dtype=np.float32)
+            del emb
+            writer.add(ids, [texts_by_id.get(doc_id, '') for doc_id in ids],
+                       [(meta_by_id.get(doc_id) or {}).get('meta') for doc_id in ids], vectors)
+        return writer.finalize(ann=args.ann, ann_lists=args.ann_lists or None, quantize=args.quantize)
+    except BaseException:
+        writer.abort()
+        raise
+
+
+def append_segment(ckpt: ReindexCheckpoint, to_index, texts_by_id, meta_by_id, args):
+    """Modo incremental: os documentos novos viram um segmento anexado ao índice atual
+    (`segment_index`), sem regravar as linhas existentes. Retorna o config do segmento.
+
+    Recusa um modelo diferente do índice atual, mesmo com a mesma dimensão (p.ex.
+    embedding-001 e text-embedding-004, ambos d=768): os espaços não são comparáveis."""
+    if current_model() != args.model:
+        raise ValueError(f"Modelo incompatível: índice atual gerado com {current_model()}, não {args.model}. Reindex completo necessário.")
+    base_dim = int(np.load(str(EMB_FILE), mmap_mode='r').shape[1])
+    writer = index_writer.IndexWriter.append(VECTORS_DIR, args.model)
+    return write_checkpoints(writer, ckpt, to_index, texts_by_id, meta_by_id, args, dim=base_dim)
+
+
 def main(args):
     docs = load_metadata()
     if not docs:
         print("❌ Nenhum documento para reindexar. Verifique memoria/vectors/metadata.jsonl")
         return
 
-    used_slot = configure_api()
-
     # Preparar lista de documentos a indexar (suporta incremental)
     existing_ids = []
     if args.incremental and ID_MAP_FILE.exists():
         try:
-            with open(ID_MAP_FILE, 'r', encoding='utf-8') as f:
-                j = json.load(f)
-                existing_ids = j.get('ids', []) if isinstance(j, dict) else j
+            existing_ids = [doc_id for part in segment_index.part_dirs(VECTORS_DIR) for doc_id in index_writer.read_ids(part)]
             print(f"ℹ️ Modo incremental: {len(existing_ids)} ids existentes carregados")
         except Exception as e:
             print(f"⚠️ Falha ao carregar id_map existente: {e}")
+    existing_set = set(existing_ids)
 
     to_index = []
-    for idx, md in enumerate(docs):
-        doc_id = md.get('id') or md.get('meta', {}).get('path') or md.get('meta', {}).get('id') or str(idx)
-        if args.incremental and doc_id in existing_ids:
+    failed = []
+    # textos por id, usados também no índice BM25 das linhas já existentes (modo incremental)
+    texts_by_id = {}
+    # metadados por id, usados nas partições (source/especialidade) na ordem das linhas
+    meta_by_id = {}
+    doc_ids = [md.get('id') or md.get('meta', {}).get('path') or md.get('meta', {}).get('id') or str(idx)
+               for idx, (md, _, _) in enumerate(docs)]
+    # mesmo id na base e num segmento anexado (fonte reingerida): vale a linha mais nova,
+    # que vem depois na ordem das partes
+    latest = {doc_id: idx for idx, doc_id in enumerate(doc_ids)}
+    # linhas sem texto para reembedar: no reindex completo, o vetor atual é mantido
+    carry = []
+    # full_text: texto completo de cada linha, se o índice atual tiver chunk store
+    for idx, (md, full_text, location) in enumerate(docs):
+        doc_id = doc_ids[idx]
+        if latest[doc_id] != idx:
+            continue
+        meta_by_id[doc_id] = md
+        if args.incremental and doc_id in existing_set:
+            texts_by_id[doc_id] = full_text or md.get('text') or md.get('text_preview') or ''
+            continue
+        txt = full_text or extract_text_from_meta(md)
+        texts_by_id[doc_id] = txt
+        if not txt:
+            print(f"⚠️ Documento {doc_id} tem texto vazio — pulando")
+            failed.append(doc_id)
+            carry.append((doc_id, location))
             continue
-        txt = extract_text_from_meta(md)
         to_index.append((doc_id, txt))
 
     if args.limit and args.limit > 0:
+        if not args.incremental:
+            # o reindex completo republica a base inteira só com o que foi embedado
+            print("❌ --limit só vale com --incremental: um reindex completo limitado substituiria o índice pelos documentos embedados")
+            return
         to_index = to_index[:args.limit]
 
     if not to_index:
         print("ℹ️ Nenhum documento novo para indexar (modo incremental ou limite aplicado). Saindo.")
         return
 
-    # Gerar embeddings iterativamente (batched simples)
-    embeddings = []
-    failed = []
-    total = len(to_index)
-    print(f"🚀 Iniciando geração de embeddings para {total} documentos (modelo={args.model})")
-    new_ids = []
-    for i, (doc_id, txt) in enumerate(to_index):
-        if not txt:
-            print(f"⚠️ Documento {doc_id} tem texto vazio — pulando")
-            failed.append(doc_id)
-            continue
-        emb = generate_embedding_text(txt, model_name=args.model)
-        if emb is None:
-            print(f"⚠️ Falha ao gerar embedding para documento {doc_id}")
-            failed.append(doc_id)
-            time.sleep(0.1)
-            continue
-        embeddings.append(emb)
-        new_ids.append(doc_id)
-        if (i+1) % args.progress == 0 or i+1 == total:
-            print(f"   ✅ {i+1}/{total} embeddings gerados")
-        if args.sleep_between > 0:
-            time.sleep(args.sleep_between)
-
-    if not embeddings:
-        print("❌ Nenhum embedding gerado — verifique credenciais/API.")
+    if args.model == embedding_backend.LOCAL_MODEL:
+        args.model = resolve_local_model(args, to_index)
+        if args.model is None:
+            return
+    else:
+        configure_api(args.model)
+
+    if args.incremental and existing_ids and current_model() != args.model:
+        # mesma dimensão não basta: vetores de modelos diferentes não são comparáveis
+        print(f"❌ O índice atual foi gerado com {current_model()}, não {args.model}; rode um reindex completo para trocar de modelo")
         return
 
-    # Converter para array 2D
+    if carry and not args.incremental and current_model() != args.model:
+        # vetores de outro modelo não podem ser misturados no índice novo
+        print(f"❌ {len(carry)} documentos sem texto (ex.: {carry[0][0]}) não podem ser reembedados com {args.model} "
+              f"(índice atual: {current_model()}); recupere os textos ou rode com --drop-empty para descartá-los")
+        if not args.drop_empty:
+            return
+        carry = []
+
+    # Checkpoints: segmentos já embedados de uma execução interrompida são reaproveitados com --resume
+    total = len(to_index)
+    plan = plan_hash(args.model, to_index)
+    ckpt = ReindexCheckpoint(WORK_DIR)
+    if args.resume and ckpt.resume(args.model, plan, total):
+        print(f"🔄 Retomando reindexação: {ckpt.done}/{total} documentos já embedados em {len(ckpt.entries)} checkpoints")
+    else:
+        pending_info = ckpt.pending_info()
+        if args.resume:
+            print("ℹ️ Nenhum checkpoint compatível (modelo ou documentos mudaram) — recomeçando do zero")
+        elif pending_info:
+            print(f"ℹ️ Descartando reindexação interrompida ({pending_info[0]}/{pending_info[1]}); use --resume para continuar uma execução")
+        ckpt.start(args.model, plan, total)
+
+    # Gerar embeddings em lotes, distribuídos entre todas as chaves (escalonador multi-chave)
     try:
-        new_emb_array = np.vstack([e.reshape(1, -1) for e in embeddings])
-    except Exception as e:
-        print(f"❌ Erro ao empilhar embeddings: {e}")
+        scheduler = build_scheduler(args)
+    except embedding_backend.EmbeddingError as e:
+        print(f"❌ {e}")
         return
-
-    # Backup e salvar (se incremental, tentar anexar ao existente)
+    start = ckpt.done
+    pending = to_index[start:]
+    print(f"🚀 Iniciando geração de embeddings para {len(pending)} documentos (modelo={args.model})")
+    batch_size = max(1, min(args.batch, embedding_backend.EMBED_BATCH_LIMIT))
+    id_batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    checkpoint_rows = max(batch_size, args.checkpoint_every)
+    done = start
+    next_report = done + args.progress
+    buffered = []
+    interrupted = None
+    results = scheduler.map([txt for _, txt in batch] for batch in id_batches)
     try:
-        if args.incremental and EMB_FILE.exists():
-            existing = np.load(str(EMB_FILE))
-            # checar compatibilidade de dimensão
-            if existing.shape[1] != new_emb_array.shape[1]:
-                print(f"❌ Dimensão incompatível: existing={existing.shape}, new={new_emb_array.shape}. Reindex completo necessário.")
-                return
-            combined = np.vstack([existing, new_emb_array])
-            backup_existing()
-            np.save(str(EMB_FILE), combined)
-            print(f"✅ Embeddings anexados em: {EMB_FILE} (shape={combined.shape})")
-            # atualizar id_map
-            try:
-                with open(ID_MAP_FILE, 'r', encoding='utf-8') as f:
-                    j = json.load(f)
-                    existing_ids_file = j.get('ids', []) if isinstance(j, dict) else j
-            except Exception:
-                existing_ids_file = []
-            merged_ids = existing_ids_file + new_ids
-            with open(ID_MAP_FILE, 'w', encoding='utf-8') as f:
-                json.dump({'ids': merged_ids}, f, ensure_ascii=False, indent=2)
-            print(f"✅ id_map atualizado em: {ID_MAP_FILE}")
-        else:
-            backup_existing()
-            np.save(str(EMB_FILE), new_emb_array)
-            print(f"✅ Embeddings salvos em: {EMB_FILE} (shape={new_emb_array.shape})")
-            # Salvar id_map (os indices correspondem às linhas do embeddings.npy)
-            try:
-                with open(ID_MAP_FILE, 'w', encoding='utf-8') as f:
-                    json.dump({'ids': new_ids}, f, ensure_ascii=False, indent=2)
-                print(f"✅ id_map salvo em: {ID_MAP_FILE}")
-            except Exception as e:
-                print(f"⚠️ Falha ao salvar id_map: {e}")
-    except Exception as e:
-        print(f"❌ Falha ao salvar embeddings: {e}")
+        for batch, (_, emb, error) in zip(id_batches, results):
+            if error is not None:
+                interrupted = f"{len(batch)} documentos (ex.: {batch[0][0]}): {error}"
+                break
+            buffered.extend(emb)
+            done += len(batch)
+            if len(buffered) >= checkpoint_rows:
+                ckpt.commit(np.vstack(buffered), ckpt.done, done)
+                buffered = []
+            if done >= next_report or done == total:
+                print(f"   ✅ {done}/{total} embeddings processados")
+                next_report = done + args.progress
+    except KeyboardInterrupt:
+        interrupted = "interrompido pelo usuário"
+    finally:
+        results.close()
+        # o que já foi embedado antes da falha também vira checkpoint
+        if buffered:
+            ckpt.commit(np.vstack(buffered), ckpt.done, done)
+    for slot, st in scheduler.stats().items():
+        print(f"   🔑 {slot}: {st['requests']} requisições, {st['texts']} textos, {st['rate_limited']} x 429, {st['errors']} erros")
+    if scheduler.cache is not None:
+        cst = scheduler.cache.stats()
+        print(f"   💾 cache de embeddings: {cst['hits']} textos reaproveitados, {cst['stored']} novos gravados")
+
+    if interrupted is not None:
+        print(f"❌ Falha ao gerar embeddings para {interrupted}")
+        print(f"💾 {ckpt.done}/{total} documentos salvos em checkpoints ({WORK_DIR}); rode novamente com --resume para continuar")
         return
 
-    # Salvar config simples
-    # determinar tamanho final salvo
-    try:
-        final_count = None
-        if args.incremental and EMB_FILE.exists():
-            # recarregar para obter shape final
-            final_arr = np.load(str(EMB_FILE))
-            final_count = int(final_arr.shape[0])
-        else:
-            final_count = int(new_emb_array.shape[0])
-    except Exception:
-        final_count = None
-
-    cfg = {
-        'model': args.model,
-        'generated_at': int(time.time()),
-        'count': final_count
-    }
+    # Incremental: só os documentos novos são gravados, num segmento anexado ao índice
+    if args.incremental and existing_ids and EMB_FILE.exists():
+        try:
+            seg_cfg = append_segment(ckpt, to_index, texts_by_id, meta_by_id, args)
+        except Exception as e:
+            print(f"❌ Falha ao gravar o segmento: {e}")
+            print(f"💾 Checkpoints mantidos em {WORK_DIR}; corrija o problema e rode com --resume")
+            return
+        ckpt.clear()
+        print(f"✅ Segmento anexado ao índice: {seg_cfg['items_count']} linhas")
+        index_writer.compact_after_append(VECTORS_DIR)
+        if failed:
+            print(f"⚠️ Alguns documentos falharam ao gerar embedding: {len(failed)} itens. Exemplos de índices: {failed[:10]}")
+        return
+
+    # Reindex completo: base + segmentos regravados numa base única, na ordem dos checkpoints.
+    # O IndexWriter grava vetores, metadata.jsonl (com offsets), id_map, chunk store, BM25 e
+    # partições na mesma ordem de linhas e, ao publicar, aposenta os segmentos e os tombstones.
+    backup_existing()
     try:
-        with open(CFG_FILE, 'w', encoding='utf-8') as f:
-            json.dump(cfg, f, ensure_ascii=False, indent=2)
-        print(f"✅ config salvo em: {CFG_FILE}")
+        cfg = write_checkpoints(index_writer.IndexWriter(VECTORS_DIR, args.model), ckpt, to_index, texts_by_id, meta_by_id, args,
+                                carry=carry)
     except Exception as e:
-        print(f"⚠️ Falha ao salvar config: {e}")
+        print(f"❌ Falha ao gravar o índice: {e}")
+        print(f"💾 Checkpoints mantidos em {WORK_DIR}; corrija o problema e rode com --resume")
+        return
+    print(f"✅ Índice regravado em: {VECTORS_DIR} ({cfg['items_count']} linhas, {len(ckpt.entries)} checkpoints, "
+          f"{len(carry)} vetores mantidos sem reembedar)")
+    ckpt.clear()
 
     if failed:
         print(f"⚠️ Alguns documentos falharam ao gerar embedding: {len(failed)} itens. Exemplos de índices: {failed[:10]}")
@@ -389,15 +544,25 @@ def main(args):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Reindexar vetores em memoria/vectors')
-    parser.add_argument('--model', type=str, default=os.getenv('EMBEDDING_MODEL', 'models/text-embedding-004'), help='Nome do modelo de embeddings')
-    parser.add_argument('--batch', type=int, default=1, help='Batch size (não usado intensamente; chamado por item)')
-    parser.add_argument('--sleep-between', type=float, default=0.0, help='Delay entre requisições (s)')
+    parser.add_argument('--model', type=str, default=os.getenv('EMBEDDING_MODEL', 'models/text-embedding-004'), help="Nome do modelo de embeddings ('local' = TF-IDF + SVD na CPU, sem API)")
+    parser.add_argument('--batch', type=int, default=32, help='Textos por requisição de embedding (máx. 100)')
+    parser.add_argument('--sleep-between', type=float, default=0.0, help='Legado: intervalo entre requisições por chave (s); use --rate-per-key')
+    parser.add_argument('--keys', type=str, default='', help='Slots de chave a usar, separados por vírgula (padrão: todos os KEY_SLOTS configurados)')
+    parser.add_argument('--rate-per-key', type=float, default=0.0, help='Requisições/s por chave (0 = EMBED_RATE_PER_KEY)')
+    parser.add_argument('--max-in-flight', type=int, default=0, help='Lotes em andamento ao mesmo tempo (0 = 2 por chave)')
+    parser.add_argument('--no-embed-cache', action='store_true', help='Não consultar/gravar o cache de embeddings por conteúdo (embedding_cache.CONTENT_CACHE_PATH)')
     parser.add_argument('--progress', type=int, default=10, help='Intervalo para logs de progresso')
     parser.add_argument('--skip-api-check', action='store_true', help='Pular verificação de disponibilidade da API')
     parser.add_argument('--incremental', action='store_true', help='Modo incremental: apenas novos documentos serão indexados e anexados')
-    parser.add_argument('--limit', type=int, default=0, help='Limitar número de documentos a indexar (0 = sem limite)')
+    parser.add_argument('--checkpoint-every', type=int, default=512, help='Documentos embedados por checkpoint (segmento em memoria/vectors/.reindex)')
+    parser.add_argument('--resume', action='store_true', help='Continuar uma reindexação interrompida a partir do último checkpoint')
+    parser.add_argument('--limit', type=int, default=0, help='Limitar número de documentos novos a indexar (só com --incremental; 0 = sem limite)')
+    parser.add_argument('--drop-empty', action='store_true', help='Reindex completo com outro modelo: descartar documentos sem texto (o vetor antigo não serve)')
+    parser.add_argument('--ann', choices=['auto', 'on', 'off'], default='auto', help="Índice aproximado IVF-flat: 'auto' constrói a partir de ann_index.AUTO_BUILD_MIN_ROWS vetores")
+    parser.add_argument('--ann-lists', type=int, default=0, help='Número de listas do IVF (0 = ~4*sqrt(N))')
+    parser.add_argument('--quantize', choices=['none', 'int8', 'float16'], default='none', help='Cópia compacta dos vetores para a varredura (re-rank exato em float32)')
     args = parser.parse_args()
-    if not args.skip_api_check:
+    if not args.skip_api_check and args.model != embedding_backend.LOCAL_MODEL:
         ok, info = check_api_available(args.model)
         if not ok:
             print(f"❌ Verificação de API falhou: {info}")
@@ -0,0 +1,426 @@
+"""Índice RAG em segmentos imutáveis (estilo LSM).
+
+O diretório do índice (`memoria/vectors`) continua sendo o segmento base, no formato de
+sempre. Cada anexação (ingestão incremental, `reindex_vectors.py --incremental`) grava só
+os dados novos em `segments/seg_<ns>/` — um índice completo escrito pelo
+`index_writer.IndexWriter` — e o registra em `segments.json`:
+
+    {"version": 1, "segments": [{"dir": "segments/seg_...", "rows": 120, ...}], "retired": [...]}
+
+Depois de publicado, um segmento não muda; linhas removidas vão para o `tombstones.npy`
+do próprio segmento. O `rag_agent` enxerga base + segmentos como um índice só (visões
+`Segmented*` abaixo, linhas numeradas em sequência) e o compactador
+(`index_writer.compact_segments`) junta os segmentos pequenos em um maior — ou tudo na
+base, com `major=True`. Segmentos substituídos ficam em `retired` até poderem ser apagados
+(processos que ainda os mapeiam continuam lendo uma cópia íntegra).
+
+Alterações do `segments.json` (anexar, compactar, regravar a base) são serializadas pelo
+arquivo `segments.lock` (criação exclusiva), que vale entre processos.
+"""
+
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import vector_store
+
+MANIFEST_FILE = 'segments.json'
+MANIFEST_VERSION = 1
+SEGMENTS_DIR = 'segments'
+LOCK_FILE = 'segments.lock'
+# Um lock mais velho que isso é de um processo que morreu sem liberá-lo
+LOCK_STALE_SECS = float(os.getenv('RAG_SEGMENT_LOCK_STALE', '3600'))
+LOCK_TIMEOUT = float(os.getenv('RAG_SEGMENT_LOCK_TIMEOUT', '600'))
+# Compactação menor: junta os segmentos com até COMPACT_SMALL_ROWS linhas quando houver
+# pelo menos COMPACT_MIN_SEGMENTS deles
+COMPACT_MIN_SEGMENTS = int(os.getenv('RAG_COMPACT_MIN_SEGMENTS', '4'))
+COMPACT_SMALL_ROWS = int(os.getenv('RAG_COMPACT_SMALL_ROWS', '50000'))
+
+
+# ---------------------------------------------------------------------------
+# Manifesto e lock
+# ---------------------------------------------------------------------------
+
+def load_manifest(vdir: Path) -> dict:
+    path = Path(vdir) / MANIFEST_FILE
+    if not path.exists():
+        return {'version': MANIFEST_VERSION, 'segments': [], 'retired': []}
+    with open(path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    manifest.setdefault('segments', [])
+    manifest.setdefault('retired', [])
+    return manifest
+
+
+def save_manifest(vdir: Path, manifest: dict):
+    """Grava o `segments.json` (temporário + `os.replace`); chamar com `locked(vdir)`."""
+    path = Path(vdir) / MANIFEST_FILE
+    if not manifest.get('segments') and not manifest.get('retired'):
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        return
+    manifest = {**manifest, 'version': MANIFEST_VERSION, 'updated_at': datetime.utcnow().isoformat()}
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def segment_dirs(vdir: Path, manifest: Optional[dict] = None) -> List[Path]:
+    vdir = Path(vdir)
+    manifest = manifest if manifest is not None else load_manifest(vdir)
+    return [vdir / entry['dir'] for entry in manifest['segments']]
+
+
+def part_dirs(vdir: Path, manifest: Optional[dict] = None) -> List[Path]:
+    """Base (se existir) + segmentos, na ordem das linhas do índice combinado."""
+    vdir = Path(vdir)
+    base = [vdir] if (vdir / vector_store.EMBEDDINGS_FILE).exists() else []
+    return base + segment_dirs(vdir, manifest)
+
+
+def new_segment_dir(vdir: Path) -> Path:
+    """Diretório (ainda não registrado) para um segmento novo; nomes crescem com o tempo."""
+    path = Path(vdir) / SEGMENTS_DIR / f"seg_{time.time_ns()}_{os.getpid()}"
+    path.mkdir(parents=True)
+    return path
+
+
+def segment_entry(vdir: Path, seg_dir: Path, config: dict) -> dict:
+    return {
+        'dir': Path(seg_dir).relative_to(Path(vdir)).as_posix(),
+        'rows': int(config.get('items_count', 0)),
+        'created_at': datetime.utcnow().isoformat(),
+    }
+
+
+class _DirLock:
+    def __init__(self, path: Path):
+        self.path = path
+        self.rlock = threading.RLock()
+        self.depth = 0
+
+
+_dir_locks: Dict[str, _DirLock] = {}
+_dir_locks_guard = threading.Lock()
+
+
+def _acquire_file(path: Path, timeout: Optional[float]):
+    deadline = None if timeout is None else time.time() + timeout
+    warned = False
+    while True:
+        try:
+            fd = os.open(str(path), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            with os.fdopen(fd, 'w') as f:
+                f.write(f"{os.getpid()} {datetime.utcnow().isoformat()}")
+            return
+        except FileExistsError:
+            try:
+                if time.time() - path.stat().st_mtime > LOCK_STALE_SECS:
+                    print(f"⚠️ Removendo lock abandonado: {path}")
+                    path.unlink()
+                    continue
+            except FileNotFoundError:
+                continue
+            if deadline is not None and time.time() >= deadline:
+                raise TimeoutError(f"índice ocupado por outro processo ({path})")
+            if not warned:
+                print(f"ℹ️ Aguardando outro processo liberar {path}")
+                warned = True
+            time.sleep(0.2)
+
+
+@contextmanager
+def locked(vdir: Path, timeout: Optional[float] = LOCK_TIMEOUT):
+    """Exclusão mútua (entre processos e threads) para alterar o conjunto de segmentos.
+
+    Reentrante na mesma thread: quem já segura o lock pode chamar funções que o pedem.
+    `timeout=0` falha na hora (`TimeoutError`) se outro processo estiver com ele.
+    """
+    path = Path(vdir) / LOCK_FILE
+    with _dir_locks_guard:
+        lock = _dir_locks.setdefault(str(path.resolve()), _DirLock(path))
+    if not lock.rlock.acquire(timeout=-1 if timeout is None else max(timeout, 0)):
+        raise TimeoutError(f"índice ocupado por outra thread ({path})")
+    try:
+        if lock.depth == 0:
+            _acquire_file(path, timeout)
+        lock.depth += 1
+        try:
+            yield
+        finally:
+            lock.depth -= 1
+            if lock.depth == 0:
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+    finally:
+        lock.rlock.release()
+
+
+def register_segment(vdir: Path, seg_dir: Path, config: dict):
+    """Anexa um segmento já publicado ao manifesto; chamar com `locked(vdir)`."""
+    manifest = load_manifest(vdir)
+    manifest['segments'].append(segment_entry(vdir, seg_dir, config))
+    save_manifest(vdir, manifest)
+
+
+def retire(vdir: Path, manifest: dict, dirs: List[str]):
+    """Tira `dirs` do manifesto e tenta apagá-los (e os aposentados antes); chamar com o lock."""
+    manifest['segments'] = [e for e in manifest['segments'] if e['dir'] not in set(dirs)]
+    manifest['retired'] = list(dict.fromkeys(manifest.get('retired', []) + list(dirs)))
+    save_manifest(vdir, manifest)
+    purge_retired(vdir, manifest)
+
+
+def purge_retired(vdir: Path, manifest: dict):
+    """Apaga segmentos aposentados; os que ainda estão abertos (Windows) ficam para a próxima."""
+    left = []
+    for rel in manifest.get('retired', []):
+        path = Path(vdir) / rel
+        try:
+            shutil.rmtree(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            left.append(rel)
+    if left != manifest.get('retired', []):
+        manifest['retired'] = left
+        save_manifest(vdir, manifest)
+
+
+def clear(vdir: Path):
+    """Aposenta todos os segmentos (a base foi regravada com tudo); chamar com o lock."""
+    manifest = load_manifest(vdir)
+    if manifest['segments'] or manifest['retired']:
+        retire(vdir, manifest, [e['dir'] for e in manifest['segments']])
+
+
+def manifest_signature(vdir: Path):
+    try:
+        st = (Path(vdir) / MANIFEST_FILE).stat()
+        return (st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        return None
+
+
+# ---------------------------------------------------------------------------
+# Visões combinadas (base + segmentos) usadas pelo rag_agent
+# ---------------------------------------------------------------------------
+
+class _Parts:
+    """Linhas globais -> (parte, linha local) a partir do número de linhas de cada parte."""
+
+    def __init__(self, sizes: List[int]):
+        self.sizes = [int(s) for s in sizes]
+        self.offsets = np.concatenate([[0], np.cumsum(self.sizes)]).astype(np.int64)
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def locate(self, row: int):
+        part = int(np.searchsorted(self.offsets, row, side='right')) - 1
+        return part, int(row) - int(self.offsets[part])
+
+    def split(self, rows: np.ndarray):
+        """Gera (parte, máscara em `rows`, linhas locais) para cada parte presente em `rows`."""
+        rows = np.asarray(rows, dtype=np.int64)
+        parts = np.searchsorted(self.offsets, rows, side='right') - 1
+        for part in np.unique(parts):
+            mask = parts == part
+            yield int(part), mask, rows[mask] - self.offsets[part]
+
+    def local_rows(self, rows: np.ndarray, part: int) -> np.ndarray:
+        """Linhas de `rows` (ordenadas) que caem na parte, em numeração local."""
+        lo, hi = self.offsets[part], self.offsets[part + 1]
+        start, end = np.searchsorted(rows, [lo, hi])
+        return np.asarray(rows[start:end], dtype=np.int64) - lo
+
+
+def merge_top(results, k: int):
+    """Junta listas (linhas globais, scores) de várias partes no top k geral."""
+    results = [(np.asarray(r, dtype=np.int64), np.asarray(s, dtype=np.float32)) for r, s in results if len(r)]
+    if not results:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    rows = np.concatenate([r for r, _ in results])
+    scores = np.concatenate([s for _, s in results])
+    idx, top = vector_store.top_k(scores, k)
+    return rows[idx], top
+
+
+class SegmentedVectors(_Parts):
+    """Os `embeddings.npy` (memmap) de todas as partes vistos como uma matriz."""
+
+    def __init__(self, parts: List[np.ndarray]):
+        super().__init__([p.shape[0] for p in parts])
+        self.parts = parts
+        self.shape = (len(self), int(parts[0].shape[1]))
+        self.dtype = np.dtype(np.float32)
+
+    def __getitem__(self, rows):
+        if isinstance(rows, (int, np.integer)):
+            part, local = self.locate(int(rows))
+            return self.parts[part][local]
+        if isinstance(rows, slice):
+            rows = np.arange(*rows.indices(len(self)))
+        rows = np.asarray(rows, dtype=np.int64)
+        out = np.empty((rows.size, self.shape[1]), dtype=np.float32)
+        for part, mask, local in self.split(rows):
+            out[mask] = self.parts[part][local]
+        return out
+
+    def scores_batch(self, q_embs: np.ndarray) -> np.ndarray:
+        """Similaridades (N, M) com as queries já normalizadas, parte a parte."""
+        out = np.empty((q_embs.shape[0], len(self)), dtype=np.float32)
+        for part, emb in enumerate(self.parts):
+            out[:, self.offsets[part]:self.offsets[part + 1]] = q_embs @ emb.T
+        return out
+
+
+class SegmentedQuantized(_Parts):
+    """Cópias compactas de todas as partes (todas precisam ter a mesma quantização)."""
+
+    def __init__(self, parts: List[vector_store.QuantizedVectors]):
+        super().__init__([p.codes.shape[0] for p in parts])
+        self.parts = parts
+        self.kind = parts[0].kind
+
+    def scores_batch(self, q_embs: np.ndarray) -> np.ndarray:
+        return np.hstack([p.scores_batch(q_embs) for p in self.parts])
+
+    def score_rows(self, rows: np.ndarray, q_emb: np.ndarray) -> np.ndarray:
+        rows = np.asarray(rows, dtype=np.int64)
+        out = np.empty(rows.size, dtype=np.float32)
+        for part, mask, local in self.split(rows):
+            out[mask] = self.parts[part].score_rows(local, q_emb)
+        return out
+
+
+class SegmentedIVF(_Parts):
+    """IVF por parte; partes sem IVF (segmentos pequenos) são varridas por inteiro."""
+
+    def __init__(self, parts: List[Optional[object]], sizes: List[int]):
+        super().__init__(sizes)
+        self.parts = parts
+
+    def candidates(self, q: np.ndarray, nprobe: int) -> np.ndarray:
+        found = []
+        for part, ann in enumerate(self.parts):
+            lo = self.offsets[part]
+            if ann is not None:
+                found.append(ann.candidates(q, nprobe) + lo)
+            else:
+                found.append(np.arange(lo, self.offsets[part + 1], dtype=np.int64))
+        return np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+
+    def search(self, q: np.ndarray, embeddings: SegmentedVectors, top_k: int, nprobe: int):
+        results = []
+        for part, ann in enumerate(self.parts):
+            emb = embeddings.parts[part]
+            if ann is not None:
+                rows, scores = ann.search(q, emb, top_k, nprobe=nprobe)
+            else:
+                rows, scores = vector_store.top_k(np.asarray(emb @ q, dtype=np.float32), top_k)
+            results.append((rows + self.offsets[part], scores))
+        return merge_top(results, top_k)
+
+
+class SegmentedBM25(_Parts):
+    """BM25 por parte, resultados juntados pelo score.
+
+    Cada parte tem suas próprias estatísticas (IDF, tamanho médio): entre partes os scores
+    são aproximados até a compactação juntá-las.
+    """
+
+    def __init__(self, parts: list, sizes: List[int]):
+        super().__init__(sizes)
+        self.parts = parts
+
+    def search(self, query: str, top_k: int, allowed: Optional[np.ndarray] = None, excluded: Optional[np.ndarray] = None):
+        results = []
+        for part, bm25 in enumerate(self.parts):
+            local = self.local_rows(allowed, part) if allowed is not None else None
+            if local is not None and local.size == 0:
+                continue
+            dead = self.local_rows(excluded, part) if excluded is not None else None
+            rows, scores = bm25.search(query, top_k, allowed=local, excluded=dead)
+            results.append((rows + self.offsets[part], scores))
+        return merge_top(results, top_k)
+
+
+class SegmentedPartitions(_Parts):
+    def __init__(self, parts: list, sizes: List[int]):
+        super().__init__(sizes)
+        self.parts = parts
+
+    def values(self, field: str) -> List[str]:
+        return sorted(set(v for p in self.parts for v in p.values(field)))
+
+    def select(self, filters) -> Optional[np.ndarray]:
+        if not filters:
+            return None
+        return np.concatenate([np.asarray(p.select(filters), dtype=np.int64) + self.offsets[i] for i, p in enumerate(self.parts)])
+
+
+class SegmentedRecords(_Parts):
+    """Linhas do `metadata.jsonl` de todas as partes (None onde uma parte não tem o registro)."""
+
+    def __init__(self, parts: list, sizes: List[int]):
+        super().__init__(sizes)
+        self.parts = parts
+
+    def __getitem__(self, i: int) -> Optional[dict]:
+        i = int(i)
+        if i < 0 or i >= len(self):
+            raise IndexError(i)
+        part, local = self.locate(i)
+        records = self.parts[part]
+        return records[local] if records is not None and local < len(records) else None
+
+    def __iter__(self):
+        for part, records in enumerate(self.parts):
+            n = self.sizes[part]
+            it = iter(records) if records is not None else iter(())
+            for _ in range(n):
+                yield next(it, None)
+
+    def close(self):
+        for records in self.parts:
+            if records is not None:
+                records.close()
+
+
+class SegmentedChunks(_Parts):
+    def __init__(self, parts: list, sizes: List[int]):
+        super().__init__(sizes)
+        self.parts = parts
+
+    def get(self, row: int) -> Optional[str]:
+        part, local = self.locate(int(row))
+        store = self.parts[part]
+        return store.get(local) if store is not None and local < len(store) else None
+
+    def get_many(self, rows) -> List[Optional[str]]:
+        return [self.get(r) for r in rows]
+
+    def close(self):
+        for store in self.parts:
+            if store is not None:
+                store.close()
+
+
+def combine_tombstones(parts: List[Optional[np.ndarray]], sizes: List[int]) -> Optional[np.ndarray]:
+    offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+    found = [np.asarray(t, dtype=np.int64) + offsets[i] for i, t in enumerate(parts) if t is not None]
+    return np.concatenate(found) if found else None
@@ -0,0 +1,139 @@
+"""Cache semântico de resultados do RAG (evidências e respostas geradas).
+
+Queries das Fases 1–3 muitas vezes diferem só na redação ("IAM cardiologia" x "infarto
+agudo do miocárdio cardiologia"). Cada entrada guarda o embedding normalizado da query e
+o resultado (ids das evidências, scores e, no `/rag/query`, a resposta gerada); uma
+consulta cujo embedding está a até `max_distance` (distância de cosseno) de uma entrada
+com os mesmos parâmetros reaproveita o resultado, sem varrer o índice nem chamar a
+geração.
+
+A busca é um único produto matriz-vetor sobre os embeddings guardados. As entradas
+expiram após `ttl` segundos; com o cache cheio, a entrada expirada ou usada há mais tempo
+dá lugar à nova. Tudo é descartado quando a geração do índice muda.
+"""
+
+import threading
+import time
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+import numpy as np
+
+
+class SemanticCache:
+    """Vizinho mais próximo (cosseno) sobre queries já respondidas, por chave de parâmetros."""
+
+    def __init__(self, max_items: int = 2048, ttl: float = 3600.0, max_distance: float = 0.05):
+        self.max_items = max(0, int(max_items))
+        self.ttl = float(ttl)
+        self.max_distance = float(max_distance)
+        self._lock = threading.Lock()
+        self._generation = None
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+        self._reset(0)
+
+    def _reset(self, dim: int):
+        self._dim = dim
+        self._vecs = np.zeros((self.max_items, dim), dtype=np.float32)
+        self._key_ids = np.full(self.max_items, -1, dtype=np.int64)
+        self._expires = np.zeros(self.max_items, dtype=np.float64)
+        self._last_used = np.zeros(self.max_items, dtype=np.float64)
+        self._payloads = [None] * self.max_items
+        self._queries = [None] * self.max_items
+        # chave de parâmetros <-> id numérico; só chaves com alguma entrada no cache
+        self._key_index: Dict[Hashable, int] = {}
+        self._keys: Dict[int, Hashable] = {}
+        self._next_kid = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_items > 0 and self.max_distance >= 0
+
+    def _check_generation(self, generation):
+        if generation != self._generation:
+            if self._generation is not None and (self._key_ids >= 0).any():
+                self._stats['invalidations'] += 1
+            self._generation = generation
+            self._reset(self._dim)
+
+    def _release(self, slots: np.ndarray):
+        """Libera as posições `slots` e esquece as chaves que ficaram sem nenhuma entrada."""
+        old = np.unique(self._key_ids[slots])
+        self._key_ids[slots] = -1
+        for slot in slots.tolist():
+            self._payloads[slot] = None
+            self._queries[slot] = None
+        live = self._key_ids[np.isin(self._key_ids, old)]
+        for kid in np.setdiff1d(old[old >= 0], live).tolist():
+            del self._key_index[self._keys.pop(kid)]
+
+    @staticmethod
+    def _normalize(q: np.ndarray) -> np.ndarray:
+        q = np.asarray(q, dtype=np.float32).reshape(-1)
+        n = float(np.linalg.norm(q))
+        return q / n if n else q
+
+    def lookup(self, generation, key: Hashable, q_emb: np.ndarray) -> Optional[Tuple[Any, float, str]]:
+        """Retorna (payload, similaridade, query original) da entrada mais próxima, ou None."""
+        if not self.enabled or q_emb is None:
+            return None
+        q = self._normalize(q_emb)
+        now = time.time()
+        with self._lock:
+            self._check_generation(generation)
+            kid = self._key_index.get(key)
+            if kid is None or q.shape[0] != self._dim:
+                self._stats['misses'] += 1
+                return None
+            sims = self._vecs @ q
+            sims[(self._key_ids != kid) | (self._expires <= now)] = -np.inf
+            slot = int(np.argmax(sims))
+            if not np.isfinite(sims[slot]) or 1.0 - float(sims[slot]) > self.max_distance:
+                self._stats['misses'] += 1
+                return None
+            self._last_used[slot] = now
+            self._stats['hits'] += 1
+            return self._payloads[slot], float(sims[slot]), self._queries[slot]
+
+    def put(self, generation, key: Hashable, q_emb: np.ndarray, query: str, payload: Any):
+        if not self.enabled or q_emb is None:
+            return
+        q = self._normalize(q_emb)
+        now = time.time()
+        with self._lock:
+            self._check_generation(generation)
+            if q.shape[0] != self._dim:
+                # outra dimensão (troca de modelo): recomeça o cache
+                self._reset(q.shape[0])
+            expired = np.flatnonzero((self._key_ids >= 0) & (self._expires <= now))
+            if expired.size:
+                self._release(expired)
+            free = np.flatnonzero(self._key_ids < 0)
+            if free.size:
+                slot = int(free[0])
+            else:
+                slot = int(np.argmin(self._last_used))
+                self._release(np.array([slot]))
+                self._stats['evictions'] += 1
+            kid = self._key_index.get(key)
+            if kid is None:
+                kid = self._key_index[key] = self._next_kid
+                self._keys[kid] = key
+                self._next_kid += 1
+            self._vecs[slot] = q
+            self._key_ids[slot] = kid
+            self._expires[slot] = now + self.ttl
+            self._last_used[slot] = now
+            self._payloads[slot] = payload
+            self._queries[slot] = query
+
+    def clear(self):
+        with self._lock:
+            self._reset(self._dim)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            out = dict(self._stats)
+            out['items'] = int(((self._key_ids >= 0) & (self._expires > time.time())).sum())
+            out['hit_rate'] = round(self._stats['hits'] / lookups, 4) if lookups else 0.0
+            return out
@@ -0,0 +1,59 @@
+import sys
+import zlib
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'scripts'))
+
+import embedding_backend  # noqa: E402
+import index_writer  # noqa: E402
+
+
+class TokenEmbedder(embedding_backend.EmbeddingBackend):
+    """Embedding determinístico sem rede: soma de vetores fixos por token."""
+
+    name = 'test'
+
+    def __init__(self, model: str = 'test-model', dim: int = 16):
+        super().__init__(model)
+        self.dim = dim
+
+    def embed(self, texts, timeout=None):
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for token in text.lower().split():
+                out[i] += np.random.default_rng(zlib.crc32(token.encode('utf-8'))).standard_normal(self.dim)
+        return out
+
+
+@pytest.fixture
+def embedder():
+    return TokenEmbedder()
+
+
+def write_index(writer: index_writer.IndexWriter, embedder: TokenEmbedder, docs, source: str = 'pdf') -> dict:
+    """Publica `docs` ([(id, texto)]) pelo `writer`."""
+    ids = [doc_id for doc_id, _ in docs]
+    texts = [text for _, text in docs]
+    writer.add(ids, texts, [{'source': source, 'path': f'{doc_id}.pdf'} for doc_id in ids], embedder.embed(texts))
+    return writer.finalize(ann='off')
+
+
+@pytest.fixture
+def serve_index(monkeypatch):
+    """Aponta o `rag_agent` para um índice de teste (sem caches de embedding em disco)."""
+    import embedding_cache
+    import rag_agent
+
+    def serve(vdir: Path, backend: embedding_backend.EmbeddingBackend):
+        monkeypatch.setitem(embedding_backend._BACKENDS, backend.model, backend)
+        monkeypatch.setattr(rag_agent, 'VECTORS_DIR', vdir)
+        monkeypatch.setattr(rag_agent, 'QUERY_EMBEDDING_CACHE', embedding_cache.QueryEmbeddingCache(None, 0, 0))
+        rag_agent.reload_index(vdir, force=True)
+        return rag_agent
+
+    return serve
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+import ann_index
+import vector_store
+
+
+@pytest.fixture(scope='module')
+def corpus():
+    """4000 vetores em 40 grupos e 50 queries próximas de linhas do corpus."""
+    rng = np.random.default_rng(7)
+    centers = rng.standard_normal((40, 32))
+    emb = vector_store.normalize_rows(centers[rng.integers(0, 40, 4000)] + 0.35 * rng.standard_normal((4000, 32)))
+    queries = vector_store.normalize_rows(emb[rng.choice(4000, 50, replace=False)] + 0.1 * rng.standard_normal((50, 32)))
+    return emb, queries
+
+
+def _recall(index, emb, queries, nprobe, k=10):
+    hits = 0
+    for q in queries:
+        exact, _ = vector_store.top_k(emb @ q, k)
+        approx, scores = index.search(q, emb, k, nprobe=nprobe)
+        assert np.all(np.diff(scores) <= 0)
+        hits += len(set(exact.tolist()) & set(approx.tolist()))
+    return hits / (k * len(queries))
+
+
+def test_ivf_recall_grows_with_nprobe(corpus, tmp_path):
+    emb, queries = corpus
+    index = ann_index.IVFIndex.build(emb, n_lists=64)
+    assert index.offsets[-1] == emb.shape[0]
+    assert np.array_equal(np.sort(index.lists), np.arange(emb.shape[0]))
+
+    index.save(tmp_path)
+    index = ann_index.IVFIndex.load(tmp_path)
+    low = _recall(index, emb, queries, nprobe=1)
+    high = _recall(index, emb, queries, nprobe=8)
+    assert high >= 0.95 and high >= low
+    assert _recall(index, emb, queries, nprobe=index.n_lists) == 1.0
+    # poucas listas varridas: bem menos linhas que a busca exata
+    assert index.candidates(queries[0], 8).size < emb.shape[0] / 2
+
+
+def test_auto_mode_skips_small_indexes(corpus, tmp_path):
+    emb, _ = corpus
+    assert ann_index.build_for(tmp_path, emb, mode='auto') is None
+    assert ann_index.IVFIndex.load(tmp_path) is None
+    cfg = ann_index.build_for(tmp_path, emb, mode='on', n_lists=16)
+    assert cfg == {'type': ann_index.ANN_TYPE, 'n_lists': 16, 'nprobe': ann_index.DEFAULT_NPROBE}
+    assert ann_index.IVFIndex.load(tmp_path).n_lists == 16
+    ann_index.build_for(tmp_path, emb, mode='off')
+    assert ann_index.IVFIndex.load(tmp_path) is None
@@ -0,0 +1,67 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+import embedding_backend
+import rag_agent
+
+
+@pytest.fixture
+def executor(monkeypatch):
+    pool = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(rag_agent, '_API_EXECUTOR', pool)
+    monkeypatch.setattr(rag_agent, 'RAG_API_MAX_CONCURRENCY', 1)
+    monkeypatch.setattr(rag_agent, '_API_STATS', dict.fromkeys(rag_agent._API_STATS, 0))
+    yield pool
+    pool.shutdown(wait=True)
+
+
+def test_stats_report_saturation_and_calls_running_past_timeout(executor):
+    async def scenario():
+        slow = asyncio.ensure_future(rag_agent._run_api_call(time.sleep, 0.3, timeout=0.05))
+        queued = asyncio.ensure_future(rag_agent._run_api_call(time.sleep, 0.0, timeout=0.05))
+        for task in (slow, queued):
+            with pytest.raises(asyncio.TimeoutError):
+                await task
+        return rag_agent.get_api_executor_stats()
+
+    stats = asyncio.run(scenario())
+    # a thread da chamada lenta continua ocupada; a da fila foi cancelada antes de começar
+    assert stats['running'] == 1 and stats['saturated'] and stats['queued'] == 0
+    assert stats['timeouts'] == 2
+    executor.shutdown(wait=True)
+    stats = rag_agent.get_api_executor_stats()
+    assert stats['running'] == 0 and stats['overruns'] == 1 and not stats['saturated']
+
+
+class SlowBackend(embedding_backend.EmbeddingBackend):
+    """Lote sempre falha; cada query sozinha leva o prazo inteiro."""
+
+    name = 'slow'
+
+    def __init__(self):
+        super().__init__('slow-model')
+        self.timeouts = []
+
+    def embed(self, texts, timeout=None):
+        if len(texts) > 1:
+            raise embedding_backend.EmbeddingError('lote recusado')
+        self.timeouts.append(timeout)
+        time.sleep(timeout)
+        return np.ones((1, 4), dtype=np.float32)
+
+
+def test_query_embedding_fallback_shares_one_deadline(monkeypatch):
+    backend = SlowBackend()
+    monkeypatch.setitem(embedding_backend._BACKENDS, backend.model, backend)
+    monkeypatch.setattr(rag_agent, 'RAG_EMBED_TIMEOUT', 0.1)
+
+    t0 = time.monotonic()
+    embs, _ = rag_agent._embed_queries_api(['a', 'b', 'c', 'd'], backend.model)
+
+    assert time.monotonic() - t0 < 0.2
+    assert embs[0] is not None and embs[-1] is None
+    assert sum(backend.timeouts) <= 0.1 + 1e-6
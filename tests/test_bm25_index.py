@@ -0,0 +1,61 @@
+import math
+
+import numpy as np
+import pytest
+
+import bm25_index
+
+TEXTS = [
+    'Dengue grave: hidratação venosa e sinais de alarme na dengue',
+    'Asma aguda: broncodilatador inalatório e corticoide',
+    'Dengue em gestantes',
+    '',
+    'Conduta na crise de asma em crianças: corticoide oral',
+]
+
+
+def reference_scores(texts, query, k1=bm25_index.DEFAULT_K1, b=bm25_index.DEFAULT_B):
+    """BM25 por força bruta, linha a linha."""
+    docs = [bm25_index.tokenize(t) for t in texts]
+    avgdl = sum(len(d) for d in docs) / len(docs)
+    out = np.zeros(len(docs))
+    for term in set(bm25_index.tokenize(query)):
+        df = sum(term in d for d in docs)
+        if not df:
+            continue
+        idf = math.log(1 + (len(docs) - df + 0.5) / (df + 0.5))
+        for row, d in enumerate(docs):
+            tf = d.count(term)
+            if tf:
+                out[row] += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(d) / avgdl))
+    return out
+
+
+def test_tokenize_folds_case_and_accents():
+    assert bm25_index.tokenize('Estação  HIDRATAÇÃO, 2ª-fase') == ['estacao', 'hidratacao', '2a', 'fase']
+
+
+@pytest.mark.parametrize('query', ['dengue hidratacao', 'corticoide asma crianças', 'palavra inexistente'])
+def test_scores_match_reference_after_reload(tmp_path, query):
+    assert bm25_index.build_for(tmp_path, TEXTS)['n_docs'] == len(TEXTS)
+    index = bm25_index.BM25Index.load(tmp_path)
+
+    expected = reference_scores(TEXTS, query)
+    rows, scores = index.search(query, top_k=10)
+    assert rows.tolist() == [r for r in np.argsort(-expected, kind='stable') if expected[r] > 0]
+    assert np.allclose(scores, expected[rows], rtol=1e-5)
+
+
+def test_search_respects_allowed_and_excluded_rows():
+    index = bm25_index.BM25Index.build(TEXTS)
+    # a linha curta vence pela normalização de tamanho
+    assert index.search('dengue', 5)[0].tolist() == [2, 0]
+    assert index.search('dengue', 5, allowed=np.array([0, 4]))[0].tolist() == [0]
+    assert index.search('dengue', 5, excluded=np.array([2]))[0].tolist() == [0]
+    assert index.search('dengue', 1)[0].tolist() == [2]
+
+
+def test_empty_corpus_removes_the_index(tmp_path):
+    bm25_index.build_for(tmp_path, TEXTS)
+    assert bm25_index.build_for(tmp_path, []) is None
+    assert bm25_index.BM25Index.load(tmp_path) is None
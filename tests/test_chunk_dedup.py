@@ -0,0 +1,72 @@
+import numpy as np
+
+import bm25_index
+import chunk_dedup
+from chunk_dedup import NearDuplicateFilter
+
+WORDS = ('paciente febre dengue hidratacao venosa sinais alarme plaquetas hematocrito '
+         'conduta internacao observacao dor abdominal vomitos persistentes sangramento mucosa').split()
+
+
+def text(seed: int, n: int = 120) -> str:
+    rng = np.random.default_rng(seed)
+    return ' '.join(rng.choice(WORDS, n))
+
+
+def edit(source: str, every: int) -> str:
+    """Troca uma palavra a cada `every`."""
+    tokens = source.split()
+    return ' '.join('trocada' if i % every == 0 else t for i, t in enumerate(tokens))
+
+
+def jaccard(a: str, b: str) -> float:
+    def shingles(s):
+        t = bm25_index.tokenize(s)
+        return {tuple(t[i:i + chunk_dedup.SHINGLE_WORDS]) for i in range(len(t) - chunk_dedup.SHINGLE_WORDS + 1)}
+    sa, sb = shingles(a), shingles(b)
+    return len(sa & sb) / len(sa | sb)
+
+
+def test_minhash_estimates_shingle_jaccard():
+    dedup = NearDuplicateFilter()
+    base = text(1)
+    for other in (base.upper(), edit(base, 40), edit(base, 12), edit(base, 4), text(2)):
+        estimate = float((dedup.signature(base) == dedup.signature(other)).mean())
+        assert abs(estimate - jaccard(base, other)) < 0.15
+    assert dedup.signature('!!! ...') is None
+
+
+def test_filter_drops_near_duplicates_and_records_the_kept_chunk():
+    base = text(1)
+    items = [
+        {'id': 'a', 'text': base},
+        {'id': 'b', 'text': base.replace('febre', 'Fébre')},
+        {'id': 'c', 'text': edit(base, 60)},
+        {'id': 'd', 'text': edit(base, 4)},
+        {'id': 'e', 'text': text(2)},
+        {'id': 'vazio', 'text': ''},
+        {'id': 'a', 'text': base},
+    ]
+    dedup = NearDuplicateFilter()
+    kept = [item['id'] for item in dedup.filter(items)]
+    assert kept == ['a', 'd', 'e', 'vazio', 'a']
+    assert dedup.dropped == {'b': 'a', 'c': 'a'}
+    assert len(dedup) == 3
+
+
+def test_signatures_persist_across_runs_and_removed_chunks_stop_matching(tmp_path):
+    base = text(1)
+    dedup = NearDuplicateFilter()
+    list(dedup.filter([{'id': 'a', 'text': base}, {'id': 'e', 'text': text(2)}]))
+    dedup.save(tmp_path)
+
+    again = NearDuplicateFilter.load(tmp_path)
+    assert len(again) == 2
+    assert list(again.filter([{'id': 'b', 'text': edit(base, 60)}])) == []
+    assert again.remove(['a', 'inexistente']) == 1
+    assert [i['id'] for i in again.filter([{'id': 'b', 'text': edit(base, 60)}])] == ['b']
+
+    # parâmetros do LSH diferentes: as assinaturas salvas não servem
+    saved = dict(np.load(str(tmp_path / chunk_dedup.DEDUP_FILE)))
+    np.savez(str(tmp_path / chunk_dedup.DEDUP_FILE), **{**saved, 'bands': np.array(5)})
+    assert len(NearDuplicateFilter.load(tmp_path)) == 0
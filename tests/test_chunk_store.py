@@ -0,0 +1,46 @@
+import json
+
+import chunk_store
+
+
+def test_random_access_across_blocks(tmp_path, monkeypatch):
+    monkeypatch.setattr(chunk_store, 'BLOCK_CACHE_SIZE', 2)
+    texts = [f'chunk {i} ' + 'conduta na hipertensão ' * (i % 5) for i in range(200)] + ['']
+    writer = chunk_store.ChunkStoreWriter(tmp_path, block_size=256)
+    for text in texts:
+        writer.add(text)
+    assert writer.close() == len(texts)
+
+    store = chunk_store.ChunkStore.load(tmp_path)
+    assert store.blocks.size > 10
+    rows = [150, 3, 199, 3, 0, 200, 77]
+    assert store.get_many(rows) == [texts[r] for r in rows]
+    assert len(store._cache) <= 2
+    assert store.get(len(texts)) is None and store.get(-1) is None
+    store.close()
+
+
+def test_empty_store_is_removed(tmp_path):
+    chunk_store.write_store(tmp_path, ['texto'])
+    assert chunk_store.write_store(tmp_path, []) is None
+    assert chunk_store.ChunkStore.load(tmp_path) is None
+
+
+def test_metadata_records_reuse_offsets_only_while_valid(tmp_path):
+    meta_file = tmp_path / 'metadata.jsonl'
+    rows = [{'id': f'd{i}', 'text_preview': f'ação {i}'} for i in range(5)]
+    meta_file.write_text(''.join(json.dumps(r, ensure_ascii=False) + '\n\n' for r in rows), encoding='utf-8')
+    chunk_store.write_metadata_offsets(tmp_path)
+
+    records = chunk_store.JsonlRecords.load(tmp_path)
+    assert len(records) == 5
+    assert records[3] == rows[3] and records[-1] == rows[4]
+    assert list(records) == rows
+    records.close()
+
+    # metadata.jsonl regravado sem os offsets: os offsets salvos não valem mais
+    rows.append({'id': 'novo', 'text_preview': 'x'})
+    meta_file.write_text(''.join(json.dumps(r) + '\n' for r in rows), encoding='utf-8')
+    records = chunk_store.JsonlRecords.load(tmp_path)
+    assert len(records) == 6 and records[5]['id'] == 'novo' and records[2] == rows[2]
+    records.close()
@@ -0,0 +1,79 @@
+import asyncio
+import sqlite3
+
+import numpy as np
+
+import embedding_cache
+from embedding_cache import ContentEmbeddingCache
+
+
+class CountingEmbed:
+    def __init__(self, embedder):
+        self.embedder = embedder
+        self.calls = []
+
+    def __call__(self, texts):
+        self.calls.append(list(texts))
+        return self.embedder.embed(texts)
+
+
+def test_only_new_texts_are_embedded(tmp_path, embedder):
+    cache = ContentEmbeddingCache(tmp_path / 'c.sqlite')
+    embed = CountingEmbed(embedder)
+    first = cache.embed('test-model', ['dengue', 'zika', 'dengue'], embed)
+    second = cache.embed('test-model', ['zika', 'chikungunya'], embed)
+
+    assert embed.calls == [['dengue', 'zika'], ['chikungunya']]
+    assert np.array_equal(first[0], first[2]) and np.array_equal(first[1], second[0])
+    cache.embed('outro-modelo', ['dengue'], embed)
+    assert embed.calls[-1] == ['dengue']
+
+
+def test_cache_is_bounded_by_least_recent_use(tmp_path, embedder):
+    path = tmp_path / 'c.sqlite'
+    cache = ContentEmbeddingCache(path, max_items=10)
+    texts = [f'chunk {i}' for i in range(10)]
+    for text in texts:
+        cache.put_many('test-model', [text], embedder.embed([text]))
+    assert cache.get_many('test-model', ['chunk 0'])[0] is not None  # chunk 0 passa a ser o mais recente
+    cache.put_many('test-model', ['chunk 10'], embedder.embed(['chunk 10']))
+
+    # 11 > 10: remove o excesso mais 10% do limite, os menos usados
+    assert cache.stats()['items'] == 9 and cache.stats()['evictions'] == 2
+    kept = cache.get_many('test-model', texts + ['chunk 10'])
+    assert [v is not None for v in kept] == [True, False, False] + [True] * 8
+    with sqlite3.connect(str(path)) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM content_embeddings").fetchone()[0] == 9
+
+
+def test_cache_created_before_the_limit_is_migrated(tmp_path):
+    path = tmp_path / 'c.sqlite'
+    with sqlite3.connect(str(path)) as conn:
+        conn.execute("CREATE TABLE models (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)")
+        conn.execute(
+            "CREATE TABLE content_embeddings (model_id INTEGER NOT NULL, digest BLOB NOT NULL,"
+            " vector BLOB NOT NULL, PRIMARY KEY (model_id, digest)) WITHOUT ROWID"
+        )
+        conn.execute("INSERT INTO models (id, name) VALUES (1, 'm')")
+        conn.execute("INSERT INTO content_embeddings VALUES (1, ?, ?)",
+                     (embedding_cache.text_digest('antigo'), np.ones(4, dtype=np.float32).tobytes()))
+    cache = ContentEmbeddingCache(path, max_items=1)
+    cache.put_many('m', ['novo'], np.zeros((1, 4), dtype=np.float32))
+    assert cache.get_many('m', ['antigo', 'novo'])[0] is None
+    assert cache.get_many('m', ['novo'])[0] is not None
+
+
+def test_queries_do_not_touch_the_content_cache(tmp_path, embedder, serve_index, monkeypatch):
+    import index_writer
+    from conftest import write_index
+
+    vdir = tmp_path / 'vectors'
+    write_index(index_writer.IndexWriter(vdir, 'test-model'), embedder, [('a', 'dengue grave')])
+    rag_agent = serve_index(vdir, embedder)
+    cache = ContentEmbeddingCache(tmp_path / 'c.sqlite')
+    monkeypatch.setattr(embedding_cache, '_content_cache', cache)
+
+    body = rag_agent.RAGQuery(query='texto livre de um usuário', top_k=1, mode='dense')
+    asyncio.run(rag_agent.retrieve_many([body]))
+    assert cache.stats() == {'hits': 0, 'misses': 0, 'stored': 0, 'evictions': 0, 'errors': 0,
+                             'items': 0, 'hit_rate': 0.0}
@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+import embedding_backend
+from conftest import TokenEmbedder
+from embedding_backend import EmbeddingError, EmbeddingScheduler, TokenBucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(embedding_backend.time, 'monotonic', clock)
+    monkeypatch.setattr(embedding_backend.random, 'random', lambda: 0.0)
+    return clock
+
+
+def test_bucket_allows_bursts_then_the_configured_rate(clock):
+    bucket = TokenBucket(rate=2, burst=3)
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+    assert bucket.wait_time() == pytest.approx(0.5)
+    clock.now += 0.5
+    assert bucket.try_acquire() and not bucket.try_acquire()
+    clock.now += 10
+    assert sum(bucket.try_acquire() for _ in range(5)) == 3
+
+
+def test_bucket_backs_off_multiplicatively_and_recovers_additively(clock):
+    bucket = TokenBucket(rate=8, burst=8)
+    bucket.on_rate_limited()
+    assert bucket.rate == 4 and bucket.tokens == 0
+    assert bucket.wait_time() == pytest.approx(embedding_backend.BACKOFF_INITIAL)
+    assert not bucket.try_acquire()
+    bucket.on_rate_limited()
+    assert bucket.rate == 2
+    assert bucket.wait_time() == pytest.approx(2 * embedding_backend.BACKOFF_INITIAL)
+    for _ in range(10):
+        bucket.on_rate_limited()
+    assert bucket.rate == bucket.min_rate == 0.5
+    assert bucket.backoff == embedding_backend.BACKOFF_MAX
+
+    bucket.on_success()
+    assert bucket.backoff == 0 and bucket.rate == pytest.approx(1.3)
+    for _ in range(20):
+        bucket.on_success()
+    assert bucket.rate == bucket.max_rate == 8
+
+
+class FlakyKey(TokenEmbedder):
+    """Responde 429 nas primeiras `limited` chamadas."""
+
+    def __init__(self, limited=0, error=None):
+        super().__init__()
+        self.limited = limited
+        self.error = error
+        self.calls = 0
+
+    def embed(self, texts, timeout=None):
+        self.calls += 1
+        if self.calls <= self.limited:
+            raise EmbeddingError('429 RESOURCE_EXHAUSTED')
+        if self.error is not None:
+            raise EmbeddingError(self.error)
+        return super().embed(texts)
+
+
+def test_scheduler_moves_a_rate_limited_batch_to_another_key(monkeypatch):
+    monkeypatch.setattr(embedding_backend.random, 'random', lambda: 0.0)
+    limited, healthy = FlakyKey(limited=1000), FlakyKey()
+    scheduler = EmbeddingScheduler('test-model', rate_per_key=1000, burst_per_key=1000, max_in_flight=2,
+                                   backends=[('k1', limited), ('k2', healthy)])
+    batches = [[f'texto {i} {j}' for j in range(3)] for i in range(6)]
+    results = list(scheduler.map(batches))
+
+    assert [batch for batch, _, _ in results] == batches
+    assert all(error is None for _, _, error in results)
+    for batch, emb, _ in results:
+        assert np.array_equal(emb, TokenEmbedder().embed(batch))
+    stats = scheduler.stats()
+    assert stats['k1']['requests'] == 0 and stats['k1']['rate_limited'] >= 1
+    assert stats['k1']['rate'] < 1000
+    assert stats['k2']['requests'] == 6 and stats['k2']['texts'] == 18
+
+
+def test_scheduler_gives_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr(embedding_backend.random, 'random', lambda: 0.0)
+    broken = FlakyKey(error='500 interno')
+    scheduler = EmbeddingScheduler('test-model', rate_per_key=1000, burst_per_key=1000, max_retries=2,
+                                   backends=[('k1', broken)])
+    with pytest.raises(EmbeddingError):
+        scheduler.embed(['a', 'b'])
+    assert broken.calls == 3 and scheduler.stats()['k1']['errors'] == 3
@@ -0,0 +1,55 @@
+import asyncio
+
+import numpy as np
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import index_writer
+import rag_agent
+from conftest import write_index
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.include_router(rag_agent.router)
+    return TestClient(app)
+
+
+@pytest.mark.parametrize('mode', ['hybird', 'Dense', ''])
+def test_unknown_mode_is_rejected(client, mode):
+    response = client.post('/rag/retrieve', json={'query': 'dengue', 'mode': mode})
+    assert response.status_code == 422
+
+
+def test_rrf_fuse_sums_weighted_reciprocal_ranks():
+    rows, scores = rag_agent._rrf_fuse([([7, 3, 5], 1.0), ([5, 9], 2.0)], rrf_k=60, top_k=10)
+    expected = {7: 1 / 61, 3: 1 / 62, 5: 1 / 63 + 2 / 61, 9: 2 / 62}
+    assert rows.tolist() == sorted(expected, key=expected.get, reverse=True)
+    assert np.allclose(scores, [expected[r] for r in rows.tolist()])
+    assert rag_agent._rrf_fuse([([7, 3, 5], 1.0), ([5, 9], 2.0)], rrf_k=60, top_k=2)[0].tolist() == rows[:2].tolist()
+
+
+def test_rrf_fuse_ignores_empty_and_zero_weight_lists():
+    assert rag_agent._rrf_fuse([([1, 2], 0.0), ([], 1.0)], rrf_k=60, top_k=5)[0].size == 0
+    assert rag_agent._rrf_fuse([([4, 2], 1.0), ([9], 0.0)], rrf_k=60, top_k=5)[0].tolist() == [4, 2]
+
+
+def test_hybrid_finds_rows_only_one_side_ranks(tmp_path, embedder, serve_index):
+    vdir = tmp_path / 'vectors'
+    docs = [(f'd{i}', f'clinica geral caso {i}') for i in range(30)] + [('cid', 'codigo A90 notificacao')]
+    write_index(index_writer.IndexWriter(vdir, 'test-model'), embedder, docs)
+    serve_index(vdir, embedder)
+
+    def ids(mode):
+        body = rag_agent.RAGQuery(query='A90 caso 3', top_k=3, mode=mode)
+        result = asyncio.run(rag_agent.retrieve_many([body]))[0]
+        assert result['retrieval_mode'] == mode
+        return [e['metadata']['id'] for e in result['evidence']]
+
+    dense, lexical, hybrid = ids('dense'), ids('lexical'), ids('hybrid')
+    # o código só aparece no BM25; o caso 3 está no topo das duas listas
+    assert 'cid' not in dense and lexical[0] == 'cid'
+    assert dense[0] == 'd3' and 'd3' in lexical
+    assert hybrid[:2] == ['d3', 'cid']
@@ -0,0 +1,106 @@
+import asyncio
+import os
+
+import pytest
+
+import index_writer
+from conftest import write_index
+
+
+def docs(tag: str, n: int = 12):
+    return [(f'd{i}', f'dengue febre caso {i} {tag}') for i in range(n)]
+
+
+def test_reload_closes_retired_generation_after_last_query(tmp_path, embedder, serve_index):
+    vdir = tmp_path / 'vectors'
+    write_index(index_writer.IndexWriter(vdir, 'test-model'), embedder, docs('v1'))
+    rag_agent = serve_index(vdir, embedder)
+
+    old = rag_agent._acquire_generation(vdir)
+    write_index(index_writer.IndexWriter(vdir, 'test-model'), embedder, docs('v2', 15))
+    rag_agent.reload_index(vdir, force=True)
+    # consulta em andamento continua na geração antiga
+    assert not old.closed and old.embeddings.shape[0] == 12
+    old.release()
+    assert old.closed and old.embeddings is None
+
+    body = rag_agent.RAGQuery(query='dengue febre', top_k=3)
+    result = asyncio.run(rag_agent.retrieve_many([body]))[0]
+    assert result['index_generation'] == rag_agent._current.generation != old.generation
+    assert len(result['evidence']) == 3
+    assert rag_agent._current._users == 0
+
+
+def test_publish_fails_untouched_when_a_file_is_locked(tmp_path, monkeypatch, embedder):
+    vdir = tmp_path / 'vectors'
+    write_index(index_writer.IndexWriter(vdir, 'test-model'), embedder, docs('v1'))
+    before = {p.name: p.read_bytes() for p in vdir.iterdir() if p.is_file()}
+
+    # simula o Windows com o servidor segurando o memmap do embeddings.npy
+    replace = index_writer.os.replace
+
+    def locked_replace(src, dst):
+        if str(src).endswith('embeddings.npy') and '.staging' not in str(src):
+            raise PermissionError(src)
+        return replace(src, dst)
+
+    monkeypatch.setattr(index_writer, '_LOCKING_FS', True)
+    monkeypatch.setattr(index_writer.os, 'replace', locked_replace)
+    with pytest.raises(PermissionError):
+        write_index(index_writer.IndexWriter(vdir, 'test-model'), embedder, docs('v2', 15))
+    monkeypatch.undo()
+
+    assert {p.name: p.read_bytes() for p in vdir.iterdir() if p.is_file()} == before
+
+
+class _StopWatching(Exception):
+    pass
+
+
+def _watch_once(rag_agent, monkeypatch, vdir):
+    """Roda uma volta do `_watch_index` (o segundo `sleep` interrompe o laço)."""
+    sleeps = []
+
+    def fake_sleep(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) > 1:
+            raise _StopWatching()
+
+    with monkeypatch.context() as m:
+        m.setattr(rag_agent.time, 'sleep', fake_sleep)
+        with pytest.raises(_StopWatching):
+            rag_agent._watch_index(vdir, 5)
+
+
+def test_watcher_reloads_only_when_the_index_changes(tmp_path, embedder, serve_index, monkeypatch):
+    vdir = tmp_path / 'vectors'
+    write_index(index_writer.IndexWriter(vdir, 'test-model'), embedder, docs('v1'))
+    rag_agent = serve_index(vdir, embedder)
+    first = rag_agent._current
+
+    assert rag_agent.reload_index(vdir)['reloaded'] is False
+    _watch_once(rag_agent, monkeypatch, vdir)
+    assert rag_agent._current is first
+
+    write_index(index_writer.IndexWriter(vdir, 'test-model'), embedder, docs('v2', 15))
+    _watch_once(rag_agent, monkeypatch, vdir)
+    assert rag_agent._current is not first and rag_agent._current.info()['rows'] == 15
+    assert first.closed
+
+
+def test_watcher_keeps_the_current_generation_when_reload_fails(tmp_path, embedder, serve_index, monkeypatch):
+    vdir = tmp_path / 'vectors'
+    write_index(index_writer.IndexWriter(vdir, 'test-model'), embedder, docs('v1'))
+    rag_agent = serve_index(vdir, embedder)
+    current = rag_agent._current
+
+    # reindex que publicou um embeddings.npy ilegível (arquivo novo, como o os.replace)
+    broken = tmp_path / 'broken.npy'
+    broken.write_bytes(b'nao e um npy')
+    os.replace(broken, vdir / 'embeddings.npy')
+    config = vdir / 'config.json'
+    config.write_text(config.read_text(encoding='utf-8') + '\n', encoding='utf-8')
+    _watch_once(rag_agent, monkeypatch, vdir)
+    assert rag_agent._current is current and not current.closed
+    body = rag_agent.RAGQuery(query='dengue febre', top_k=2)
+    assert len(asyncio.run(rag_agent.retrieve_many([body]))[0]['evidence']) == 2
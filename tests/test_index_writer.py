@@ -0,0 +1,52 @@
+import json
+
+import numpy as np
+import pytest
+
+import chunk_store
+import index_writer
+import vector_store
+from conftest import write_index
+
+
+def test_batches_stream_to_segments_and_publish_aligned(tmp_path, embedder):
+    vdir = tmp_path / 'vectors'
+    writer = index_writer.IndexWriter(vdir, 'test-model', segment_rows=7)
+    texts = [f'caso {i} dengue conduta ' + 'x' * (i * 40) for i in range(30)]
+    for start in range(0, 30, 5):
+        batch = range(start, start + 5)
+        writer.add([f'd{i}' for i in batch], [texts[i] for i in batch], [{'source': 'pdf'}] * 5,
+                   embedder.embed([texts[i] for i in batch]))
+        # só o segmento em formação fica em memória; nada é publicado antes do finalize
+        assert writer._pending_rows < 7
+        assert not (vdir / 'config.json').exists()
+    assert len(writer._segments) == 3
+
+    config = writer.finalize(ann='off')
+    assert config['items_count'] == 30 and not (vdir / index_writer.STAGING_DIR).exists()
+    emb = vector_store.load_embeddings(vdir, config)
+    assert np.allclose(emb, vector_store.normalize_rows(embedder.embed(texts)), atol=1e-6)
+    records = chunk_store.JsonlRecords.load(vdir)
+    store = chunk_store.ChunkStore.load(vdir)
+    assert [r['id'] for r in records] == [f'd{i}' for i in range(30)]
+    assert records[29]['text_preview'].endswith('...')
+    assert store.get_many(range(30)) == texts
+    with open(vdir / 'id_map.json', encoding='utf-8') as f:
+        assert json.load(f)['17'] == 'd17'
+    records.close()
+    store.close()
+
+
+def test_failed_batch_leaves_the_published_index_untouched(tmp_path, embedder):
+    vdir = tmp_path / 'vectors'
+    write_index(index_writer.IndexWriter(vdir, 'test-model'), embedder, [('a', 'dengue'), ('b', 'zika')])
+    before = {p.name: p.read_bytes() for p in vdir.iterdir() if p.is_file()}
+
+    writer = index_writer.IndexWriter(vdir, 'test-model')
+    writer.add(['c'], ['asma'], [None], embedder.embed(['asma']))
+    with pytest.raises(ValueError):
+        writer.add(['d'], ['asma'], [None], np.ones((1, 3), dtype=np.float32))
+    writer.abort()
+
+    assert {p.name: p.read_bytes() for p in vdir.iterdir() if p.is_file()} == before
+    assert not (vdir / index_writer.STAGING_DIR).exists()
@@ -0,0 +1,81 @@
+import os
+
+from ingest_manifest import IngestManifest, Source
+
+ROOTS = {'pdf': 'downloads', 'firestore': 'estacoes_clinicas'}
+
+
+def scan(files, stations=()):
+    sources = [Source(f'pdf::{p.name}', 'pdf', 'downloads', path=p) for p in files]
+    sources += [Source(f'estacao::{doc_id}', 'firestore', 'estacoes_clinicas', update_time=ts) for doc_id, ts in stations]
+    return sources
+
+
+def run(manifest, sources, roots=ROOTS, ids_of=None):
+    """Planeja e registra uma execução; cada fonte reindexada gera os ids de `ids_of`."""
+    plan = manifest.plan(sources, roots)
+    for src in plan.changed:
+        src.ids = (ids_of or {}).get(src.key, [f'{src.key}::chunk0'])
+    manifest.apply(plan, model='test-model')
+    return plan
+
+
+def test_only_new_changed_and_deleted_sources_are_planned(tmp_path):
+    a, b, c = (tmp_path / f'{n}.pdf' for n in 'abc')
+    for p in (a, b, c):
+        p.write_bytes(p.name.encode() * 10)
+    manifest = IngestManifest()
+    first = run(manifest, scan([a, b, c], [('e1', 't1')]))
+    assert len(first.changed) == 4 and first.summary().startswith('4 novas')
+    manifest.save(tmp_path)
+    manifest = IngestManifest.load(tmp_path)
+    assert manifest.model == 'test-model'
+
+    assert run(manifest, scan([a, b, c], [('e1', 't1')])).empty
+
+    # touch sem mudar o conteúdo: o sha256 decide e só atualiza o mtime registrado
+    st = b.stat()
+    os.utime(b, (st.st_atime, st.st_mtime + 10))
+    touched = run(manifest, scan([a, b, c], [('e1', 't1')]))
+    assert touched.empty and [s.key for s in touched.touched] == ['pdf::b.pdf']
+    assert manifest.entries['pdf::b.pdf']['mtime'] == b.stat().st_mtime
+
+    a.write_bytes(b'conteudo novo')
+    c.unlink()
+    plan = run(manifest, scan([a, b], [('e1', 't2')]))
+    assert sorted(s.key for s in plan.changed) == ['estacao::e1', 'pdf::a.pdf']
+    assert all(s.replaces for s in plan.changed)
+    assert plan.deleted == ['pdf::c.pdf']
+    assert sorted(plan.stale_ids) == ['estacao::e1::chunk0', 'pdf::a.pdf::chunk0', 'pdf::c.pdf::chunk0']
+    assert 'pdf::c.pdf' not in manifest.entries
+
+
+def test_unscanned_roots_are_not_deleted(tmp_path):
+    a = tmp_path / 'a.pdf'
+    a.write_bytes(b'a')
+    manifest = IngestManifest()
+    run(manifest, scan([a], [('e1', 't1')]))
+    # Firestore indisponível nesta execução: as estações ficam
+    plan = manifest.plan(scan([a]), {'pdf': 'downloads'})
+    assert plan.empty
+    plan = manifest.plan(scan([], [('e1', 't1')]), {'pdf': 'outra_pasta', 'firestore': 'estacoes_clinicas'})
+    assert plan.empty
+
+
+def test_source_is_requeued_when_the_chunk_kept_for_its_duplicate_leaves(tmp_path):
+    a, b = tmp_path / 'a.pdf', tmp_path / 'b.pdf'
+    a.write_bytes(b'a')
+    b.write_bytes(b'b')
+    manifest = IngestManifest()
+    plan = manifest.plan(scan([a, b]), ROOTS)
+    for src in plan.changed:
+        src.ids = [f'{src.key}::chunk0']
+    # o chunk 1 de b era quase duplicado do chunk 0 de a e não virou linha
+    plan.changed[1].dups = ['pdf::a.pdf::chunk0']
+    manifest.apply(plan)
+
+    a.unlink()
+    plan = manifest.plan(scan([b]), ROOTS)
+    assert plan.deleted == ['pdf::a.pdf']
+    assert [s.key for s in plan.changed] == ['pdf::b.pdf'] and plan.unchanged == 0
+    assert sorted(plan.stale_ids) == ['pdf::a.pdf::chunk0', 'pdf::b.pdf::chunk0']
@@ -0,0 +1,38 @@
+import asyncio
+
+import pytest
+
+import embedding_backend
+import index_writer
+import rag_agent
+
+DOCS = [(f'dengue-{i}', f'dengue febre hemorragica plaquetas caso {i}') for i in range(30)] + \
+       [(f'asma-{i}', f'asma crianca tosse sibilancia caso {i}') for i in range(30)]
+
+
+@pytest.fixture
+def local_index(tmp_path, serve_index):
+    backend = embedding_backend.LocalEmbeddingBackend.fit([text for _, text in DOCS], dim=8)
+    vdir = tmp_path / 'vectors'
+    writer = index_writer.IndexWriter(vdir, backend.model)
+    texts = [text for _, text in DOCS]
+    writer.add([doc_id for doc_id, _ in DOCS], texts, [{'source': 'pdf', 'path': f'{doc_id}.pdf'} for doc_id, _ in DOCS],
+               backend.embed(texts))
+    writer.finalize(ann='off')
+    serve_index(vdir, backend)
+    return backend
+
+
+def test_local_embedding_of_unknown_words_is_null(local_index):
+    embs = local_index.embed(['dengue', 'palavras inexistentes'])
+    assert (embs[0] ** 2).sum() > 0.99
+    assert not embs[1].any()
+
+
+def test_null_query_embedding_falls_back_to_lexical(local_index):
+    bodies = [rag_agent.RAGQuery(query=q, top_k=3, use_cache=False) for q in ('dengue plaquetas', 'palavras inexistentes')]
+    known, unknown = asyncio.run(rag_agent.retrieve_many(bodies))
+    assert known['retrieval_mode'] == 'dense'
+    assert all(e['metadata']['id'].startswith('dengue-') for e in known['evidence'])
+    assert unknown['retrieval_mode'] == 'lexical'
+    assert unknown['evidence'] == []
@@ -0,0 +1,60 @@
+import asyncio
+
+import numpy as np
+import pytest
+from fastapi import HTTPException
+
+import index_writer
+import partition_index
+
+METAS = [
+    {'meta': {'source': 'pdf', 'especialidade': 'Clínica  Médica'}},
+    {'meta': {'source': 'local_prova', 'especialidade': 'pediatria'}},
+    {'source': 'firestore', 'especialidade': 'clinica medica'},
+    None,
+    {'meta': {'source': 'PDF', 'especialidade': ''}},
+    {'meta': {'source': 'local_prova', 'especialidade': 'Clinica Medica'}},
+]
+
+
+def test_select_ands_fields_and_ors_values(tmp_path):
+    partition_index.build_for(tmp_path, METAS)
+    index = partition_index.PartitionIndex.load(tmp_path)
+    assert index.n_rows == len(METAS)
+    assert index.values('source') == ['firestore', 'local_prova', 'pdf']
+
+    assert index.select(None) is None
+    assert index.select({'source': 'pdf'}).tolist() == [0, 4]
+    assert index.select({'especialidade': 'CLÍNICA MÉDICA'}).tolist() == [0, 2, 5]
+    assert index.select({'source': ['pdf', 'firestore']}).tolist() == [0, 2, 4]
+    assert index.select({'source': 'local_prova', 'especialidade': 'clinica medica'}).tolist() == [5]
+    assert index.select({'source': 'pdf', 'especialidade': 'pediatria'}).size == 0
+    assert index.select({'source': 'inexistente'}).size == 0
+    with pytest.raises(ValueError):
+        index.select({'banca': 'inep'})
+
+
+def test_filtered_query_scores_only_the_partition(tmp_path, embedder, serve_index):
+    vdir = tmp_path / 'vectors'
+    specialties = ['pediatria', 'cardiologia']
+    ids = [f'd{i}' for i in range(40)]
+    texts = [f'febre tosse conduta {specialties[i % 2]} {i}' for i in range(40)]
+    metas = [{'source': 'pdf', 'especialidade': specialties[i % 2]} for i in range(40)]
+    writer = index_writer.IndexWriter(vdir, 'test-model')
+    writer.add(ids, texts, metas, embedder.embed(texts))
+    writer.finalize(ann='off')
+    rag_agent = serve_index(vdir, embedder)
+
+    for mode in ('dense', 'lexical', 'hybrid'):
+        body = rag_agent.RAGQuery(query='febre tosse cardiologia', top_k=5, mode=mode,
+                                  filter={'especialidade': 'Pediatria'})
+        result = asyncio.run(rag_agent.retrieve_many([body]))[0]
+        assert result['filtered_rows'] == 20
+        rows = [e['index'] for e in result['evidence']]
+        assert len(rows) == 5 and all(row % 2 == 0 for row in rows)
+
+    body = rag_agent.RAGQuery(query='febre', filter={'banca': 'inep'})
+    with pytest.raises(HTTPException) as err:
+        asyncio.run(rag_agent.retrieve_many([body]))
+    assert err.value.status_code == 400
+    assert np.array_equal(rag_agent._current.partitions.select({'especialidade': 'cardiologia'}), np.arange(1, 40, 2))
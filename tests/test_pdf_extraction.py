@@ -0,0 +1,54 @@
+import inspect
+
+import fitz
+import pytest
+
+import ingest_and_index
+from ingest_manifest import Source
+
+
+def _write_pdf(path, pages):
+    doc = fitz.open()
+    for text in pages:
+        page = doc.new_page()
+        if text:
+            page.insert_text((72, 72), text)
+    doc.save(str(path))
+    doc.close()
+    return path
+
+
+@pytest.fixture
+def pdfs(tmp_path):
+    long_pages = [f'pagina {i} dengue febre hemorragica conduta' for i in range(7)]
+    long_pages[3] = ''
+    return [
+        _write_pdf(tmp_path / 'longo.pdf', long_pages),
+        tmp_path / 'ausente.pdf',
+        _write_pdf(tmp_path / 'curto.pdf', ['zika gestante']),
+        _write_pdf(tmp_path / 'vazio.pdf', ['']),
+    ]
+
+
+def test_page_ranges_are_reassembled_in_order(pdfs):
+    serial = list(ingest_and_index.iter_pdf_texts(pdfs, workers=1))
+    pooled = list(ingest_and_index.iter_pdf_texts(pdfs, workers=2, pages_per_task=2))
+
+    assert [p for p, _, _ in pooled] == pdfs
+    assert [(p, text) for p, text, _ in pooled] == [(p, text) for p, text, _ in serial]
+    assert [error is None for _, _, error in pooled] == [True, False, True, True]
+    text = pooled[0][1]
+    assert [text.index(f'pagina {i} ') for i in (0, 1, 2, 4, 5, 6)] == sorted(text.index(f'pagina {i} ') for i in (0, 1, 2, 4, 5, 6))
+    assert 'pagina 3 ' not in text
+    assert pooled[3][1] == ''
+
+
+def test_extraction_is_serial_by_default(tmp_path, pdfs, monkeypatch):
+    def no_pool(*args, **kwargs):
+        raise AssertionError('pool de processos criado sem --workers')
+
+    monkeypatch.setattr(ingest_and_index, 'ProcessPoolExecutor', no_pool)
+    sources = [Source(f'pdf::{p.name}', 'pdf', 'downloads', path=p) for p in pdfs if p.exists()]
+    items = list(ingest_and_index.iter_source_items(sources, tmp_path))
+    assert items and all(item['meta']['source'] == 'pdf' for item in items)
+    assert inspect.signature(ingest_and_index.main).parameters['workers'].default == 1
@@ -0,0 +1,65 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+import index_writer
+import vector_store
+
+
+@pytest.fixture(scope='module')
+def emb():
+    return vector_store.normalize_rows(np.random.default_rng(11).standard_normal((3000, 24)))
+
+
+@pytest.mark.parametrize('kind, tolerance', [('int8', 0.02), ('float16', 1e-3)])
+def test_compact_scores_approximate_the_exact_ones(tmp_path, emb, kind, tolerance):
+    qcfg = vector_store.save_quantized(tmp_path, emb, kind)
+    assert qcfg['type'] == kind
+    quant = vector_store.load_quantized(tmp_path, {'quantization': qcfg})
+    assert quant.codes.dtype == np.dtype(kind) and isinstance(quant.codes, np.memmap)
+
+    q = np.random.default_rng(12).standard_normal((3, 24))
+    exact = vector_store.dense_scores_batch(q, emb)
+    approx = quant.scores_batch(q)
+    assert np.abs(approx - exact).max() < tolerance
+    rows = np.array([5, 17, 2999])
+    assert np.allclose(quant.score_rows(rows, q[0]), approx[0, rows], atol=1e-5)
+
+
+def test_rerank_recovers_the_exact_top_k(tmp_path, emb):
+    quant = vector_store.load_quantized(tmp_path, {'quantization': vector_store.save_quantized(tmp_path, emb, 'int8')})
+    for q in np.random.default_rng(13).standard_normal((20, 24)):
+        cand, _ = vector_store.top_k(quant.scores_batch(q[None])[0], vector_store.rerank_depth(10))
+        rows, scores = vector_store.rerank(q, emb, cand, 10)
+        exact_rows, exact_scores = vector_store.top_k(vector_store.dense_scores(q, emb), 10)
+        assert rows.tolist() == exact_rows.tolist()
+        assert np.allclose(scores, exact_scores, atol=1e-6)
+
+
+def test_none_removes_the_compact_copy(tmp_path, emb):
+    vector_store.save_quantized(tmp_path, emb, 'int8')
+    assert vector_store.save_quantized(tmp_path, emb, 'none') is None
+    assert not (tmp_path / vector_store.QUANT_FILE).exists()
+    assert not (tmp_path / vector_store.QUANT_SCALE_FILE).exists()
+
+
+def test_quantized_index_serves_the_same_evidence(tmp_path, embedder, serve_index):
+    docs = [(f'd{i}', f'caso {i} dengue {"grave" if i % 3 else "leve"} conduta {i % 7}') for i in range(60)]
+    ids, texts = [d for d, _ in docs], [t for _, t in docs]
+    metas = [{'source': 'pdf', 'path': f'{d}.pdf'} for d in ids]
+    exact_dir, quant_dir = tmp_path / 'exact', tmp_path / 'int8'
+    for vdir, kind in ((exact_dir, 'none'), (quant_dir, 'int8')):
+        writer = index_writer.IndexWriter(vdir, 'test-model')
+        writer.add(ids, texts, metas, embedder.embed(texts))
+        writer.finalize(ann='off', quantize=kind)
+
+    def evidence(vdir):
+        rag_agent = serve_index(vdir, embedder)
+        body = rag_agent.RAGQuery(query='dengue grave conduta 4', top_k=5)
+        return [e['index'] for e in asyncio.run(rag_agent.retrieve_many([body]))[0]['evidence']], rag_agent
+
+    expected, _ = evidence(exact_dir)
+    got, rag_agent = evidence(quant_dir)
+    assert rag_agent._current.quant is not None
+    assert got == expected
@@ -0,0 +1,82 @@
+import sqlite3
+
+import numpy as np
+
+import embedding_cache
+from embedding_cache import QueryEmbeddingCache
+
+
+def _vec(i):
+    return np.full(4, float(i), dtype=np.float32)
+
+
+def _rows(path):
+    with sqlite3.connect(str(path)) as conn:
+        return dict(conn.execute("SELECT query, last_used FROM query_embeddings").fetchall())
+
+
+def test_memory_hit_normalizes_text_and_counts(tmp_path):
+    cache = QueryEmbeddingCache(tmp_path / 'q.sqlite', max_memory_items=8, max_disk_items=100)
+    cache.put('m', 'Dengue   Grave', _vec(1))
+    assert np.array_equal(cache.get('m', ' dengue grave '), _vec(1))
+    assert cache.get('outro-modelo', 'dengue grave') is None
+    stats = cache.stats()
+    assert stats['memory_hits'] == 1 and stats['misses'] == 1 and stats['disk_items'] == 1
+
+
+def test_disk_layer_survives_a_new_process(tmp_path):
+    QueryEmbeddingCache(tmp_path / 'q.sqlite', max_memory_items=8).put('m', 'zika', _vec(2))
+    cache = QueryEmbeddingCache(tmp_path / 'q.sqlite', max_memory_items=8)
+    assert np.array_equal(cache.get('m', 'zika'), _vec(2))
+    assert cache.stats()['disk_hits'] == 1
+    assert cache.get('m', 'zika') is not None
+    assert cache.stats()['memory_hits'] == 1
+
+
+def test_disk_is_pruned_by_least_recent_use(tmp_path, monkeypatch):
+    monkeypatch.setattr(embedding_cache, 'TOUCH_BATCH', 1)
+    path = tmp_path / 'q.sqlite'
+    cache = QueryEmbeddingCache(path, max_memory_items=0, max_disk_items=10)
+    for i in range(10):
+        cache.put('m', f'q{i}', _vec(i))
+    assert cache.get('m', 'q0') is not None  # q0 passa a ser a mais recente
+    cache.put('m', 'q10', _vec(10))
+    rows = _rows(path)
+    # 11 linhas > 10: remove o excesso mais 10% do limite (2 linhas), as menos usadas
+    assert len(rows) == 9 and cache.stats()['disk_items'] == 9
+    assert 'q0' in rows and 'q1' not in rows and 'q2' not in rows
+
+
+def test_put_does_not_count_rows_until_the_limit(tmp_path):
+    path = tmp_path / 'q.sqlite'
+    cache = QueryEmbeddingCache(path, max_memory_items=0, max_disk_items=1000)
+    cache.put('m', 'aquecimento', _vec(0))
+    statements = []
+    cache._conn.set_trace_callback(statements.append)
+    for i in range(20):
+        cache.put('m', f'q{i}', _vec(i))
+    assert not any('COUNT' in s for s in statements)
+
+
+def test_disk_hits_batch_last_used_updates(tmp_path, monkeypatch):
+    monkeypatch.setattr(embedding_cache, 'TOUCH_BATCH', 3)
+    path = tmp_path / 'q.sqlite'
+    cache = QueryEmbeddingCache(path, max_memory_items=0, max_disk_items=100)
+    for i in range(3):
+        cache.put('m', f'q{i}', _vec(i))
+    before = _rows(path)
+    statements = []
+    cache._conn.set_trace_callback(statements.append)
+
+    cache.get('m', 'q0')
+    cache.get('m', 'q1')
+    assert not any(s.startswith('UPDATE') for s in statements)
+    assert _rows(path) == before
+
+    cache.get('m', 'q2')
+    after = _rows(path)
+    assert all(after[q] > before[q] for q in before)
+
+    cache.get('m', 'q0')
+    cache.flush()
+    assert _rows(path)['q0'] > after['q0']
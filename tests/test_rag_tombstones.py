@@ -0,0 +1,54 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+import index_writer
+import rag_agent
+from conftest import write_index
+
+DEAD = 200
+LIVE = 20
+
+
+@pytest.fixture
+def vdir(tmp_path, embedder, serve_index):
+    """Base com DEAD linhas, todas removidas depois, e um segmento com LIVE linhas vivas."""
+    vdir = tmp_path / 'vectors'
+    write_index(index_writer.IndexWriter(vdir, 'test-model'), embedder,
+                [(f'old-{i}', f'dengue febre hemorragica antiga {i}') for i in range(DEAD)])
+    write_index(index_writer.IndexWriter.append(vdir, 'test-model'), embedder,
+                [(f'new-{i}', f'dengue febre hemorragica nova {i}') for i in range(LIVE)])
+    index_writer.tombstone_ids(vdir, [f'old-{i}' for i in range(DEAD)])
+    serve_index(vdir, embedder)
+    return vdir
+
+
+@pytest.mark.parametrize('mode', ['dense', 'lexical', 'hybrid'])
+@pytest.mark.parametrize('diversity', [0.0, 0.5])
+def test_tombstones_do_not_widen_search(vdir, monkeypatch, mode, diversity):
+    body = rag_agent.RAGQuery(query='dengue febre hemorragica', top_k=5, mode=mode, diversity=diversity, use_cache=False)
+    depth = rag_agent._candidate_depth(body)
+    assert rag_agent._current.tombstones.size == DEAD > 5 * depth
+
+    seen = []
+    diversify, rrf_fuse = rag_agent._diversify, rag_agent._rrf_fuse
+
+    def spy_diversify(gen, idx, *args):
+        seen.append(len(idx))
+        return diversify(gen, idx, *args)
+
+    def spy_rrf_fuse(rankings, *args):
+        seen.extend(len(rows) for rows, _ in rankings)
+        return rrf_fuse(rankings, *args)
+
+    monkeypatch.setattr(rag_agent, '_diversify', spy_diversify)
+    monkeypatch.setattr(rag_agent, '_rrf_fuse', spy_rrf_fuse)
+    result = asyncio.run(rag_agent.retrieve_many([body]))[0]
+
+    assert result['retrieval_mode'] == mode
+    evidence = result['evidence']
+    assert len(evidence) == 5
+    assert all(e['metadata']['id'].startswith('new-') for e in evidence)
+    assert all(np.isfinite(e['score']) for e in evidence)
+    assert all(n <= depth for n in seen)
@@ -0,0 +1,161 @@
+import json
+import types
+
+import numpy as np
+import pytest
+
+import chunk_store
+import embedding_backend
+import index_writer
+import reindex_vectors as rv
+import segment_index
+from conftest import TokenEmbedder, write_index
+
+
+@pytest.fixture
+def vdir(tmp_path, monkeypatch, embedder):
+    """Diretório de índice temporário usado pelo `reindex_vectors` (sem API)."""
+    vdir = tmp_path / 'vectors'
+    vdir.mkdir()
+    for name in ('METADATA_FILE', 'EMB_FILE', 'ID_MAP_FILE', 'CFG_FILE', 'WORK_DIR'):
+        monkeypatch.setattr(rv, name, vdir / getattr(rv, name).relative_to(rv.VECTORS_DIR))
+    monkeypatch.setattr(rv, 'VECTORS_DIR', vdir)
+    monkeypatch.setitem(embedding_backend._BACKENDS, 'test-model', embedder)
+    monkeypatch.setattr(rv, 'build_scheduler', lambda args: embedding_backend.EmbeddingScheduler(
+        args.model, rate_per_key=1000, burst_per_key=100, max_in_flight=1, backends=[('test', embedder)]))
+    return vdir
+
+
+def run_reindex(**kwargs):
+    args = dict(model='test-model', batch=8, checkpoint_every=16, resume=False, incremental=False, limit=0,
+                progress=1000, ann='off', ann_lists=0, quantize='none', no_embed_cache=True, drop_empty=False)
+    args.update(kwargs)
+    rv.main(types.SimpleNamespace(**args))
+
+
+def doc_text(i: int, tag: str = 'v1') -> str:
+    return f'documento {i} {tag} pressao arterial glicemia ' + ' '.join(f'termo{i * 7 + j}' for j in range(6))
+
+
+def live_rows(vdir):
+    """(id, metadata) das linhas não removidas de todas as partes do índice."""
+    rows = []
+    for part in segment_index.part_dirs(vdir):
+        records = chunk_store.JsonlRecords.load(part)
+        dead = set()
+        if (part / 'tombstones.npy').exists():
+            dead = set(np.load(part / 'tombstones.npy').tolist())
+        rows.extend((rec['id'], rec) for row, rec in enumerate(records) if row not in dead)
+        records.close()
+    return rows
+
+
+def test_full_reindex_of_segmented_index_keeps_rows_aligned(vdir, embedder):
+    write_index(index_writer.IndexWriter(vdir, 'test-model'), embedder, [(f'd{i}', doc_text(i)) for i in range(20)])
+    write_index(index_writer.IndexWriter.append(vdir, 'test-model'), embedder, [(f'n{i}', doc_text(100 + i)) for i in range(5)])
+    assert len(segment_index.segment_dirs(vdir)) == 1
+
+    run_reindex()
+
+    assert segment_index.segment_dirs(vdir) == []
+    embeddings = np.load(vdir / 'embeddings.npy', mmap_mode='r')
+    records = chunk_store.JsonlRecords.load(vdir)
+    store = chunk_store.ChunkStore.load(vdir)
+    try:
+        ids = index_writer.read_ids(vdir)
+        assert embeddings.shape[0] == len(records) == len(ids) == len(store) == 25
+        assert [rec['id'] for rec in records] == ids
+        assert store.get(ids.index('n3')) == doc_text(103)
+    finally:
+        records.close()
+        store.close()
+    config = json.loads((vdir / 'config.json').read_text(encoding='utf-8'))
+    assert config['items_count'] == 25
+
+
+def test_full_reindex_keeps_newest_copy_of_reingested_id(vdir, embedder):
+    write_index(index_writer.IndexWriter(vdir, 'test-model'), embedder, [(f'd{i}', doc_text(i)) for i in range(10)])
+    # d1 reingerido num segmento com texto novo; a linha antiga fica na base
+    write_index(index_writer.IndexWriter.append(vdir, 'test-model'), embedder, [('d1', doc_text(1, 'v2'))])
+
+    run_reindex()
+
+    ids = index_writer.read_ids(vdir)
+    assert ids.count('d1') == 1 and len(ids) == 10
+    store = chunk_store.ChunkStore.load(vdir)
+    try:
+        assert store.get(ids.index('d1')) == doc_text(1, 'v2')
+    finally:
+        store.close()
+
+
+def test_full_reindex_drops_rows_of_deleted_source(vdir, embedder):
+    write_index(index_writer.IndexWriter(vdir, 'test-model'), embedder, [(f'd{i}', doc_text(i)) for i in range(12)])
+    # fonte removida: linhas d0..d4 marcadas no tombstones.npy
+    index_writer.tombstone_ids(vdir, [f'd{i}' for i in range(5)])
+    write_index(index_writer.IndexWriter.append(vdir, 'test-model', drop_ids=['d6']), embedder, [('d6', doc_text(6, 'v2'))])
+
+    run_reindex()
+
+    ids = index_writer.read_ids(vdir)
+    assert sorted(ids) == sorted(f'd{i}' for i in range(5, 12))
+    assert not (vdir / 'tombstones.npy').exists()
+    assert [doc_id for doc_id, _ in live_rows(vdir)] == ids
+
+
+def test_full_reindex_rejects_limit(vdir, embedder):
+    write_index(index_writer.IndexWriter(vdir, 'test-model'), embedder, [(f'd{i}', doc_text(i)) for i in range(12)])
+    before = (vdir / 'embeddings.npy').read_bytes()
+
+    run_reindex(limit=3)
+
+    assert index_writer.read_ids(vdir) == [f'd{i}' for i in range(12)]
+    assert (vdir / 'embeddings.npy').read_bytes() == before
+
+
+def test_full_reindex_keeps_vectors_of_rows_without_text(vdir, embedder):
+    docs = [(f'd{i}', doc_text(i)) for i in range(8)] + [('vazio', '')]
+    writer = index_writer.IndexWriter(vdir, 'test-model')
+    # linha cujo texto se perdeu, mas com o vetor embedado quando ainda existia
+    emb = np.vstack([embedder.embed([text for _, text in docs[:-1]]), embedder.embed([doc_text(99)])])
+    writer.add([doc_id for doc_id, _ in docs], [text for _, text in docs],
+               [{'source': 'pdf', 'path': f'{doc_id}.pdf'} for doc_id, _ in docs], emb)
+    writer.finalize(ann='off')
+    old = np.load(vdir / 'embeddings.npy')[8].copy()
+    assert old.any()
+
+    run_reindex()
+
+    ids = index_writer.read_ids(vdir)
+    assert sorted(ids) == sorted(doc_id for doc_id, _ in docs)
+    embeddings = np.load(vdir / 'embeddings.npy', mmap_mode='r')
+    assert np.array_equal(embeddings[ids.index('vazio')], old)
+    assert [doc_id for doc_id, _ in live_rows(vdir)] == ids
+
+
+def test_appended_segments_are_compacted_by_the_indexer(vdir, embedder):
+    write_index(index_writer.IndexWriter(vdir, 'test-model'), embedder, [(f'd{i}', doc_text(i)) for i in range(6)])
+    for seg in range(segment_index.COMPACT_MIN_SEGMENTS):
+        write_index(index_writer.IndexWriter.append(vdir, 'test-model'), embedder, [(f's{seg}', doc_text(50 + seg))])
+    assert len(segment_index.segment_dirs(vdir)) == segment_index.COMPACT_MIN_SEGMENTS
+
+    result = index_writer.compact_after_append(vdir)
+
+    assert result['merged'] == segment_index.COMPACT_MIN_SEGMENTS
+    assert len(segment_index.segment_dirs(vdir)) == 1
+    assert sorted(doc_id for doc_id, _ in live_rows(vdir)) == sorted([f'd{i}' for i in range(6)] + [f's{i}' for i in range(segment_index.COMPACT_MIN_SEGMENTS)])
+
+
+def test_incremental_reindex_refuses_another_model_of_same_dimension(vdir, monkeypatch, embedder):
+    write_index(index_writer.IndexWriter(vdir, 'test-model'), embedder, [(f'd{i}', doc_text(i)) for i in range(6)])
+    # documento no metadata.jsonl que ainda não está no id_map: candidato do modo incremental
+    with open(vdir / 'metadata.jsonl', 'a', encoding='utf-8') as f:
+        f.write(json.dumps({'id': 'novo', 'text': doc_text(60), 'meta': {'source': 'pdf'}}) + '\n')
+    other = TokenEmbedder('other-model', dim=embedder.dim)
+    monkeypatch.setitem(embedding_backend._BACKENDS, 'other-model', other)
+
+    run_reindex(incremental=True, model='other-model')
+
+    assert segment_index.segment_dirs(vdir) == []
+    with pytest.raises(ValueError, match='Modelo incompatível'):
+        rv.append_segment(rv.ReindexCheckpoint(rv.WORK_DIR), [], {}, {}, types.SimpleNamespace(model='other-model'))
@@ -0,0 +1,59 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import index_writer
+import rag_agent
+from conftest import write_index
+
+DOCS = [
+    ('dengue', 'dengue febre hemorragica hidratacao venosa'),
+    ('asma', 'asma crise broncodilatador corticoide'),
+    ('iam', 'infarto dor toracica troponina cateterismo'),
+]
+
+
+@pytest.fixture
+def client(tmp_path, embedder, serve_index, monkeypatch):
+    vdir = tmp_path / 'vectors'
+    write_index(index_writer.IndexWriter(vdir, 'test-model'), embedder, DOCS)
+    serve_index(vdir, embedder)
+
+    def no_generation(*args, **kwargs):
+        raise AssertionError('o retrieve não deve chamar o modelo de geração')
+
+    monkeypatch.setattr(rag_agent, 'GenerativeModel', no_generation)
+    app = FastAPI()
+    app.include_router(rag_agent.router)
+    return TestClient(app)
+
+
+def test_retrieve_returns_evidence_without_generation(client):
+    response = client.post('/rag/retrieve', json={'query': 'crise de asma broncodilatador', 'top_k': 2})
+    assert response.status_code == 200
+    payload = response.json()
+    assert payload['retrieval_mode'] == 'dense'
+    assert 'answer' not in payload
+    evidence = payload['evidence']
+    assert len(evidence) == 2
+    assert evidence[0]['metadata']['id'] == 'asma'
+    assert evidence[0]['text'] == dict(DOCS)['asma']
+    assert evidence[0]['score'] >= evidence[1]['score']
+
+
+def test_batch_embeds_once_and_matches_single_queries(client, embedder, monkeypatch):
+    calls = []
+    embed = embedder.embed
+
+    def counting_embed(texts, timeout=None):
+        calls.append(list(texts))
+        return embed(texts)
+
+    queries = [{'query': 'dengue hidratacao', 'top_k': 2}, {'query': 'troponina infarto', 'top_k': 1}]
+    single = [client.post('/rag/retrieve', json=q).json() for q in queries]
+    monkeypatch.setattr(embedder, 'embed', counting_embed)
+    batch = client.post('/rag/retrieve/batch', json={'queries': queries}).json()['results']
+
+    assert calls == [['dengue hidratacao', 'troponina infarto']]
+    assert [[e['index'] for e in r['evidence']] for r in batch] == [[e['index'] for e in r['evidence']] for r in single]
+    assert batch[1]['evidence'][0]['metadata']['id'] == 'iam'
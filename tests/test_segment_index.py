@@ -0,0 +1,45 @@
+import asyncio
+
+import index_writer
+import segment_index
+from conftest import write_index
+
+
+def evidence_ids(rag_agent, query, **kw):
+    body = rag_agent.RAGQuery(query=query, top_k=4, **kw)
+    return [e['metadata']['id'] for e in asyncio.run(rag_agent.retrieve_many([body]))[0]['evidence']]
+
+
+def test_segments_are_served_as_one_index_before_and_after_compaction(tmp_path, embedder, serve_index):
+    vdir = tmp_path / 'vectors'
+    write_index(index_writer.IndexWriter(vdir, 'test-model'), embedder,
+                [(f'base-{i}', f'asma crise caso {i}') for i in range(10)])
+    for seg in range(3):
+        # cada segmento reingere base-{seg} com texto novo e traz uma linha própria
+        write_index(index_writer.IndexWriter.append(vdir, 'test-model', drop_ids=[f'base-{seg}']), embedder,
+                    [(f'base-{seg}', f'dengue grave reingerido {seg}'), (f'seg-{seg}', f'zika gestante {seg}')])
+    assert len(segment_index.segment_dirs(vdir)) == 3
+
+    rag_agent = serve_index(vdir, embedder)
+    gen = rag_agent._current
+    assert gen.segments == 3 and gen.embeddings.shape[0] == 16 and gen.tombstones.size == 3
+    before = {mode: evidence_ids(rag_agent, 'dengue grave reingerido', mode=mode) for mode in ('dense', 'lexical', 'hybrid')}
+    for ids in before.values():
+        assert sorted(ids[:3]) == ['base-0', 'base-1', 'base-2']
+    # a versão antiga de base-0 (asma) saiu do índice
+    body = rag_agent.RAGQuery(query='asma crise caso 0', top_k=16, mode='lexical')
+    texts = [e['text'] for e in asyncio.run(rag_agent.retrieve_many([body]))[0]['evidence']]
+    assert 'asma crise caso 0' not in texts and 'asma crise caso 5' in texts
+
+    result = index_writer.compact_segments(vdir, min_segments=2)
+    assert result == {'merged': 3, 'rows': 6, 'major': False}
+    rag_agent.reload_index(vdir)
+    assert rag_agent._current.segments == 1
+    for mode, ids in before.items():
+        assert sorted(evidence_ids(rag_agent, 'dengue grave reingerido', mode=mode)[:3]) == sorted(ids[:3])
+
+    assert index_writer.compact_segments(vdir, major=True)['rows'] == 13
+    rag_agent.reload_index(vdir)
+    gen = rag_agent._current
+    assert gen.segments == 0 and gen.tombstones is None and gen.embeddings.shape[0] == 13
+    assert segment_index.segment_dirs(vdir) == []
@@ -0,0 +1,76 @@
+import asyncio
+
+import numpy as np
+
+import index_writer
+import rag_agent
+import semantic_cache
+from conftest import write_index
+
+# modelo das queries da Fase 1 (main.rag_queries_for_theme)
+FASE_1 = '{tema} {especialidade} diretrizes protocolo tratamento'
+
+
+def unit(i, dim=8):
+    v = np.zeros(dim, dtype=np.float32)
+    v[i % dim] = 1.0
+    return v
+
+
+def test_key_index_only_keeps_keys_with_entries():
+    cache = semantic_cache.SemanticCache(max_items=4, ttl=3600, max_distance=0.05)
+    for i in range(100):
+        cache.put(1, ('k', i), unit(i), f'q{i}', i)
+    assert len(cache._key_index) == len(cache._keys) == 4
+    assert cache.stats()['evictions'] == 96
+    # as últimas chaves continuam achando suas entradas; as despejadas não
+    assert cache.lookup(1, ('k', 99), unit(99))[0] == 99
+    assert cache.lookup(1, ('k', 0), unit(0)) is None
+
+
+def test_expired_entries_release_their_keys(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(semantic_cache.time, 'time', lambda: now[0])
+    cache = semantic_cache.SemanticCache(max_items=8, ttl=10, max_distance=0.05)
+    cache.put(1, 'a', unit(0), 'qa', 'A')
+    cache.put(1, 'a', unit(1), 'qa2', 'A2')
+    cache.put(1, 'b', unit(2), 'qb', 'B')
+    now[0] += 11
+    cache.put(1, 'c', unit(3), 'qc', 'C')
+    assert set(cache._key_index) == {'c'}
+    assert cache.lookup(1, 'a', unit(0)) is None
+    assert cache.lookup(1, 'c', unit(3))[0] == 'C'
+    assert cache.stats()['items'] == 1
+
+
+def test_cache_is_opt_in():
+    assert rag_agent.RAGQuery(query='x').use_cache is False
+
+
+def test_themes_from_same_template_do_not_collide(embedder):
+    cache = semantic_cache.SemanticCache(max_items=16, ttl=3600, max_distance=rag_agent.SEMANTIC_CACHE.max_distance)
+    themes = [('dengue', 'infectologia'), ('malaria', 'infectologia'), ('asma', 'pediatria'), ('bronquiolite', 'pediatria')]
+    queries = [FASE_1.format(tema=tema, especialidade=esp) for tema, esp in themes]
+    embs = embedder.embed(queries)
+    cache.put(1, 'fase_1', embs[0], queries[0], queries[0])
+    for query, emb in zip(queries[1:], embs[1:]):
+        assert cache.lookup(1, 'fase_1', emb) is None, query
+    assert cache.lookup(1, 'fase_1', embs[0])[0] == queries[0]
+
+
+def test_given_query_embedding_is_not_looked_up_twice(tmp_path, monkeypatch, embedder, serve_index):
+    vdir = tmp_path / 'vectors'
+    write_index(index_writer.IndexWriter(vdir, 'test-model'), embedder, [(f'd{i}', f'dengue caso {i}') for i in range(10)])
+    serve_index(vdir, embedder)
+    cache = semantic_cache.SemanticCache(max_items=16, ttl=3600, max_distance=0.02)
+    monkeypatch.setattr(rag_agent, 'SEMANTIC_CACHE', cache)
+    body = rag_agent.RAGQuery(query='dengue caso', top_k=3, use_cache=True)
+
+    # como no rag_query: o chamador já consultou o cache com este embedding
+    first = asyncio.run(rag_agent.retrieve_many([body], q_embs=[embedder.embed_one(body.query)]))[0]
+    assert first['semantic_cache'] is None
+    assert cache.stats()['misses'] == 0 and cache.stats()['items'] == 1
+
+    second = asyncio.run(rag_agent.retrieve_many([body]))[0]
+    assert second['semantic_cache']['hit'] is True
+    assert [e['index'] for e in second['evidence']] == [e['index'] for e in first['evidence']]
@@ -0,0 +1,95 @@
+import json
+
+import numpy as np
+
+import vector_store
+
+
+def _config(vdir):
+    with open(vdir / 'config.json', 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def test_saved_rows_are_normalized_and_memory_mapped(tmp_path):
+    emb = np.array([[3.0, 4.0], [0.0, 0.0], [-2.0, 0.0]])
+    vector_store.save_embeddings(tmp_path, emb)
+
+    loaded = vector_store.load_embeddings(tmp_path, {'vector_format': vector_store.VECTOR_FORMAT})
+    assert isinstance(loaded, np.memmap) and loaded.dtype == np.float32
+    assert np.allclose(loaded, [[0.6, 0.8], [0.0, 0.0], [-1.0, 0.0]])
+    assert np.allclose(vector_store.dense_scores(np.array([6.0, 8.0]), loaded), [1.0, 0.0, -0.6])
+
+
+def test_legacy_index_is_normalized_on_load_and_converted(tmp_path):
+    raw = np.array([[3.0, 4.0], [0.0, 5.0]], dtype=np.float64)
+    np.save(tmp_path / vector_store.EMBEDDINGS_FILE, raw)
+    (tmp_path / 'config.json').write_text(json.dumps({'model': 'm'}), encoding='utf-8')
+
+    legacy = vector_store.load_embeddings(tmp_path, _config(tmp_path))
+    assert not isinstance(legacy, np.memmap)
+    assert np.allclose(legacy, [[0.6, 0.8], [0.0, 1.0]])
+
+    assert vector_store.convert_legacy(tmp_path)
+    cfg = _config(tmp_path)
+    assert cfg == {'model': 'm', 'vector_format': vector_store.VECTOR_FORMAT}
+    converted = vector_store.load_embeddings(tmp_path, cfg)
+    assert isinstance(converted, np.memmap)
+    assert np.allclose(converted, legacy)
+    assert not vector_store.convert_legacy(tmp_path)
+
+
+def test_top_k_matches_a_full_sort():
+    rng = np.random.default_rng(3)
+    scores = rng.standard_normal(1000).astype(np.float32)
+    idx, top = vector_store.top_k(scores, 25)
+    assert np.array_equal(idx, np.argsort(-scores)[:25])
+    assert np.array_equal(top, scores[idx])
+    assert vector_store.top_k(scores[:3], 10)[0].tolist() == np.argsort(-scores[:3]).tolist()
+    assert vector_store.top_k(scores, 0)[0].size == 0
+
+
+def test_batch_scores_match_one_query_at_a_time():
+    rng = np.random.default_rng(4)
+    emb = vector_store.normalize_rows(rng.standard_normal((200, 8)))
+    queries = rng.standard_normal((5, 8))
+    batch = vector_store.dense_scores_batch(queries, emb)
+    assert batch.shape == (5, 200)
+    for row, q in enumerate(queries):
+        assert np.allclose(batch[row], vector_store.dense_scores(q, emb), atol=1e-6)
+
+
+def naive_mmr(rel, vecs, k, lam):
+    vecs = vector_store.normalize_rows(vecs)
+    selected = []
+    while len(selected) < min(k, len(rel)):
+        best, best_score = None, -np.inf
+        for i in range(len(rel)):
+            if i in selected:
+                continue
+            penalty = max((float(vecs[i] @ vecs[j]) for j in selected), default=0.0)
+            score = (1 - lam) * rel[i] - lam * penalty
+            if score > best_score:
+                best, best_score = i, score
+        selected.append(best)
+    return selected
+
+
+def test_mmr_matches_the_greedy_definition():
+    rng = np.random.default_rng(5)
+    vecs = rng.standard_normal((40, 6))
+    rel = rng.random(40).astype(np.float32)
+    for lam in (0.0, 0.3, 0.7, 1.0):
+        assert vector_store.mmr(rel, vecs, 10, lam).tolist() == naive_mmr(rel, vecs, 10, lam)
+    assert vector_store.mmr(rel, vecs, 10, 0.0).tolist() == np.argsort(-rel)[:10].tolist()
+    assert vector_store.mmr(rel[:3], vecs[:3], 10, 0.5).size == 3
+
+
+def test_mmr_skips_near_duplicates():
+    base = np.array([1.0, 0.0, 0.0])
+    vecs = np.array([base, base + [0, 0.01, 0], base + [0, 0, 0.01], [0.0, 1.0, 0.0]])
+    rel = np.array([0.9, 0.89, 0.88, 0.5])
+    assert vector_store.mmr(rel, vecs, 2, 0.0).tolist() == [0, 1]
+    assert vector_store.mmr(rel, vecs, 2, 0.5).tolist() == [0, 3]
+    # BM25/RRF: relevância reescalada para [0, 1] antes de comparar com o cosseno
+    assert vector_store.mmr(rel * 40, vecs, 2, 0.5).tolist() == [0, 1]
+    assert vector_store.mmr(rel * 40, vecs, 2, 0.5, rescale=True).tolist() == [0, 3]
@@ -0,0 +1,336 @@
+"""Armazenamento dos vetores do RAG (`memoria/vectors`).
+
+Formato `normalized_f32`: `embeddings.npy` em float32, com as linhas já normalizadas
+(L2) no momento da indexação. O arquivo é aberto com `np.load(mmap_mode='r')`, então
+uma consulta é um único produto matriz-vetor e as páginas ficam no cache do sistema
+operacional, compartilhadas entre os workers do uvicorn.
+
+Índices antigos (sem `vector_format` no `config.json`) continuam sendo lidos: o arquivo
+é carregado em memória e normalizado uma única vez no carregamento.
+
+Formato compacto opcional (`config.json['quantization']`): uma cópia int8 (quantização
+escalar por dimensão, 4x menor) ou float16 (2x menor) em `embeddings_q.npy` é usada na
+primeira varredura; os melhores candidatos são reordenados com o produto exato em
+float32 (`embeddings.npy`, via mmap, só as linhas dos candidatos são lidas).
+
+Conversão de um índice antigo (PowerShell):
+    python vector_store.py memoria/vectors
+    python vector_store.py memoria/vectors --quantize int8
+"""
+
+import json
+import os
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+VECTOR_FORMAT = 'normalized_f32'
+EMBEDDINGS_FILE = 'embeddings.npy'
+QUANT_FILE = 'embeddings_q.npy'
+QUANT_SCALE_FILE = 'embeddings_q_scale.npy'
+QUANT_KINDS = ('int8', 'float16')
+# Linhas removidas (fontes apagadas/alteradas) ainda presentes nos arquivos do índice
+TOMBSTONES_FILE = 'tombstones.npy'
+# Candidatos reordenados em float32: max(RERANK_FACTOR * k, RERANK_MIN)
+RERANK_FACTOR = 4
+RERANK_MIN = 50
+# Linhas convertidas para float32 por vez na varredura do formato compacto
+SCAN_BATCH = 4096
+
+
+def normalize_rows(arr: np.ndarray) -> np.ndarray:
+    """Converte para float32 e normaliza cada linha (L2); linhas nulas ficam como estão."""
+    arr = np.asarray(arr, dtype=np.float32)
+    if arr.ndim == 1:
+        arr = arr.reshape(1, -1)
+    norms = np.linalg.norm(arr, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return arr / norms
+
+
+def normalize_query(q: np.ndarray) -> np.ndarray:
+    """Normaliza o vetor da query (float32, 1-D)."""
+    q = np.asarray(q, dtype=np.float32).reshape(-1)
+    n = float(np.linalg.norm(q))
+    if n == 0:
+        return q
+    return q / n
+
+
+def save_embeddings(out_dir: Path, embeddings: np.ndarray) -> Path:
+    """Salva `embeddings.npy` no formato normalizado.
+
+    A escrita é feita em arquivo temporário + `os.replace`, para que processos que já
+    mapearam o arquivo antigo continuem lendo uma cópia íntegra (POSIX; no Windows o
+    `os.replace` falha enquanto outro processo tiver o arquivo aberto).
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    target = out_dir / EMBEDDINGS_FILE
+    tmp = out_dir / (EMBEDDINGS_FILE + '.tmp')
+    with open(tmp, 'wb') as f:
+        np.save(f, normalize_rows(embeddings))
+    os.replace(tmp, target)
+    return target
+
+
+def load_embeddings(vdir: Path, config: Optional[dict] = None) -> np.ndarray:
+    """Abre os embeddings de `vdir`.
+
+    No formato `normalized_f32` retorna um memmap somente leitura; em índices antigos
+    carrega o arquivo e normaliza uma vez.
+    """
+    emb_file = Path(vdir) / EMBEDDINGS_FILE
+    if not emb_file.exists():
+        raise FileNotFoundError(str(emb_file))
+    if (config or {}).get('vector_format') == VECTOR_FORMAT:
+        return np.load(str(emb_file), mmap_mode='r')
+    return normalize_rows(np.load(str(emb_file)))
+
+
+def dense_scores(q_emb: np.ndarray, embeddings: np.ndarray) -> np.ndarray:
+    """Similaridade de cosseno entre a query e todas as linhas (já normalizadas)."""
+    return np.asarray(embeddings @ normalize_query(q_emb), dtype=np.float32)
+
+
+def dense_scores_batch(q_embs: np.ndarray, embeddings: np.ndarray) -> np.ndarray:
+    """Similaridades (N, M) de N queries contra M linhas num único produto de matrizes.
+
+    Índices em segmentos (`segment_index.SegmentedVectors`) são pontuados parte a parte.
+    """
+    if hasattr(embeddings, 'scores_batch'):
+        return embeddings.scores_batch(normalize_rows(q_embs))
+    return np.asarray(normalize_rows(q_embs) @ embeddings.T, dtype=np.float32)
+
+
+def top_k(scores: np.ndarray, k: int):
+    """Retorna (índices, scores) dos k maiores valores, em ordem decrescente.
+
+    Usa `np.argpartition` (O(M)) e ordena apenas os k selecionados.
+    """
+    scores = np.asarray(scores)
+    k = min(int(k), scores.shape[0])
+    if k <= 0:
+        return np.empty(0, dtype=np.int64), scores[:0]
+    if k < scores.shape[0]:
+        idx = np.argpartition(-scores, k - 1)[:k]
+    else:
+        idx = np.arange(scores.shape[0])
+    idx = idx[np.argsort(-scores[idx], kind='stable')]
+    return idx, scores[idx]
+
+
+def quantize(embeddings: np.ndarray, kind: str):
+    """Retorna (códigos, escala) no formato compacto `kind` ('int8' ou 'float16').
+
+    int8: escala simétrica por dimensão (max |x| / 127), com `x ≈ código * escala`;
+    float16 não usa escala (None).
+    """
+    if kind == 'float16':
+        codes = np.empty(embeddings.shape, dtype=np.float16)
+        for start in range(0, embeddings.shape[0], SCAN_BATCH):
+            codes[start:start + SCAN_BATCH] = np.asarray(embeddings[start:start + SCAN_BATCH], dtype=np.float16)
+        return codes, None
+    if kind != 'int8':
+        raise ValueError(f"quantização desconhecida: {kind}")
+    max_abs = np.zeros(embeddings.shape[1], dtype=np.float32)
+    for start in range(0, embeddings.shape[0], SCAN_BATCH):
+        block = np.abs(np.asarray(embeddings[start:start + SCAN_BATCH], dtype=np.float32))
+        np.maximum(max_abs, block.max(axis=0), out=max_abs)
+    scale = np.where(max_abs > 0, max_abs / 127.0, 1.0).astype(np.float32)
+    codes = np.empty(embeddings.shape, dtype=np.int8)
+    for start in range(0, embeddings.shape[0], SCAN_BATCH):
+        block = np.asarray(embeddings[start:start + SCAN_BATCH], dtype=np.float32) / scale
+        codes[start:start + SCAN_BATCH] = np.clip(np.rint(block), -127, 127)
+    return codes, scale
+
+
+class QuantizedVectors:
+    """Cópia compacta dos vetores para a primeira varredura (scores aproximados)."""
+
+    def __init__(self, kind: str, codes: np.ndarray, scale: Optional[np.ndarray] = None):
+        self.kind = kind
+        self.codes = codes
+        self.scale = scale
+
+    def _query_matrix(self, q_embs: np.ndarray) -> np.ndarray:
+        q = normalize_rows(q_embs)
+        return q * self.scale if self.scale is not None else q
+
+    def scores_batch(self, q_embs: np.ndarray) -> np.ndarray:
+        """Similaridades aproximadas (N, M), convertendo os códigos em blocos."""
+        q = self._query_matrix(q_embs)
+        n_rows = self.codes.shape[0]
+        out = np.empty((q.shape[0], n_rows), dtype=np.float32)
+        for start in range(0, n_rows, SCAN_BATCH):
+            block = np.asarray(self.codes[start:start + SCAN_BATCH], dtype=np.float32)
+            out[:, start:start + block.shape[0]] = q @ block.T
+        return out
+
+    def score_rows(self, rows: np.ndarray, q_emb: np.ndarray) -> np.ndarray:
+        """Similaridades aproximadas de uma query contra as linhas `rows`."""
+        q = self._query_matrix(q_emb)[0]
+        return np.asarray(self.codes[rows], dtype=np.float32) @ q
+
+
+def save_quantized(out_dir: Path, embeddings: np.ndarray, kind: Optional[str]) -> Optional[dict]:
+    """Grava (ou remove, com `kind` None/'none') a cópia compacta de `embeddings`.
+
+    Retorna o trecho para `config.json['quantization']` ou None.
+    """
+    out_dir = Path(out_dir)
+    if not kind or kind == 'none' or embeddings.shape[0] == 0:
+        remove_quantized(out_dir)
+        return None
+    codes, scale = quantize(embeddings, kind)
+    for name, arr in ((QUANT_FILE, codes), (QUANT_SCALE_FILE, scale)):
+        if arr is None:
+            continue
+        tmp = out_dir / (name + '.tmp')
+        with open(tmp, 'wb') as f:
+            np.save(f, arr)
+        os.replace(tmp, out_dir / name)
+    if scale is None:
+        try:
+            (out_dir / QUANT_SCALE_FILE).unlink()
+        except FileNotFoundError:
+            pass
+    print(f"✅ Vetores compactos ({kind}) salvos em: {out_dir / QUANT_FILE}")
+    return {'type': kind, 'rerank_factor': RERANK_FACTOR, 'rerank_min': RERANK_MIN}
+
+
+def load_quantized(vdir: Path, config: Optional[dict] = None) -> Optional[QuantizedVectors]:
+    """Abre a cópia compacta indicada em `config['quantization']` (None se não houver)."""
+    qcfg = (config or {}).get('quantization') or {}
+    kind = qcfg.get('type')
+    qfile = Path(vdir) / QUANT_FILE
+    if kind not in QUANT_KINDS or not qfile.exists():
+        return None
+    scale = None
+    if kind == 'int8':
+        scale_file = Path(vdir) / QUANT_SCALE_FILE
+        if not scale_file.exists():
+            return None
+        scale = np.load(str(scale_file))
+    return QuantizedVectors(kind, np.load(str(qfile), mmap_mode='r'), scale)
+
+
+def remove_quantized(vdir: Path):
+    for name in (QUANT_FILE, QUANT_SCALE_FILE):
+        try:
+            (Path(vdir) / name).unlink()
+        except FileNotFoundError:
+            pass
+
+
+def load_tombstones(vdir: Path) -> Optional[np.ndarray]:
+    """Linhas marcadas como removidas (int64 ordenado), ou None se não houver."""
+    path = Path(vdir) / TOMBSTONES_FILE
+    if not path.exists():
+        return None
+    rows = np.load(str(path))
+    return rows if rows.size else None
+
+
+def save_tombstones(vdir: Path, rows: np.ndarray):
+    tmp = Path(vdir) / (TOMBSTONES_FILE + '.tmp')
+    with open(tmp, 'wb') as f:
+        np.save(f, np.unique(np.asarray(rows, dtype=np.int64)))
+    os.replace(tmp, Path(vdir) / TOMBSTONES_FILE)
+
+
+def remove_tombstones(vdir: Path):
+    try:
+        (Path(vdir) / TOMBSTONES_FILE).unlink()
+    except FileNotFoundError:
+        pass
+
+
+def rerank_depth(k: int, config: Optional[dict] = None) -> int:
+    """Quantos candidatos da varredura compacta são reordenados em float32."""
+    qcfg = (config or {}).get('quantization') or {}
+    return max(int(k) * int(qcfg.get('rerank_factor', RERANK_FACTOR)), int(qcfg.get('rerank_min', RERANK_MIN)), int(k))
+
+
+def rerank(q_emb: np.ndarray, embeddings: np.ndarray, rows: np.ndarray, k: int):
+    """Reordena `rows` pelo produto exato em float32; retorna (linhas, scores) do top k."""
+    rows = np.asarray(rows, dtype=np.int64)
+    if rows.size == 0:
+        return rows, np.empty(0, dtype=np.float32)
+    order = np.argsort(rows)  # leitura sequencial do memmap
+    rows = rows[order]
+    scores = np.asarray(embeddings[rows], dtype=np.float32) @ normalize_query(q_emb)
+    idx, top = top_k(scores, k)
+    return rows[idx], top
+
+
+def mmr(relevance: np.ndarray, vectors: np.ndarray, k: int, diversity: float, rescale: bool = False) -> np.ndarray:
+    """Maximal marginal relevance: posições (em `relevance`) dos k itens escolhidos, em ordem.
+
+    A cada passo escolhe o candidato com maior `(1 - diversity) * relevância -
+    diversity * max(similaridade com os já escolhidos)`. As similaridades entre
+    candidatos vêm de uma única matriz (C×C); cada passo é vetorizado. Com `rescale`
+    (scores BM25/RRF) a relevância é levada para [0, 1], comparável ao cosseno.
+    """
+    rel = np.asarray(relevance, dtype=np.float32)
+    n = rel.shape[0]
+    k = min(int(k), n)
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if rescale:
+        span = float(rel.max() - rel.min())
+        rel = (rel - rel.min()) / span if span > 0 else np.ones_like(rel)
+    vecs = normalize_rows(vectors)
+    sim = vecs @ vecs.T
+    lam = float(min(max(diversity, 0.0), 1.0))
+
+    selected = np.empty(k, dtype=np.int64)
+    chosen = np.zeros(n, dtype=bool)
+    max_sim = np.full(n, -np.inf, dtype=np.float32)
+    for step in range(k):
+        penalty = np.where(np.isfinite(max_sim), max_sim, 0.0)
+        score = (1.0 - lam) * rel - lam * penalty
+        score[chosen] = -np.inf
+        best = int(np.argmax(score))
+        selected[step] = best
+        chosen[best] = True
+        np.maximum(max_sim, sim[best], out=max_sim)
+    return selected
+
+
+def convert_legacy(vdir: Path) -> bool:
+    """Normaliza um índice antigo no lugar e marca `vector_format` no `config.json`."""
+    vdir = Path(vdir)
+    cfg_file = vdir / 'config.json'
+    cfg = {}
+    if cfg_file.exists():
+        with open(cfg_file, 'r', encoding='utf-8') as f:
+            cfg = json.load(f)
+    if cfg.get('vector_format') == VECTOR_FORMAT:
+        print(f"ℹ️ {vdir} já está no formato {VECTOR_FORMAT}")
+        return False
+    emb = load_embeddings(vdir, cfg)
+    save_embeddings(vdir, emb)
+    cfg['vector_format'] = VECTOR_FORMAT
+    with open(cfg_file, 'w', encoding='utf-8') as f:
+        json.dump(cfg, f, ensure_ascii=False, indent=2)
+    print(f"✅ {vdir / EMBEDDINGS_FILE} convertido para {VECTOR_FORMAT} (shape={emb.shape})")
+    return True
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Converte memoria/vectors para o formato normalizado (mmap)')
+    parser.add_argument('vectors_dir', nargs='?', default='memoria/vectors')
+    parser.add_argument('--quantize', choices=['none', 'int8', 'float16'], default=None, help='Grava (ou remove, com none) a cópia compacta usada na primeira varredura')
+    args = parser.parse_args()
+    vdir = Path(args.vectors_dir)
+    convert_legacy(vdir)
+    if args.quantize:
+        with open(vdir / 'config.json', 'r', encoding='utf-8') as f:
+            cfg = json.load(f)
+        cfg['quantization'] = save_quantized(vdir, load_embeddings(vdir, cfg), args.quantize)
+        with open(vdir / 'config.json', 'w', encoding='utf-8') as f:
+            json.dump(cfg, f, ensure_ascii=False, indent=2)